@@ -0,0 +1,13 @@
+"""
+Micro-benchmarks for pyservice's hot paths.
+
+Run every suite, optionally saving the results and comparing them against
+a baseline (see benchmarks/__main__.py):
+
+    python -m benchmarks --baseline baseline.json --output results.json
+
+Each module can also be run directly, ie:
+
+    python -m benchmarks.allocations
+    python -m benchmarks.chain
+"""
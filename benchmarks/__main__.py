@@ -0,0 +1,58 @@
+"""
+Run the benchmark suites, and compare them against a saved baseline.
+
+    # Save a baseline
+    python -m benchmarks --output baseline.json
+
+    # After a change (or upgrade), compare against it.  Exits with status 1
+    # when any case is more than --tolerance slower.
+    python -m benchmarks --baseline baseline.json --output results.json
+
+    # Only some suites
+    python -m benchmarks chain routing
+"""
+import argparse
+import importlib
+import sys
+from benchmarks import harness
+
+SUITES = ("chain", "serialization", "body", "routing", "roundtrip",
+          "allocations")
+
+
+def run(suites):
+    results = {}
+    for suite in suites:
+        module = importlib.import_module("benchmarks." + suite)
+        for case, value in module.run().items():
+            results["{}.{}".format(suite, case)] = value
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument(
+        "suites", nargs="*", metavar="suite",
+        help="any of {} (default: all)".format(", ".join(SUITES)))
+    parser.add_argument("--output", help="save results to this file")
+    parser.add_argument("--baseline", help="compare against this file")
+    parser.add_argument("--tolerance", type=float, default=harness.TOLERANCE,
+                        help="slowdown reported as a regression (0.1 = 10%%)")
+    args = parser.parse_args(argv)
+    unknown = [suite for suite in args.suites if suite not in SUITES]
+    if unknown:
+        parser.error("unknown suite: {}".format(", ".join(unknown)))
+
+    results = run(args.suites or SUITES)
+    if args.output:
+        harness.save(args.output, results)
+    if not args.baseline:
+        harness.report(results)
+        return 0
+    rows = harness.compare(results, harness.load(args.baseline))
+    harness.report(results, rows, args.tolerance)
+    return 1 if harness.regressions(rows, args.tolerance) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
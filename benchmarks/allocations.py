@@ -0,0 +1,101 @@
+"""
+Per-request allocation benchmark for ServiceProcessor and ClientProcessor.
+
+Reports, per request:
+    cyclic - objects that could only be reclaimed by the cyclic GC
+    blocks - memory blocks still allocated until the cyclic GC runs
+    time   - wall time in microseconds (best of several runs)
+
+Before Context/Processor lost their reference cycles, every request left
+its processor, context and both containers for the GC.  Containers are
+still their own __dict__ (see common.Container), so they're left behind.
+"""
+import gc
+import sys
+import timeit
+import ujson
+from pyservice import Client, Service, processors
+
+REQUESTS = 10000
+REQUEST_BODY = ujson.dumps({"key": "value", "values": [1, 2, 3]})
+
+
+def make_service():
+    service = Service(operations=["foo"])
+
+    @service.plugin(scope="request")
+    def request_plugin(context):
+        context.process_request()
+
+    @service.plugin(scope="operation")
+    def operation_plugin(request, response, context):
+        context.process_request()
+
+    @service.operation("foo")
+    def foo(request, response, context):
+        response.key = request.key
+        response.values = request.values
+    return service
+
+
+def make_client():
+    class Transport:
+        class Response:
+            status_code = 200
+            headers = {}
+            text = REQUEST_BODY
+
+        def send(self, uri, data, headers=None, timeout=None):
+            return self.Response
+    client = Client(operations=["foo"])
+    client.transport = Transport()
+    return client
+
+
+def measure(func):
+    gc.collect()
+    gc.disable()
+    try:
+        blocks = sys.getallocatedblocks()
+        for _ in range(REQUESTS):
+            func()
+        blocks = sys.getallocatedblocks() - blocks
+        cyclic = gc.collect()
+    finally:
+        gc.enable()
+    # Include the cost of GC collections in the timing
+    timer = timeit.Timer(func, setup="import gc; gc.enable()")
+    best = min(timer.repeat(number=REQUESTS, repeat=5))
+    return {
+        "cyclic": cyclic / REQUESTS,
+        "blocks": blocks / REQUESTS,
+        "time": best / REQUESTS * 1e6
+    }
+
+
+def measure_all():
+    service = make_service()
+    client = make_client()
+    return {
+        "service": measure(lambda: processors.ServiceProcessor(
+            service, "foo", REQUEST_BODY)()),
+        "client": measure(lambda: processors.ClientProcessor(
+            client, "foo", {"key": "value"})())
+    }
+
+
+def run():
+    ''' Microseconds per request, for the suite runner '''
+    return {name: result["time"] for name, result in measure_all().items()}
+
+
+def main():
+    results = measure_all()
+    for name, result in results.items():
+        print("{:8} cyclic {cyclic:6.2f}  blocks {blocks:6.2f}  "
+              "time {time:6.2f}us".format(name, **result))
+    return results
+
+
+if __name__ == "__main__":
+    main()
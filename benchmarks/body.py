@@ -0,0 +1,44 @@
+"""
+wsgi.load_body by body size, for Content-Length and chunked bodies.
+"""
+import io
+from benchmarks import harness
+from pyservice import wsgi
+
+SIZES = {"100b": 100, "10kb": 10 * 1024, "1mb": 1024 * 1024}
+
+
+def plain(data):
+    return {
+        "CONTENT_LENGTH": str(len(data)),
+        "wsgi.input": io.BytesIO(data)
+    }
+
+
+def chunked(data, size=wsgi.BUFFER_SIZE):
+    encoded = b"".join(
+        b"%x\r\n%s\r\n" % (len(data[i:i + size]), data[i:i + size])
+        for i in range(0, len(data), size)) + b"0\r\n\r\n"
+    return {
+        "HTTP_TRANSFER_ENCODING": "chunked",
+        "wsgi.input": io.BytesIO(encoded)
+    }
+
+
+def run():
+    results = {}
+    for name, size in SIZES.items():
+        data = b"x" * size
+        for kind, make_environ in [("length", plain), ("chunked", chunked)]:
+            environ = make_environ(data)
+            stream = environ["wsgi.input"]
+
+            def load():
+                stream.seek(0)
+                wsgi.load_body(environ, max_size=size)
+            results["{}_{}".format(kind, name)] = harness.measure(load)
+    return results
+
+
+if __name__ == "__main__":
+    harness.report(run())
@@ -0,0 +1,43 @@
+"""
+Processor chain overhead by plugin count.
+
+Every plugin only continues the chain, so the difference between cases is
+the cost of the chain itself: one request and one operation plugin per
+step of PLUGINS.  Runs ServiceProcessor directly, without wsgi.
+"""
+from benchmarks import harness
+from pyservice import Service, processors
+
+PLUGINS = (0, 1, 2, 4, 8, 16)
+REQUEST_BODY = '{"key": "value"}'
+
+
+def make_service(count):
+    service = Service(operations=["foo"])
+    for _ in range(count):
+        @service.plugin(scope="request")
+        def request_plugin(context):
+            context.process_request()
+
+        @service.plugin(scope="operation")
+        def operation_plugin(request, response, context):
+            context.process_request()
+
+    @service.operation("foo")
+    def foo(request, response, context):
+        response.key = request.key
+    return service
+
+
+def run():
+    results = {}
+    for count in PLUGINS:
+        service = make_service(count)
+        results["plugins_{}".format(count)] = harness.measure(
+            lambda: processors.ServiceProcessor(
+                service, "foo", REQUEST_BODY)())
+    return results
+
+
+if __name__ == "__main__":
+    harness.report(run())
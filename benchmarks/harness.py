@@ -0,0 +1,79 @@
+"""
+Timing, result files and baseline comparison shared by the benchmarks.
+
+Results are a flat dict of "suite.case" -> microseconds per call, saved as:
+
+    {
+        "meta": {"python": "3.8.2", "platform": "...", "time": "..."},
+        "results": {"chain.plugins_0": 12.3, ...}
+    }
+"""
+import json
+import platform
+import time
+import timeit
+
+# Timing runs per case; the best is reported, since slower runs are noise
+# from the rest of the machine rather than the code being measured
+REPEAT = 5
+# Relative slowdown against the baseline reported as a regression
+TOLERANCE = 0.1
+
+
+def measure(func, repeat=REPEAT):
+    ''' Best wall time of func(), in microseconds '''
+    timer = timeit.Timer(func)
+    # Enough calls for a run to take at least 0.2 seconds
+    number, _ = timer.autorange()
+    return min(timer.repeat(number=number, repeat=repeat)) / number * 1e6
+
+
+def meta():
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+
+def save(path, results):
+    with open(path, "w") as file:
+        json.dump({"meta": meta(), "results": results}, file,
+                  indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def compare(results, baseline):
+    '''
+    Returns [(case, baseline, result, change)] for cases in both, where
+    change is the relative difference (0.25 is 25% slower).  Cases that
+    are only in one of them are skipped.
+    '''
+    rows = []
+    for case in results:
+        if case not in baseline:
+            continue
+        before, after = baseline[case], results[case]
+        rows.append((case, before, after, (after - before) / before))
+    return rows
+
+
+def regressions(rows, tolerance=TOLERANCE):
+    return [row for row in rows if row[3] > tolerance]
+
+
+def report(results, rows=None, tolerance=TOLERANCE):
+    ''' Print results, and their change against a baseline if given '''
+    if rows is None:
+        for case in results:
+            print("{:40} {:12.2f}us".format(case, results[case]))
+        return
+    for case, before, after, change in rows:
+        flag = "  REGRESSION" if change > tolerance else ""
+        print("{:40} {:12.2f}us {:12.2f}us {:+8.1%}{}".format(
+            case, before, after, change, flag))
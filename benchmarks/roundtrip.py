@@ -0,0 +1,70 @@
+"""
+Full Service.wsgi_application round trips from in-process environs.
+
+Covers routing, codec negotiation, reading the body, the processor chain
+and building the response - everything but the server and the socket.
+"""
+import io
+import ujson
+from benchmarks import harness
+from pyservice import Service, codecs
+
+SMALL = {"key": "value"}
+LARGE = {"items": [{"id": i, "name": "item {}".format(i)}
+                   for i in range(200)]}
+
+
+def make_service():
+    service = Service(operations=["echo"])
+
+    @service.plugin(scope="request")
+    def request_plugin(context):
+        context.process_request()
+
+    @service.plugin(scope="operation")
+    def operation_plugin(request, response, context):
+        context.process_request()
+
+    @service.operation("echo")
+    def echo(request, response, context):
+        response.update(request)
+    return service
+
+
+def start_response(status, headers):
+    pass
+
+
+def call(service, body, headers):
+    environ = dict(headers)
+    environ["PATH_INFO"] = "/api/echo"
+    environ["CONTENT_LENGTH"] = str(len(body))
+    stream = environ["wsgi.input"] = io.BytesIO(body)
+
+    def request():
+        stream.seek(0)
+        service.wsgi_application(environ, start_response)
+    return request
+
+
+def run():
+    service = make_service()
+    msgpack = {
+        "CONTENT_TYPE": codecs.MSGPACK_TYPE,
+        "HTTP_ACCEPT": codecs.MSGPACK_TYPE
+    }
+    gzip = {"HTTP_ACCEPT_ENCODING": "gzip"}
+    cases = {
+        "json_small": (ujson.dumps(SMALL).encode(), {}),
+        "json_large": (ujson.dumps(LARGE).encode(), {}),
+        "json_large_gzip": (ujson.dumps(LARGE).encode(), gzip),
+        "msgpack_small": (codecs.MSGPACK.serialize(SMALL), msgpack),
+        "msgpack_large": (codecs.MSGPACK.serialize(LARGE), msgpack),
+    }
+    return {
+        name: harness.measure(call(service, body, headers))
+        for name, (body, headers) in cases.items()}
+
+
+if __name__ == "__main__":
+    harness.report(run())
@@ -0,0 +1,26 @@
+"""
+wsgi.Request.operation by the number of operations in the api.
+
+Routing should cost the same regardless of how many operations a service
+exposes.  The last operation is routed, since it's the worst case for a
+linear scan.
+"""
+from benchmarks import harness
+from pyservice import Service, wsgi
+
+OPERATIONS = (1, 10, 100, 1000)
+
+
+def run():
+    results = {}
+    for count in OPERATIONS:
+        operations = ["operation_{}".format(i) for i in range(count)]
+        service = Service(operations=operations)
+        environ = {"PATH_INFO": "/api/{}".format(operations[-1])}
+        results["operations_{}".format(count)] = harness.measure(
+            lambda: wsgi.Request(service, environ).operation)
+    return results
+
+
+if __name__ == "__main__":
+    harness.report(run())
@@ -0,0 +1,34 @@
+"""
+common.serialize and common.deserialize by payload shape.
+"""
+from benchmarks import harness
+from pyservice import common
+
+PAYLOADS = {
+    "small": {"id": 12345, "name": "item", "active": True},
+    "flat": {"key_{}".format(i): i for i in range(100)},
+    "nested": {"level": {"level": {"level": {"level": {
+        "values": [1, 2, 3], "name": "leaf"}}}}},
+    "records": {"items": [
+        {"id": i, "name": "item {}".format(i), "price": i * 1.5,
+         "tags": ["a", "b"]} for i in range(100)]},
+    "numbers": {"values": list(range(1000))},
+    "floats": {"values": [i / 7 for i in range(1000)]},
+    "text": {"body": "lorem ipsum dolor sit amet " * 400},
+    "unicode": {"body": "ünicøde ☃ " * 400},
+}
+
+
+def run():
+    results = {}
+    for shape, payload in PAYLOADS.items():
+        string = common.serialize(payload)
+        results["serialize_{}".format(shape)] = harness.measure(
+            lambda: common.serialize(payload))
+        results["deserialize_{}".format(shape)] = harness.measure(
+            lambda: common.deserialize(string, common.Container()))
+    return results
+
+
+if __name__ == "__main__":
+    harness.report(run())
@@ -21,7 +21,8 @@ THE SOFTWARE.
 
 """
 
-from pyservice.client import Client
+from pyservice.client import AsyncClient, Client
+from pyservice.dispatch import Dispatcher
 from pyservice.service import Service
 
-__all__ = ["Client", "Service"]
+__all__ = ["AsyncClient", "Client", "Dispatcher", "Service"]
@@ -0,0 +1,229 @@
+"""
+ASGI counterparts to wsgi.Request and wsgi.Response.
+
+Status codes, routing failures and body limits are shared with the wsgi
+module, so a service behaves identically regardless of how it's served.
+"""
+import tempfile
+from . import compression
+from . import deadlines
+from . import timing
+from . import wsgi
+
+
+class Request(object):
+    """
+    Expose operation and body for a given request and service.
+
+    Tightly coupled to the implementation of pyservice.Service.  This is
+    chrome over the Service/ASGI boundary, especially loading the body
+    from the receive channel.
+    """
+    def __init__(self, service, scope, receive):
+        self.service = service
+        self.scope = scope
+        self.receive = receive
+        self._codecs = None
+        self._body = None
+
+    @property
+    def operation(self):
+        return wsgi.route(self.service, self.scope["path"])
+
+    @property
+    def codecs(self):
+        ''' (request codec, response codec), see wsgi.negotiate '''
+        if self._codecs is None:
+            self._codecs = wsgi.negotiate(
+                self.service.codecs,
+                header(self.scope, b"content-type"),
+                header(self.scope, b"accept"))
+        return self._codecs
+
+    @property
+    def encoding(self):
+        ''' The preferred response encoding named by Accept-Encoding '''
+        return compression.negotiate(header(self.scope, b"accept-encoding"))
+
+    @property
+    def deadline(self):
+        ''' Unix time the caller stops waiting, or None (see deadlines) '''
+        return deadlines.parse(header(self.scope, deadlines.SCOPE_HEADER))
+
+    async def body(self, max_size=wsgi.MEMFILE_MAX, stream=False):
+        '''
+        Read the request body from the receive channel.
+
+        ASGI servers decode chunked transfer encoding, so only the size
+        limit and Content-Encoding are handled here.  Returns a string, bytes
+        for binary codecs, or for streaming operations a binary file (see
+        wsgi.spool_body).
+        '''
+        clen = content_length(self.scope)
+        if clen > max_size:
+            raise wsgi.REQUEST_TOO_LARGE
+        try:
+            chunks = self.iter_chunks(max_size)
+            encoding = compression.encoding(
+                header(self.scope, b"content-encoding"))
+            if encoding is not None:
+                chunks = decompress(chunks, encoding, max_size)
+            return await self.load(chunks, stream)
+        except compression.SizeExceeded:
+            raise wsgi.REQUEST_TOO_LARGE
+        except compression.UnsupportedEncoding:
+            raise wsgi.UNSUPPORTED_MEDIA_TYPE
+        except compression.DecodeError:
+            raise wsgi.BAD_REQUEST
+
+    async def iter_chunks(self, max_size):
+        ''' Yields raw body chunks, enforcing max_size '''
+        size = 0
+        more_body = True
+        while more_body:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise wsgi.BAD_REQUEST
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > max_size:
+                raise wsgi.REQUEST_TOO_LARGE
+            yield chunk
+            more_body = message.get("more_body", False)
+
+    async def load(self, chunks, stream):
+        if stream:
+            self._body = body = tempfile.SpooledTemporaryFile(
+                max_size=wsgi.MEMFILE_MAX)
+        else:
+            body = []
+        async for chunk in chunks:
+            if stream:
+                body.write(chunk)
+            else:
+                body.append(chunk)
+        if stream:
+            body.seek(0)
+            return body
+        body = b"".join(body)
+        if self.codecs[0].binary:
+            return body
+        return body.decode("UTF-8")
+
+    def close(self):
+        ''' Release the spooled body of a streaming request '''
+        wsgi.close_body(self._body)
+
+
+class Response(object):
+    """
+    Same contract as wsgi.Response, except `send` is a coroutine that
+    writes the start and body messages to the ASGI send channel.
+    """
+    def __init__(self, send):
+        self.status = 500
+        self.content_type = None
+        self.compression = None
+        self.timings = None
+        self.body = ''
+        self._send = send
+
+    def exception(self, exc):
+        '''Set appropriate status and body for a RequestException'''
+        self.status = exc.status
+        self.body = ''
+
+    @wsgi.setter
+    def body(self, value):
+        '''
+        MUST be a unicode string, bytes, or an async iterator of unicode
+        lines for streaming operations.  MUST be empty for non-200 statuses
+        '''
+        if value:
+            self.status = 200
+        if isinstance(value, str):
+            value = value.encode('UTF-8')
+        self._encoding = None
+        if value and self.compression and isinstance(value, bytes):
+            value, self._encoding = compression.maybe_compress(
+                value, *self.compression)
+        self._body = value
+
+    async def send(self):
+        if isinstance(self._body, bytes):
+            headers = [(b"content-length", str(len(self._body)).encode())]
+            if self._body and self.content_type:
+                headers.append(
+                    (b"content-type", self.content_type.encode("latin-1")))
+            if self._encoding:
+                headers.append(
+                    (b"content-encoding", self._encoding.encode("latin-1")))
+            if self._body and self.compression:
+                headers.append((b"vary", b"Accept-Encoding"))
+            headers.extend(self.timing_headers())
+            await self._send({
+                "type": "http.response.start",
+                "status": self.status,
+                "headers": headers
+            })
+            await self._send({
+                "type": "http.response.body",
+                "body": self._body
+            })
+            return
+
+        await self._send({
+            "type": "http.response.start",
+            "status": self.status,
+            "headers": [
+                (b"content-type", wsgi.STREAMING_TYPE.encode())
+            ] + self.timing_headers()
+        })
+        async for line in self._body:
+            await self._send({
+                "type": "http.response.body",
+                "body": line.encode('UTF-8'),
+                "more_body": True
+            })
+        await self._send({"type": "http.response.body", "body": b""})
+
+    def timing_headers(self):
+        if not self.timings:
+            return []
+        value = timing.header(self.timings)
+        return [(b"server-timing", value.encode("latin-1"))]
+
+
+async def decompress(chunks, encoding, max_size):
+    ''' compression.iter_decompress for an async iterable of chunks '''
+    decompressor = compression.Decompressor(encoding, max_size)
+    async for chunk in chunks:
+        yield decompressor.feed(chunk)
+    yield decompressor.flush()
+
+
+def header(scope, name):
+    """ Returns the (decoded) value of a request header, or None """
+    for key, value in scope.get("headers", []):
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+def content_length(scope):
+    """ Returns the content length, or -1 if none is provided """
+    value = header(scope, b"content-length")
+    if value is None:
+        return -1
+    return int(value)
+
+
+async def lifespan(receive, send):
+    """ Acknowledge startup and shutdown; services hold no async state """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,148 @@
+"""
+Dynamic micro-batching for vectorizable operations.
+
+A Batcher wraps a function that takes lists of requests, responses and
+contexts, and exposes the regular operation signature:
+
+    batcher(request, response, context)
+
+Concurrent callers are collected into a batch.  The first caller into an
+empty batch becomes its leader: it waits until the batch is full or
+max_wait_ms has passed, then calls the function once for every request in
+the batch.  The other callers block until the leader finishes.  No
+background threads are used - batches only form when requests are being
+handled concurrently (ie. by a threaded wsgi server).
+
+Under asgi, coroutines are batched with `await batcher.call_async(...)`
+instead, which holds no thread while waiting.  The function may be a
+coroutine function, which is awaited on the event loop; otherwise each
+batch runs once on the given executor.
+"""
+import asyncio
+import inspect
+import threading
+import time
+
+
+class Batch(object):
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+        self.contexts = []
+        self.exception = None
+        self.done = threading.Event()
+
+    def __len__(self):
+        return len(self.requests)
+
+
+class AsyncBatch(Batch):
+    """ Batch for a single event loop; dispatched by its own task """
+    def __init__(self):
+        super().__init__()
+        self.full = asyncio.Event()
+        self.done = asyncio.Event()
+        self.task = None
+
+
+class Batcher(object):
+    def __init__(self, func, max_batch, max_wait_ms):
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        self.func = func
+        self.coroutine = inspect.iscoroutinefunction(func)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.lock = threading.Lock()
+        self.closed = threading.Condition(self.lock)
+        # The batch that's still accepting requests, if any
+        self.pending = None
+        # Same, for call_async.  Only touched from the event loop
+        self.pending_async = None
+
+    def __call__(self, request, response, context):
+        with self.lock:
+            batch = self.pending
+            leader = batch is None
+            if leader:
+                batch = self.pending = Batch()
+            batch.requests.append(request)
+            batch.responses.append(response)
+            batch.contexts.append(context)
+
+            if len(batch) >= self.max_batch:
+                self.pending = None
+                self.closed.notify_all()
+            elif leader:
+                self.wait(batch)
+
+        if leader:
+            self.execute(batch)
+        else:
+            batch.done.wait()
+        if batch.exception is not None:
+            raise batch.exception
+
+    def wait(self, batch):
+        ''' Called by the leader (with the lock held) to fill the batch '''
+        deadline = time.monotonic() + self.max_wait
+        while self.pending is batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.pending = None
+                break
+            self.closed.wait(remaining)
+
+    def execute(self, batch):
+        try:
+            if self.coroutine:
+                raise TypeError(
+                    "Coroutine batch functions must be called with call_async")
+            self.func(batch.requests, batch.responses, batch.contexts)
+        except Exception as exception:
+            # Every request in the batch fails with the same exception
+            batch.exception = exception
+        finally:
+            batch.done.set()
+
+    async def call_async(self, request, response, context, executor=None):
+        '''
+        Join the pending batch and wait for it to finish.  Batches are
+        dispatched by their own task, so a cancelled caller doesn't strand
+        the rest of its batch.
+        '''
+        batch = self.pending_async
+        if batch is None:
+            batch = self.pending_async = AsyncBatch()
+            batch.task = asyncio.ensure_future(
+                self.dispatch(batch, executor))
+        batch.requests.append(request)
+        batch.responses.append(response)
+        batch.contexts.append(context)
+        if len(batch) >= self.max_batch:
+            self.pending_async = None
+            batch.full.set()
+
+        await batch.done.wait()
+        if batch.exception is not None:
+            raise batch.exception
+
+    async def dispatch(self, batch, executor):
+        ''' Wait for the batch to fill (or max_wait), then execute it '''
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        if self.pending_async is batch:
+            self.pending_async = None
+        try:
+            args = (batch.requests, batch.responses, batch.contexts)
+            if self.coroutine:
+                await self.func(*args)
+            else:
+                await asyncio.get_running_loop().run_in_executor(
+                    executor, self.func, *args)
+        except Exception as exception:
+            batch.exception = exception
+        finally:
+            batch.done.set()
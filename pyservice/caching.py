@@ -0,0 +1,425 @@
+"""
+Response caching for service operations.
+
+    service.operation("get_item", cache=Cache(max_size=1000, ttl=30))
+
+Entries are keyed on the canonical form of the request (see canonical_key)
+and the response content type, and store the serialized response body.
+A hit skips the operation's plugins, the function and serialization;
+request-scoped plugins (ie. authentication) still run for every request.
+
+Clients can memoize operations with the same Cache (see Memo), which also
+coalesces concurrent identical calls into a single request.
+
+Pre-forked workers (see pyservice.runner) can share one SharedCache instead
+of each filling their own.
+"""
+import asyncio
+import collections
+import hashlib
+import math
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+import ujson
+from . import common
+
+
+class Cache(object):
+    """
+    Thread-safe LRU cache with an optional TTL (seconds).
+
+    max_size bounds the number of entries, and max_bytes (if given) the
+    total size of the stored bodies.  The least recently used entries are
+    evicted first; expired entries are dropped when they're next read.
+    """
+    def __init__(self, max_size=1024, ttl=None, max_bytes=None,
+                 clock=time.monotonic):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> (expires, value)
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock() + self.ttl
+        size = len(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would evict everything else and still not fit
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (expires, value)
+            self.bytes += size
+            while len(self.entries) > self.max_size or (
+                    self.max_bytes is not None and
+                    self.bytes > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        ''' Called with the lock held '''
+        _, value = self.entries.pop(key)
+        self.bytes -= len(value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries),
+            "bytes": self.bytes
+        }
+
+
+class SharedCache(object):
+    """
+    Cache in shared memory, for every process forked after it's created.
+
+    The memory is split into slots of slot_size bytes, which hold a key, its
+    value and a 40 byte header.  Values must be str or bytes, and entries
+    that don't fit in a slot aren't stored.  Keys are str, bytes, or tuples
+    of str (like canonical_key).
+
+    Each key can only live in one set of `ways` slots, picked by its hash;
+    when they're full the least recently read one is evicted.  Reads take
+    no locks: a slot's sequence number is odd while it's being written, and
+    a read that sees it change is retried.  Writes lock one of `locks`
+    stripes.  hits, misses and evictions are counted per process.
+    """
+    # sequence, hash, expires, last read, key length, value length, kind
+    HEADER = struct.Struct("<QQddHIBx")
+    SEQUENCE = struct.Struct("<Q")
+    LAST_READ = struct.Struct("<d")
+    # Offsets of the last read time and kind in HEADER
+    LAST_READ_OFFSET = 24
+    KIND_OFFSET = 38
+    # Slot kinds
+    EMPTY, BYTES, STR = 0, 1, 2
+    # Reads that keep seeing a slot change count as a miss
+    RETRIES = 8
+
+    def __init__(self, slots=4096, slot_size=4096, ttl=None, ways=8,
+                 locks=16, clock=time.monotonic):
+        if slot_size <= self.HEADER.size:
+            raise ValueError("slot_size must be more than {}".format(
+                self.HEADER.size))
+        self.ways = max(1, min(ways, slots))
+        self.sets = max(1, slots // self.ways)
+        self.slots = self.sets * self.ways
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.clock = clock
+        # Anonymous shared mappings are inherited by forked processes
+        self.memory = mmap.mmap(-1, self.slots * slot_size)
+        self.locks = [multiprocessing.Lock() for _ in range(locks)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        kinds = self.memory[self.KIND_OFFSET::self.slot_size]
+        return len(kinds) - kinds.count(self.EMPTY)
+
+    def get(self, key, default=None):
+        key = shared_key(key)
+        digest = key_hash(key)
+        start = (digest % self.sets) * self.ways
+        for slot in range(start, start + self.ways):
+            value = self.read(slot * self.slot_size, key, digest)
+            if value is not None:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return default
+
+    def read(self, offset, key, digest):
+        ''' The slot's value, if it holds key and hasn't expired '''
+        memory = self.memory
+        for _ in range(self.RETRIES):
+            sequence, found, expires, _, key_size, value_size, kind = \
+                self.HEADER.unpack_from(memory, offset)
+            if sequence & 1:
+                continue
+            if kind == self.EMPTY or found != digest:
+                return None
+            start = offset + self.HEADER.size
+            data = memory[start:start + key_size + value_size]
+            if self.SEQUENCE.unpack_from(memory, offset)[0] != sequence:
+                continue
+            if data[:key_size] != key or expires <= self.clock():
+                return None
+            # Racing another read (or a write) to this only loses a little
+            # recency, so it isn't locked
+            self.LAST_READ.pack_into(
+                memory, offset + self.LAST_READ_OFFSET, self.clock())
+            value = data[key_size:]
+            return value.decode("UTF-8") if kind == self.STR else value
+        return None
+
+    def set(self, key, value):
+        key = shared_key(key)
+        kind = self.BYTES
+        if isinstance(value, str):
+            kind, value = self.STR, value.encode("UTF-8")
+        if self.HEADER.size + len(key) + len(value) > self.slot_size:
+            return
+        digest = key_hash(key)
+        now = self.clock()
+        expires = math.inf if self.ttl is None else now + self.ttl
+        index = digest % self.sets
+        with self.locks[index % len(self.locks)]:
+            offset, evicted = self.find(index * self.ways, key, digest, now)
+            if evicted:
+                self.evictions += 1
+            self.write(offset, self.HEADER.pack(
+                0, digest, expires, now, len(key), len(value), kind) +
+                key + value)
+
+    def find(self, start, key, digest, now):
+        '''
+        Returns (offset, evicted) of the slot to store key in: the one it's
+        already in, else an empty or expired one, else the least recently
+        read.  Called with the set's lock held.
+        '''
+        memory = self.memory
+        free = oldest = None
+        for slot in range(start, start + self.ways):
+            offset = slot * self.slot_size
+            _, found, expires, last_read, key_size, _, kind = \
+                self.HEADER.unpack_from(memory, offset)
+            if kind == self.EMPTY or expires <= now:
+                if free is None:
+                    free = offset
+                continue
+            if found == digest:
+                data_start = offset + self.HEADER.size
+                if memory[data_start:data_start + key_size] == key:
+                    return offset, False
+            if oldest is None or last_read < oldest[1]:
+                oldest = (offset, last_read)
+        if free is not None:
+            return free, False
+        return oldest[0], True
+
+    def write(self, offset, data):
+        ''' Called with the slot's lock held '''
+        memory = self.memory
+        sequence = self.SEQUENCE.unpack_from(memory, offset)[0]
+        self.SEQUENCE.pack_into(memory, offset, sequence + 1)
+        memory[offset + 8:offset + len(data)] = data[8:]
+        self.SEQUENCE.pack_into(memory, offset, sequence + 2)
+
+    def clear(self):
+        empty = self.HEADER.pack(0, 0, 0, 0, 0, 0, self.EMPTY)
+        for index in range(self.sets):
+            with self.locks[index % len(self.locks)]:
+                for slot in range(index * self.ways, (index + 1) * self.ways):
+                    self.write(slot * self.slot_size, empty)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self)
+        }
+
+    def close(self):
+        self.memory.close()
+
+
+def shared_key(key):
+    if isinstance(key, bytes):
+        return key
+    if isinstance(key, tuple):
+        key = "\x00".join(key)
+    return key.encode("UTF-8")
+
+
+def key_hash(key):
+    ''' Stable across processes, unlike hash() '''
+    return int.from_bytes(
+        hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def canonical_key(request, content_type):
+    '''
+    Returns a key that's identical for equal requests, regardless of key
+    order, whitespace or the codec they were sent in.  Returns None when
+    the request can't be canonicalized (ie. it contains bytes), in which
+    case it isn't cached.
+    '''
+    key = request_key(request)
+    if key is None:
+        return None
+    return content_type, key
+
+
+def request_key(request):
+    ''' Sorted JSON for a request, or None if it isn't serializable '''
+    try:
+        return ujson.dumps(request, sort_keys=True)
+    except (TypeError, OverflowError):
+        return None
+
+
+def dump_response(response):
+    ''' JSON for a memoized response, or None if it isn't serializable '''
+    try:
+        return common.serialize(response)
+    except (TypeError, OverflowError):
+        return None
+
+
+def load_response(body):
+    ''' A new Container for every hit, so callers can't change the cache '''
+    response = common.Container()
+    common.deserialize(body, response)
+    return response
+
+
+class Call(object):
+    """ A request in flight, shared by concurrent identical calls """
+    def __init__(self, done):
+        # threading.Event, or an asyncio.Future for AsyncMemo
+        self.done = done
+        # Serialized response, see dump_response
+        self.body = None
+        self.exception = None
+
+
+class Memo(object):
+    """
+    Client-side memoization of a single operation.
+
+    Responses are stored in cache serialized (so max_bytes counts their
+    JSON length), and every hit decodes a fresh copy without a round trip
+    until they expire.  Concurrent identical calls that miss the cache wait
+    for the first one's response instead of sending their own requests
+    (singleflight).  Exceptions are never cached, but are raised in every
+    waiting call.  Responses that can't be serialized as JSON (ie. they
+    hold bytes, or are streamed) aren't cached or shared.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        # Calls in flight by request key
+        self.calls = {}
+
+    def __call__(self, request, process):
+        key = request_key(request)
+        if key is None:
+            return process()
+        body = self.cache.get(key)
+        if body is not None:
+            return load_response(body)
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call(threading.Event())
+        if not leader:
+            call.done.wait()
+            return self.shared(call, process)
+
+        try:
+            response = process()
+            self.store(key, call, response)
+        except Exception as exception:
+            call.exception = exception
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return response
+
+    def store(self, key, call, response):
+        '''
+        Cache the response before the call is removed, so there's no window
+        where an identical call finds neither
+        '''
+        if isinstance(response, dict):
+            call.body = dump_response(response)
+            if call.body is not None:
+                self.cache.set(key, call.body)
+
+    def shared(self, call, process):
+        ''' The result of a call made by another caller '''
+        if call.exception is not None:
+            raise call.exception
+        if call.body is None:
+            # Streamed records can only be iterated once, make our own call
+            return process()
+        return load_response(call.body)
+
+
+class AsyncMemo(Memo):
+    """ Memo for AsyncClient, where process returns a coroutine """
+    async def __call__(self, request, process):
+        key = request_key(request)
+        if key is None:
+            return await process()
+        body = self.cache.get(key)
+        if body is not None:
+            return load_response(body)
+
+        call = self.calls.get(key)
+        if call is not None:
+            # Shielded so a cancelled waiter doesn't cancel the others
+            await asyncio.shield(call.done)
+            if isinstance(call.exception, asyncio.CancelledError):
+                # The first caller was cancelled, not the request
+                return await process()
+            if call.exception is None and call.body is None:
+                return await process()
+            return self.shared(call, process)
+
+        call = self.calls[key] = Call(
+            asyncio.get_running_loop().create_future())
+        try:
+            response = await process()
+            self.store(key, call, response)
+        except BaseException as exception:
+            call.exception = exception
+            raise
+        finally:
+            del self.calls[key]
+            call.done.set_result(None)
+        return response
@@ -0,0 +1,184 @@
+"""
+Sample live requests to a log that can be replayed against another build
+(see pyservice.replay).
+
+    service.plugin("request", func=Capture("/var/log/app/capture", 0.01))
+
+Register it before any other plugins, so the duration it records covers
+them too.  Async services use AsyncCapture.
+
+Each sampled request is appended as one record, a fixed header:
+
+    timestamp (float64, time.time() when the request started)
+    duration (float32, seconds the rest of the chain took)
+    content type length (uint8), operation length (uint16),
+    body length (uint32)
+
+followed by the content type, operation and raw (still serialized) request
+body.  Every file starts with MAGIC.  When a record would grow the file past
+max_bytes, the file is renamed to path.1 (path.1 to path.2, and so on up to
+backups) and a new one is started.
+
+Only requests with a serialized body are captured: streamed requests are
+left for the operation to read, and batches are skipped.
+"""
+import collections
+import os
+import random
+import struct
+import threading
+import time
+
+MAGIC = b"PYSERVICE-CAPTURE\x01"
+HEADER = struct.Struct("<dfBHI")
+
+Record = collections.namedtuple(
+    "Record", ["timestamp", "duration", "operation", "content_type", "body"])
+
+
+class Log(object):
+    """ Append-only record file, rotated by size.  Safe across threads """
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backups=4):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+
+    def append(self, record):
+        timestamp, duration, operation, content_type, body = record
+        operation = operation.encode("UTF-8")
+        content_type = content_type.encode("UTF-8")
+        data = b"".join((
+            HEADER.pack(timestamp, duration, len(content_type),
+                        len(operation), len(body)),
+            content_type, operation, body))
+        with self.lock:
+            if self.file is None:
+                self.open()
+            elif (self.size + len(data) > self.max_bytes and
+                  self.size > len(MAGIC)):
+                self.rotate()
+            # Unbuffered, so each record is a single write
+            self.file.write(data)
+            self.size += len(data)
+
+    def open(self):
+        self.file = open(self.path, "ab", buffering=0)
+        self.size = self.file.seek(0, os.SEEK_END)
+        if not self.size:
+            self.file.write(MAGIC)
+            self.size = len(MAGIC)
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = "{}.{}".format(self.path, index)
+            if os.path.exists(source):
+                os.replace(source, "{}.{}".format(self.path, index + 1))
+        if self.backups:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class Capture(object):
+    """
+    Request scoped plugin that logs a sample of requests.  sample is the
+    fraction of requests captured; max_bytes and backups are passed to Log.
+    """
+    def __init__(self, path, sample=0.01, max_bytes=64 * 1024 * 1024,
+                 backups=4):
+        self.log = Log(path, max_bytes, backups)
+        self.sample = sample
+        self.random = random.random
+
+    def __call__(self, context):
+        body = self.sampled(context)
+        if body is None:
+            context.process_request()
+            return
+        timestamp, start = time.time(), time.perf_counter()
+        try:
+            context.process_request()
+        finally:
+            self.write(context, timestamp, start, body)
+
+    def sampled(self, context):
+        ''' The raw request body, when this request should be captured '''
+        if self.random() >= self.sample:
+            return None
+        body = context.__process__.request_body
+        if isinstance(body, str):
+            return body.encode("UTF-8")
+        # Streamed bodies are files, batch entries are already containers
+        return body if isinstance(body, bytes) else None
+
+    def write(self, context, timestamp, start, body):
+        self.log.append(Record(
+            timestamp, time.perf_counter() - start, context.operation,
+            context.__process__.request_codec.content_type, body))
+
+    def close(self):
+        self.log.close()
+
+
+class AsyncCapture(Capture):
+    """ Capture for async services """
+    async def __call__(self, context):
+        body = self.sampled(context)
+        if body is None:
+            await context.process_request()
+            return
+        timestamp, start = time.time(), time.perf_counter()
+        try:
+            await context.process_request()
+        finally:
+            self.write(context, timestamp, start, body)
+
+
+def files(path):
+    ''' The log at path and its rotated backups that exist, oldest first '''
+    paths = []
+    index = 1
+    while os.path.exists("{}.{}".format(path, index)):
+        paths.append("{}.{}".format(path, index))
+        index += 1
+    paths.reverse()
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def read(*paths):
+    '''
+    Yields each Record in the given files, in order.  A record cut short
+    (ie. the process died mid-write) ends its file.
+    '''
+    for path in paths:
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a capture log".format(path))
+            while True:
+                header = file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                timestamp, duration, *lengths = HEADER.unpack(header)
+                data = file.read(sum(lengths))
+                if len(data) < sum(lengths):
+                    break
+                content_type, operation = lengths[0], lengths[1]
+                yield Record(
+                    timestamp, duration,
+                    data[content_type:content_type + operation].decode(
+                        "UTF-8"),
+                    data[:content_type].decode("UTF-8"),
+                    data[content_type + operation:])
@@ -1,6 +1,101 @@
 import functools
+from . import caching
+from . import codecs
 from . import common
+from . import compression
+from . import metrics
 from . import processors
+from . import transport
+
+
+class BatchResult(object):
+    """
+    Placeholder for the result of a single operation in a batch.
+
+    `result()` returns the response Container, or raises the entry's
+    exception.  Only available once the batch has been executed.
+    """
+    def __init__(self, operation, request):
+        self.operation = operation
+        self.request = request
+        self.response = None
+        self.exception = None
+        self.done = False
+
+    def result(self):
+        if not self.done:
+            raise RuntimeError("Batch has not been executed")
+        if self.exception:
+            raise self.exception
+        return self.response
+
+
+class Batch(object):
+    def __init__(self, client, parallel):
+        self.client = client
+        self.parallel = parallel
+        self.entries = []
+
+    def __getattr__(self, operation):
+        if operation not in self.client.api["operations"]:
+            raise ValueError("Unknown operation '{}'".format(operation))
+        return functools.partial(self.add, operation)
+
+    def add(self, operation, **request):
+        entry = BatchResult(operation, request)
+        self.entries.append(entry)
+        return entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def pack(self):
+        return {
+            "operations": [
+                {"operation": entry.operation, "request": entry.request}
+                for entry in self.entries],
+            "parallel": self.parallel
+        }
+
+    def unpack(self, response):
+        for entry, result in zip(self.entries, response["results"]):
+            exception = result.get("__exception__", None)
+            if exception:
+                cls = getattr(self.client.exceptions, exception["cls"])
+                entry.exception = cls(*exception["args"])
+            else:
+                entry.response = common.Container(result)
+            entry.done = True
+        return self.entries
+
+    def execute(self):
+        ''' Send every entry in one request.  Returns the BatchResults '''
+        response = self.client(common.BATCH_OPERATION, **self.pack())
+        return self.unpack(response)
+
+
+class AsyncBatch(Batch):
+    """
+    Batch for an AsyncClient:
+
+        async with client.batch() as batch:
+            first = batch.get_item(id=1)
+        item = first.result()
+    """
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.execute()
+
+    async def execute(self):
+        response = await self.client(common.BATCH_OPERATION, **self.pack())
+        return self.unpack(response)
 
 
 class Client(object):
@@ -9,6 +104,27 @@ class Client(object):
     #   response = __process__(client, operation, request)
     __process__ = processors.client
 
+    # Factory for the transport used to reach the service.  The transport
+    # is shared by every call on this client, and can be replaced with any
+    # object that implements transport.Transport:
+    #   client.transport = PooledTransport(pool_size=50, max_connections=50)
+    __transport__ = transport.PooledTransport
+
+    # Builder returned from Client.batch
+    __batch__ = Batch
+
+    # Codecs the client understands, by content type.  Requests are sent
+    # with the first unless client.codec is changed:
+    #   client.codec = client.codecs["application/x-msgpack"]
+    __codecs__ = (codecs.JSON, codecs.MSGPACK)
+
+    # Wraps operations memoized with Client.cache
+    __memo__ = caching.Memo
+
+    # Registry that every call is recorded in, see metrics.Metrics.
+    # None disables metrics.  Memoized responses aren't recorded.
+    __metrics__ = metrics.Metrics
+
     def __init__(self, **api):
         self.api = api
         common.load_defaults(api)
@@ -19,7 +135,15 @@ class Client(object):
             "request": [],
             "operation": []
         }
+        # Compiled plugin chains by processor class, see Processor.compile
+        self.chains = {}
         self.exceptions = common.ExceptionFactory()
+        self.transport = self.__transport__()
+        self.codecs = {codec.content_type: codec for codec in self.__codecs__}
+        self.codec = self.__codecs__[0]
+        # Memoized operations, see Client.cache
+        self.memos = {}
+        self.metrics = self.__metrics__ and self.__metrics__()
 
     def __getattr__(self, operation):
         if operation not in self.api["operations"]:
@@ -30,15 +154,91 @@ class Client(object):
         setattr(self, operation, func)
         return func
 
+    @property
+    def codec(self):
+        return self._codec
+
+    @codec.setter
+    def codec(self, codec):
+        ''' Requests are sent, and responses accepted, in this codec '''
+        self._codec = codec
+        self.headers = {
+            "Content-Type": codec.content_type,
+            "Accept": codec.content_type
+        }
+        if self.api["compress_min_size"] is not None:
+            self.headers["Accept-Encoding"] = compression.ACCEPT_ENCODING
+
     def plugin(self, scope, *, func=None):
+        '''
+        Register a plugin.  Plugins should only be added through this
+        method, so that compiled chains are rebuilt.
+        '''
         if scope not in ["request", "operation"]:
             raise ValueError("Unknown scope {}".format(scope))
         # Return decorator that takes function
         if not func:
             return lambda func: self.plugin(scope=scope, func=func)
         self.plugins[scope].append(func)
+        self.chains.clear()
         return func
 
+    def chain(self, processor):
+        ''' Returns the compiled plugin chain for a processor class '''
+        chain = self.chains.get(processor)
+        if chain is None:
+            chain = self.chains[processor] = processor.compile(self.plugins)
+        return chain
+
     def __call__(self, operation, **request):
         '''Entry point for remote calls'''
-        return self.__process__(operation, request)
+        memo = self.memos.get(operation)
+        if memo is None:
+            return self.__process__(operation, request)
+        return memo(request, functools.partial(
+            self.__process__, operation, request))
+
+    def cache(self, operation, cache):
+        '''
+        Memoize an operation's responses in a caching.Cache:
+
+            client.cache("get_config", Cache(max_size=100, ttl=10))
+
+        Identical calls return a copy of the cached response without a
+        round trip until it expires, and concurrent identical calls share
+        a single request.  Client plugins don't run for cached responses.
+        '''
+        if operation not in self.api["operations"]:
+            raise ValueError("Unknown operation '{}'".format(operation))
+        self.memos[operation] = self.__memo__(cache)
+        return cache
+
+    def batch(self, *, parallel=False):
+        '''
+        Collect many operations into a single round trip.
+
+        with client.batch() as batch:
+            first = batch.get_item(id=1)
+            second = batch.get_item(id=2)
+        item = first.result()
+
+        Each entry runs through the service's plugins independently; when
+        parallel is True the service may run entries concurrently.
+        '''
+        return self.__batch__(self, parallel)
+
+
+class AsyncClient(Client):
+    """
+    asyncio counterpart to Client.  Operations return coroutines:
+
+        response = await client.foo(key="value")
+
+    Plugins must be coroutine functions, and continue the request with
+    `await context.process_request()`.  Connections are pooled per endpoint
+    and shared by every call on the client's event loop.
+    """
+    __process__ = processors.async_client
+    __transport__ = transport.AsyncPooledTransport
+    __batch__ = AsyncBatch
+    __memo__ = caching.AsyncMemo
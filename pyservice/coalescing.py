@@ -0,0 +1,95 @@
+"""
+Coalescing of identical concurrent requests.
+
+    service.operation("expensive", coalesce=True)
+
+The first request for a key leads a Flight and runs the operation; identical
+requests that arrive while it's running wait for its serialized response
+instead of running the operation again.  Flights are dropped as soon as
+they finish, so (unlike caching) nothing is retained between requests.
+
+Waiting requests don't outlive their own deadline (they're answered with a
+504 when it passes), and without one stop waiting after api["timeout"] and
+run the operation themselves, so a stuck leader can't hold them forever.
+"""
+import asyncio
+import threading
+
+
+class Flight(object):
+    """
+    An operation in progress.  Waiters can block (wait) or await
+    (wait_async), so a flight can be shared across threads and event loops.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.body = None
+        self.exception = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        # (loop, future) for each coroutine waiting on the flight
+        self.waiters = []
+
+    def finish(self, body=None, exception=None):
+        '''
+        body is the serialized response.  When neither a body nor an
+        exception is given, waiters process their own requests.
+        '''
+        with self.lock:
+            self.body = body
+            self.exception = exception
+            self.event.set()
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(resolve, future)
+
+    def wait(self, timeout=None):
+        ''' Returns False if the flight didn't finish within timeout '''
+        return self.event.wait(timeout)
+
+    async def wait_async(self, timeout=None):
+        ''' See wait '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if self.event.is_set():
+                return True
+            self.waiters.append((loop, future))
+        # Shielded so a cancelled waiter doesn't cancel the others
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                if (loop, future) in self.waiters:
+                    self.waiters.remove((loop, future))
+            return False
+        return True
+
+
+def resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Coalescer(object):
+    """ Flights in progress for a single operation, by request key """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def __len__(self):
+        return len(self.flights)
+
+    def join(self, key):
+        ''' Returns (flight, leader) - the leader must call finish '''
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.flights[key] = Flight(key)
+            return flight, True
+
+    def finish(self, flight, body=None, exception=None):
+        with self.lock:
+            del self.flights[flight.key]
+        flight.finish(body, exception)
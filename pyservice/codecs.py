@@ -0,0 +1,287 @@
+"""
+Codecs turn request and response containers into bodies on the wire.
+
+A codec exposes:
+
+    content_type  - media type sent in Content-Type/Accept headers
+    binary        - True when bodies are bytes instead of unicode strings
+    serialize(container) -> body
+    deserialize(body, container)
+
+Services and clients keep a dict of codecs by content type, which can be
+extended with any object that implements the interface above:
+
+    service.codecs[codec.content_type] = codec
+"""
+import functools
+import struct
+import ujson
+try:
+    # Optional C implementation, used for MsgPackCodec when installed
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/x-msgpack"
+
+
+class Codec(object):
+    content_type = None
+    binary = False
+
+    def serialize(self, container):  # pragma: no cover
+        raise NotImplementedError("Subclasses must implement serialize.")
+
+    def deserialize(self, body, container):  # pragma: no cover
+        raise NotImplementedError("Subclasses must implement deserialize.")
+
+
+class JSONCodec(Codec):
+    content_type = JSON_TYPE
+
+    def serialize(self, container):
+        return ujson.dumps(container)
+
+    def deserialize(self, body, container):
+        container.update(ujson.loads(body))
+
+
+class MsgPackCodec(Codec):
+    """
+    MessagePack (https://msgpack.org) without extension types.
+
+    Small integers, short strings and small maps and arrays are encoded in
+    a single byte, so payloads of numbers and repeated keys are a fraction
+    of their JSON size.
+
+    The pure python pack/unpack below are used unless the msgpack package
+    is installed, which is several times faster.
+    """
+    content_type = MSGPACK_TYPE
+    binary = True
+
+    def __init__(self, pack=None, unpack=None):
+        self.pack = pack or default_pack()
+        self.unpack = unpack or default_unpack()
+
+    def serialize(self, container):
+        return self.pack(container)
+
+    def deserialize(self, body, container):
+        value = self.unpack(body)
+        if not isinstance(value, dict):
+            raise ValueError("Body must be a map")
+        container.update(value)
+
+
+def default_pack():
+    if msgpack is None:  # pragma: no cover
+        return pack
+    # Packer instances aren't thread safe, packb creates one per call
+    return functools.partial(msgpack.packb, use_bin_type=True)
+
+
+def default_unpack():
+    if msgpack is None:  # pragma: no cover
+        return unpack
+
+    def unpack_c(data):
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except (msgpack.UnpackException, ValueError, TypeError) as exception:
+            raise ValueError("Malformed msgpack: {}".format(exception))
+    return unpack_c
+
+
+def pack(value):
+    ''' Returns the MessagePack encoding of value '''
+    parts = []
+    _pack(value, parts.append)
+    return b"".join(parts)
+
+
+def _pack(value, write, pack_into=struct.pack):
+    # Exact type checks first - they're the common case and cheaper than
+    # walking isinstance for every value in a large payload
+    cls = type(value)
+    if cls is str:
+        data = value.encode("UTF-8")
+        size = len(data)
+        if size < 32:
+            write(bytes((0xa0 | size,)))
+        elif size < 0x100:
+            write(bytes((0xd9, size)))
+        elif size < 0x10000:
+            write(pack_into(">BH", 0xda, size))
+        else:
+            write(pack_into(">BI", 0xdb, size))
+        write(data)
+    elif cls is int:
+        if 0 <= value < 0x80:
+            write(bytes((value,)))
+        elif -32 <= value < 0:
+            write(bytes((value & 0xff,)))
+        elif 0 <= value < 0x100:
+            write(bytes((0xcc, value)))
+        elif 0 <= value < 0x10000:
+            write(pack_into(">BH", 0xcd, value))
+        elif 0 <= value < 0x100000000:
+            write(pack_into(">BI", 0xce, value))
+        elif 0 <= value < 0x10000000000000000:
+            write(pack_into(">BQ", 0xcf, value))
+        elif value > 0:
+            raise OverflowError("Integer out of range: {}".format(value))
+        elif -0x80 <= value:
+            write(pack_into(">Bb", 0xd0, value))
+        elif -0x8000 <= value:
+            write(pack_into(">Bh", 0xd1, value))
+        elif -0x80000000 <= value:
+            write(pack_into(">Bi", 0xd2, value))
+        elif -0x8000000000000000 <= value:
+            write(pack_into(">Bq", 0xd3, value))
+        else:
+            raise OverflowError("Integer out of range: {}".format(value))
+    elif cls is float:
+        write(pack_into(">Bd", 0xcb, value))
+    elif value is None:
+        write(b"\xc0")
+    elif cls is bool:
+        write(b"\xc3" if value else b"\xc2")
+    elif isinstance(value, dict):
+        size = len(value)
+        if size < 16:
+            write(bytes((0x80 | size,)))
+        elif size < 0x10000:
+            write(pack_into(">BH", 0xde, size))
+        else:
+            write(pack_into(">BI", 0xdf, size))
+        for key, item in value.items():
+            _pack(key, write)
+            _pack(item, write)
+    elif isinstance(value, (list, tuple)):
+        size = len(value)
+        if size < 16:
+            write(bytes((0x90 | size,)))
+        elif size < 0x10000:
+            write(pack_into(">BH", 0xdc, size))
+        else:
+            write(pack_into(">BI", 0xdd, size))
+        for item in value:
+            _pack(item, write)
+    elif isinstance(value, (bytes, bytearray)):
+        size = len(value)
+        if size < 0x100:
+            write(bytes((0xc4, size)))
+        elif size < 0x10000:
+            write(pack_into(">BH", 0xc5, size))
+        else:
+            write(pack_into(">BI", 0xc6, size))
+        write(bytes(value))
+    elif isinstance(value, int):
+        _pack(int(value), write)
+    elif isinstance(value, float):
+        _pack(float(value), write)
+    elif isinstance(value, str):
+        _pack(str(value), write)
+    else:
+        raise TypeError("Can't serialize {!r}".format(value))
+
+
+# (struct format, size) for fixed-width values, by type byte
+_FIXED = {
+    0xca: (">f", 4), 0xcb: (">d", 8),
+    0xcc: (">B", 1), 0xcd: (">H", 2), 0xce: (">I", 4), 0xcf: (">Q", 8),
+    0xd0: (">b", 1), 0xd1: (">h", 2), 0xd2: (">i", 4), 0xd3: (">q", 8)
+}
+# Width of the length prefix for str, bin, array and map, by type byte
+_LENGTH = {
+    0xd9: (">B", 1), 0xda: (">H", 2), 0xdb: (">I", 4),
+    0xc4: (">B", 1), 0xc5: (">H", 2), 0xc6: (">I", 4),
+    0xdc: (">H", 2), 0xdd: (">I", 4),
+    0xde: (">H", 2), 0xdf: (">I", 4)
+}
+_STR = {0xd9, 0xda, 0xdb}
+_BIN = {0xc4, 0xc5, 0xc6}
+_ARRAY = {0xdc, 0xdd}
+
+
+def unpack(data):
+    ''' Returns the value encoded in data; raises ValueError if malformed '''
+    try:
+        value, offset = _unpack(data, 0)
+    except (IndexError, struct.error, UnicodeDecodeError,
+            RecursionError, TypeError) as exception:
+        raise ValueError("Malformed msgpack: {}".format(exception))
+    if offset != len(data):
+        raise ValueError("Malformed msgpack: trailing data")
+    return value
+
+
+def _unpack(data, offset, unpack_from=struct.unpack_from):
+    code = data[offset]
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    if code >= 0xe0:
+        return code - 0x100, offset
+    if code & 0xe0 == 0xa0:
+        end = offset + (code & 0x1f)
+        if end > len(data):
+            raise IndexError("str out of range")
+        return data[offset:end].decode("UTF-8"), end
+    if code & 0xf0 == 0x90:
+        return _unpack_array(data, offset, code & 0x0f)
+    if code & 0xf0 == 0x80:
+        return _unpack_map(data, offset, code & 0x0f)
+    if code == 0xc0:
+        return None, offset
+    if code == 0xc2:
+        return False, offset
+    if code == 0xc3:
+        return True, offset
+
+    fixed = _FIXED.get(code)
+    if fixed is not None:
+        fmt, width = fixed
+        return unpack_from(fmt, data, offset)[0], offset + width
+
+    length = _LENGTH.get(code)
+    if length is None:
+        raise TypeError("Unsupported type byte {:#x}".format(code))
+    fmt, width = length
+    size = unpack_from(fmt, data, offset)[0]
+    offset += width
+    if code in _STR or code in _BIN:
+        end = offset + size
+        if end > len(data):
+            raise IndexError("str out of range")
+        value = data[offset:end]
+        if code in _STR:
+            return bytes(value).decode("UTF-8"), end
+        return bytes(value), end
+    if code in _ARRAY:
+        return _unpack_array(data, offset, size)
+    return _unpack_map(data, offset, size)
+
+
+def _unpack_array(data, offset, size):
+    values = []
+    append = values.append
+    for _ in range(size):
+        value, offset = _unpack(data, offset)
+        append(value)
+    return values, offset
+
+
+def _unpack_map(data, offset, size):
+    values = {}
+    for _ in range(size):
+        key, offset = _unpack(data, offset)
+        value, offset = _unpack(data, offset)
+        values[key] = value
+    return values, offset
+
+
+JSON = JSONCodec()
+MSGPACK = MsgPackCodec()
@@ -1,13 +1,40 @@
 import builtins
 import copy
+import importlib
 import re
+import time
 import ujson
 
 
+# Reserved operation name for running many operations in one request
+BATCH_OPERATION = "__batch__"
+# Reserved operation serving the service's metrics, see api["expose_metrics"]
+METRICS_OPERATION = "__metrics__"
+
 DEFAULT_API = {
     "version": "0",
     "timeout": 3,
     "debug": False,
+    "max_body_size": 102400,
+    # Clients reject (decoded) response bodies larger than this.  None for
+    # no limit.
+    "max_response_size": None,
+    # Bodies of at least this many bytes are compressed when the other side
+    # accepts it.  None disables compression.
+    "compress_min_size": 1024,
+    "compress_level": 6,
+    # Clients only compress request bodies when this is set, since they
+    # can't tell whether the service decodes them.  Responses are always
+    # negotiated with Accept-Encoding.
+    "compress_requests": False,
+    # Serve metrics.Metrics.render() at the __metrics__ operation
+    "expose_metrics": False,
+    # Time each phase of a request, see pyservice.timing
+    "server_timing": False,
+    # Send (client) and honor (service) request deadlines, see
+    # pyservice.deadlines.  Off by default, since they need synchronized
+    # clocks.
+    "deadline": False,
     "endpoint": {
         "scheme": "http",
         "pattern": "/api/{operation}",
@@ -88,6 +115,48 @@ def construct_service_pattern(endpoint):
     endpoint["service_pattern"] = operation_regex
 
 
+def construct_routes(endpoint, operations):
+    """
+    Build a dict of request path -> operation name, so that routing is a
+    single hash lookup instead of a regex match and a scan of the api's
+    operations.  Both the plain and trailing slash paths are included.
+
+    Input:
+        {pattern: /api/{operation}}, ["foo"]
+
+    Output:
+        {"/api/foo": "foo", "/api/foo/": "foo",
+         "/api/__batch__": "__batch__", "/api/__batch__/": "__batch__"}
+    """
+    routes = {}
+    for operation in list(operations) + [BATCH_OPERATION]:
+        add_route(routes, endpoint, operation)
+    return routes
+
+
+def add_route(routes, endpoint, operation):
+    path = endpoint["pattern"].format(operation=operation)
+    routes[path] = routes[path.rstrip("/") + "/"] = operation
+
+
+def route_prefix(endpoint):
+    """
+    The path segments before {operation}, for mounting a service:
+        /api/v1/{operation} -> ["api", "v1"]
+    """
+    pattern = endpoint["pattern"]
+    prefix = pattern[:pattern.index("{operation}")]
+    return [segment for segment in prefix.split("/")[:-1] if segment]
+
+
+def load(target):
+    ''' "package.module:attribute" -> attribute '''
+    module, _, attribute = target.partition(":")
+    if not attribute:
+        raise ValueError("Expected module:attribute, got {}".format(target))
+    return getattr(importlib.import_module(module), attribute)
+
+
 def deserialize(string, container):
     """Load string as dict into container"""
     container.update(ujson.loads(string))
@@ -109,6 +178,11 @@ class Container(dict):
     >>> c = Container()
     >>> c.keys = o
     >>> assert c["keys"] is c.keys
+
+    The container is its own __dict__, so stored keys and dict methods
+    are found by the interpreter's attribute lookup without calling into
+    Python; only misses reach __getattr__.  The price is a reference cycle
+    from the container to itself, which the cyclic GC reclaims.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -131,6 +205,12 @@ class Context:
     operation - (string) name of the current operation
     client - (Client) only available during the client portion of a request
     service - (Service) only available during the service portion of a request
+    stream - (file) raw request body, only available to service operations
+        that were registered with stream=True
+    timings - (dict) seconds spent in each phase of the request so far, by
+        name, when api["server_timing"] is enabled (see pyservice.timing)
+    deadline - (float) unix time the caller stops waiting for the response,
+        or None (see pyservice.deadlines and Context.remaining)
 
 
     Plugins can execute code before and after the rest of the request is
@@ -140,6 +220,11 @@ class Context:
     To discontinue processing the request (ie. for caching)
     simply do not invoke `process_request()`.
     """
+    # Known attributes are slots; anything plugins store lands in __dict__,
+    # which isn't allocated until the first such attribute is set.
+    __slots__ = ("__process__", "operation", "client", "service", "stream",
+                 "timings", "deadline", "__dict__")
+
     def __init__(self, process):
         self.__process__ = process
 
@@ -150,8 +235,17 @@ class Context:
         Either invokes the next plugin or hands the request off to the
         remote endpoint (client context) or the underlying function
         (service context)
+
+        Within an async client or service, plugins must await the result:
+            `await context.process_request()`
         """
-        self.__process__.process_request()
+        return self.__process__.process_request()
+
+    def remaining(self):
+        """ Seconds left before the deadline, or None without one """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
 
 
 class ExceptionFactory(object):
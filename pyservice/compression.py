@@ -0,0 +1,158 @@
+"""
+gzip and deflate Content-Encoding for request and response bodies.
+
+Bodies are only compressed when they're at least api["compress_min_size"]
+bytes, at api["compress_level"].  Decompression is incremental and stops as
+soon as the decoded body exceeds its size limit, so a small compressed body
+can't expand into an arbitrarily large one.
+"""
+import zlib
+
+# Supported encodings, in order of preference
+ENCODINGS = ("gzip", "deflate")
+ACCEPT_ENCODING = ", ".join(ENCODINGS)
+# Largest block of decoded output produced from a single input chunk
+BLOCK_SIZE = 65536
+
+
+class DecodeError(ValueError):
+    """ Malformed compressed data """
+
+
+class UnsupportedEncoding(DecodeError):
+    """ The Content-Encoding isn't gzip, deflate or identity """
+
+
+class SizeExceeded(DecodeError):
+    """ The decoded body is larger than its limit """
+
+
+def wbits(encoding):
+    if encoding == "gzip":
+        return 16 + zlib.MAX_WBITS
+    if encoding == "deflate":
+        return zlib.MAX_WBITS
+    raise UnsupportedEncoding("Unsupported encoding {}".format(encoding))
+
+
+def compress(data, encoding, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits(encoding))
+    return compressor.compress(data) + compressor.flush()
+
+
+def maybe_compress(data, encoding, level, min_size):
+    '''
+    Returns (data, encoding) - the data is only compressed when an encoding
+    was negotiated and it's at least min_size bytes.  Otherwise the encoding
+    is None.
+    '''
+    if encoding is None or min_size is None or len(data) < min_size:
+        return data, None
+    return compress(data, encoding, level), encoding
+
+
+class Decompressor(object):
+    """
+    Incrementally decode a body, raising SizeExceeded once more than
+    max_size bytes have been produced.  max_size may be None for no limit.
+    """
+    def __init__(self, encoding, max_size=None):
+        self.encoding = encoding
+        self.max_size = max_size
+        self.size = 0
+        self.decoder = zlib.decompressobj(wbits(encoding))
+
+    def feed(self, chunk):
+        ''' Returns the decoded output for the next chunk of input '''
+        blocks = []
+        data = chunk
+        try:
+            while data:
+                # Bound the output of each step so a bomb can't allocate
+                # more than one block past the limit
+                block = self.decoder.decompress(data, BLOCK_SIZE)
+                self.consume(block, blocks)
+                data = self.decoder.unconsumed_tail
+        except zlib.error as exception:
+            raise DecodeError(str(exception))
+        return b"".join(blocks)
+
+    def flush(self):
+        ''' Returns any remaining output; raises if the input was truncated '''
+        try:
+            block = self.decoder.flush()
+        except zlib.error as exception:  # pragma: no cover
+            raise DecodeError(str(exception))
+        if not self.decoder.eof:
+            raise DecodeError("Truncated {} body".format(self.encoding))
+        blocks = []
+        self.consume(block, blocks)
+        return b"".join(blocks)
+
+    def consume(self, block, blocks):
+        self.size += len(block)
+        if self.max_size is not None and self.size > self.max_size:
+            raise SizeExceeded("Decoded body is larger than {}".format(
+                self.max_size))
+        blocks.append(block)
+
+
+def iter_decompress(chunks, encoding, max_size=None):
+    ''' Yields decoded blocks from an iterable of encoded chunks '''
+    decompressor = Decompressor(encoding, max_size)
+    for chunk in chunks:
+        block = decompressor.feed(chunk)
+        if block:
+            yield block
+    block = decompressor.flush()
+    if block:
+        yield block
+
+
+def decompress(data, encoding, max_size=None):
+    return b"".join(iter_decompress((data,), encoding, max_size))
+
+
+def negotiate(accept_encoding):
+    '''
+    Returns the preferred supported encoding named by an Accept-Encoding
+    header, or None.  Encodings with q=0 are refused.
+    '''
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for option in accept_encoding.split(","):
+        name, _, params = option.partition(";")
+        if refused(params):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    if "*" in accepted:
+        return ENCODINGS[0]
+    return None
+
+
+def refused(params):
+    ''' True when an Accept-Encoding option's parameters include q=0 '''
+    params = params.replace(" ", "")
+    if not params.startswith("q="):
+        return False
+    try:
+        return float(params[2:]) == 0
+    except ValueError:
+        return False
+
+
+def encoding(header):
+    ''' Returns the content coding named by a header, None for identity '''
+    if not header:
+        return None
+    header = header.strip().lower()
+    if header == "identity":
+        return None
+    if "," in header:
+        # Stacked encodings aren't supported
+        raise UnsupportedEncoding("Unsupported encoding {}".format(header))
+    return header
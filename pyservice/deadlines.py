@@ -0,0 +1,57 @@
+"""
+Stop working on requests the caller has given up on.
+
+    api = {"deadline": True, ...}  # off by default
+
+Clients send when they'll stop waiting for a response (now + timeout) as an
+absolute unix time:
+
+    X-Deadline: 1589213311.250000
+
+Services answer requests that arrive after their deadline with a 504,
+without reading the body.  Once a request has started, the deadline is
+checked before each plugin, deserialize and the function, so the rest of
+the chain is skipped as soon as it passes.  Plugins and operations can see
+the deadline (context.deadline) and the seconds left before it
+(context.remaining()) to give up on long work themselves.
+
+Deadlines are compared against each host's clock, so clients and services
+need synchronized clocks: a service whose clock is ahead of a client's by
+more than the client's timeout answers every request with a 504.  That's
+why api["deadline"] is False by default; set it on both sides to send and
+honor them.
+
+Passing the deadline raises wsgi.DeadlineExceeded from
+context.process_request().  It's an Exception, so a plugin that catches
+Exception around process_request swallows it and the request carries on
+(and isn't answered with a 504); catch it first and re-raise it.
+"""
+import time
+
+HEADER = "X-Deadline"
+# The same header as wsgi environ key, and as asgi scope header name
+ENVIRON_KEY = "HTTP_" + HEADER.upper().replace("-", "_")
+SCOPE_HEADER = HEADER.lower().encode("latin-1")
+
+
+def header(timeout, now=None):
+    ''' X-Deadline value for a request that times out after timeout '''
+    if now is None:
+        now = time.time()
+    return "{:.6f}".format(now + timeout)
+
+
+def parse(value):
+    ''' Deadline from an X-Deadline header, or None if missing/malformed '''
+    if not value:
+        return None
+    try:
+        deadline = float(value)
+    except ValueError:
+        return None
+    # nan and inf never pass
+    return deadline if deadline < float("inf") else None
+
+
+def expired(deadline):
+    return deadline is not None and deadline <= time.time()
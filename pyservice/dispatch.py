@@ -0,0 +1,78 @@
+"""
+Serve many services from a single WSGI or ASGI application.
+
+    dispatcher = Dispatcher(users_v1, users_v2, billing)
+    make_server(host, port, dispatcher)             # WSGI
+    uvicorn.run(dispatcher.asgi_application)        # ASGI
+
+Services are found by the path segments before {operation} in their
+endpoint pattern, in a trie of path segments.  The longest mounted prefix
+wins, so routing cost depends on the depth of the path rather than the
+number of services; the service then routes the operation with a single
+dict lookup (see wsgi.route).
+"""
+from . import asgi
+from . import common
+from . import wsgi
+
+
+class Node(object):
+    __slots__ = ("children", "service")
+
+    def __init__(self):
+        self.children = {}
+        self.service = None
+
+
+class Dispatcher(object):
+    def __init__(self, *services):
+        self.root = Node()
+        for service in services:
+            self.mount(service)
+
+    def mount(self, service):
+        ''' Serve a service at its endpoint's prefix '''
+        node = self.root
+        for segment in common.route_prefix(service.api["endpoint"]):
+            node = node.children.setdefault(segment, Node())
+        if node.service is not None:
+            raise ValueError("A service is already mounted at '{}'".format(
+                service.api["endpoint"]["pattern"]))
+        node.service = service
+        return service
+
+    def find(self, path):
+        ''' Returns the service with the longest prefix of path, or None '''
+        node = self.root
+        service = node.service
+        # The last segment is the operation, never part of a prefix
+        for segment in path.split("/")[:-1]:
+            if not segment:
+                continue
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.service is not None:
+                service = node.service
+        return service
+
+    def __call__(self, environ, start_response):
+        ''' WSGI entry point '''
+        service = self.find(environ.get("PATH_INFO", ""))
+        if service is None:
+            resp = wsgi.Response(start_response)
+            resp.exception(wsgi.UNKNOWN_OPERATION)
+            return resp.send()
+        return service.wsgi_application(environ, start_response)
+
+    wsgi_application = __call__
+
+    async def asgi_application(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await asgi.lifespan(receive, send)
+        service = self.find(scope["path"])
+        if service is None:
+            resp = asgi.Response(send)
+            resp.exception(wsgi.UNKNOWN_OPERATION)
+            return await resp.send()
+        return await service.asgi_application(scope, receive, send)
@@ -0,0 +1,360 @@
+"""
+Open-loop load testing for a Service and its plugin stack.
+
+    from pyservice.loadtest import LoadTest, format_report
+
+    test = LoadTest(service, {"get_item": lambda: {"id": 1}},
+                    rate=500, duration=30, workers=64)
+    print(format_report(test.run()))
+
+or from the command line:
+
+    python -m pyservice.loadtest myapp:service --rate 500 --duration 30 \\
+        --operation get_item='{"id": 1}'
+
+The service is started on a local wsgiref server (unless host and port
+are given) and driven through a Client, or raw HTTP requests with --raw.
+
+Requests are sent at a fixed arrival rate no matter how quickly the service
+responds (open loop).  Latency is measured from when each request was
+scheduled to be sent, not from when a worker got to it, so time spent
+queued behind slow requests is counted (coordinated omission is
+corrected).  The uncorrected service times are reported alongside.
+"""
+import argparse
+import copy
+import http.client
+import math
+import random
+import socketserver
+import sys
+import threading
+import time
+import queue
+import ujson
+import wsgiref.simple_server
+from . import client as clients
+from . import common
+from . import transport
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Server(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(service, host="127.0.0.1", port=0):
+    ''' Serve the service on a background thread.  Returns the server '''
+    server = wsgiref.simple_server.make_server(
+        host, port, service.wsgi_application,
+        server_class=Server, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class LoadTest(object):
+    """
+    operations maps operation names to functions that return a request
+    (dict) for each call.  Operations are picked at random, in proportion
+    to weights (by name, default 1).
+
+    rate is requests per second across all workers, for duration seconds.
+    When host and port are None, the service is started locally; otherwise
+    requests are sent to the service already running there.
+    """
+    def __init__(self, service, operations, rate=100, duration=10,
+                 workers=32, weights=None, raw=False, host=None, port=None,
+                 seed=None):
+        if not operations:
+            raise ValueError("At least one operation is required")
+        for operation in operations:
+            if operation not in service.api["operations"]:
+                raise ValueError("Unknown operation {}".format(operation))
+        self.service = service
+        self.operations = operations
+        self.rate = rate
+        self.duration = duration
+        self.workers = workers
+        self.names = list(operations)
+        weights = weights or {}
+        self.weights = [weights.get(name, 1) for name in self.names]
+        self.raw = raw
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+
+    def run(self):
+        ''' Returns the report, see LoadTest.report '''
+        api = copy.deepcopy(self.service.api)
+        server = None
+        if self.host is None:
+            server = serve(self.service)
+            host, port = server.server_address[:2]
+            api["endpoint"].update(scheme="http", host=host, port=port)
+        else:
+            api["endpoint"].update(host=self.host, port=self.port)
+        call = self.raw_call(api) if self.raw else self.client_call(api)
+
+        try:
+            samples, start = drive(self.schedule(), call, self.workers)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        return self.report(samples, start)
+
+    def client_call(self, api):
+        client = clients.Client(**api)
+        client.transport = transport.PooledTransport(
+            pool_size=self.workers, max_connections=self.workers)
+        return lambda operation, request: client(operation, **request)
+
+    def raw_call(self, api):
+        '''
+        POST serialized requests with http.client, one connection per
+        thread.  Service exceptions are raised by name, like Client does.
+        '''
+        endpoint = api["endpoint"]
+        post = http_post(endpoint["host"], endpoint["port"], api["timeout"])
+        headers = {"Content-Type": "application/json"}
+
+        def call(operation, request):
+            path = endpoint["pattern"].format(operation=operation)
+            post(path, ujson.dumps(request), headers)
+        return call
+
+    def schedule(self):
+        ''' (offset, operation, request) at the test's rate, see drive '''
+        interval = 1.0 / self.rate
+        for index in range(int(self.rate * self.duration)):
+            operation = self.random.choices(self.names, self.weights)[0]
+            yield index * interval, operation, self.operations[operation]()
+
+    def report(self, samples, start):
+        '''
+        {
+            "rate": requested rate,
+            "duration": seconds until the last response,
+            "requests": total, "throughput": responses per second,
+            "operations": {
+                name: {
+                    "requests", "throughput",
+                    "errors": {exception class: count},
+                    "latency": {"p50", "p90", "p99", "p99.9", "max"},
+                    "service_time": (same, uncorrected)
+                }
+            }
+        }
+        Latencies are in milliseconds.
+        '''
+        end = max((sample[3] for sample in samples), default=start)
+        duration = max(end - start, 1e-9)
+        by_operation = {}
+        for sample in samples:
+            by_operation.setdefault(sample[0], []).append(sample)
+        operations = {}
+        for operation, entries in sorted(by_operation.items()):
+            errors = {}
+            for entry in entries:
+                if entry[4] is not None:
+                    errors[entry[4]] = errors.get(entry[4], 0) + 1
+            operations[operation] = {
+                "requests": len(entries),
+                "throughput": len(entries) / duration,
+                "errors": errors,
+                "latency": summary(
+                    [finished - scheduled
+                     for _, scheduled, _, finished, _ in entries]),
+                "service_time": summary(
+                    [finished - started
+                     for _, _, started, finished, _ in entries])
+            }
+        return {
+            "rate": self.rate,
+            "duration": duration,
+            "requests": len(samples),
+            "throughput": len(samples) / duration,
+            "operations": operations
+        }
+
+
+def drive(schedule, call, workers):
+    '''
+    Call call(operation, request) on a pool of workers threads for each
+    (offset, operation, request) in schedule, offset seconds after the
+    start.  Returns (samples, start) where each sample is
+
+        (operation, scheduled, started, finished, exception class name)
+
+    When the schedule slips (ie. generating requests is slow, or every
+    worker is busy), the late requests are queued immediately, and still
+    timed from when they were due.
+    '''
+    requests = queue.Queue()
+    samples = []
+    threads = [threading.Thread(target=work, args=(requests, call, samples))
+               for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    try:
+        for offset, operation, request in schedule:
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            requests.put((operation, request, scheduled))
+    finally:
+        for _ in threads:
+            requests.put(None)
+        for thread in threads:
+            thread.join()
+    return samples, start
+
+
+def work(requests, call, samples):
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        operation, request, scheduled = item
+        started = time.perf_counter()
+        error = None
+        try:
+            call(operation, request)
+        except Exception as exception:
+            error = exception.__class__.__name__
+        samples.append(
+            (operation, scheduled, started, time.perf_counter(), error))
+
+
+def http_post(host, port, timeout):
+    '''
+    Returns post(path, body, headers), which sends a raw POST over one
+    keep-alive connection per thread and raises its error (see check).
+
+    A connection that fails is closed and replaced by the thread's next
+    request, since it may be left mid-response and would refuse any other.
+    '''
+    local = threading.local()
+    exceptions = common.ExceptionFactory()
+
+    def post(path, body, headers):
+        connection = getattr(local, "connection", None)
+        if connection is None:
+            connection = local.connection = http.client.HTTPConnection(
+                host, port, timeout=timeout)
+        try:
+            connection.request("POST", path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            local.connection = None
+            connection.close()
+            raise
+        check(response.status, response.reason, data, exceptions)
+    return post
+
+
+def check(status, reason, body, exceptions):
+    '''
+    Raise the error in a raw response: TransportError for http errors, or
+    the service exception (by name, from exceptions) in a JSON body.
+    '''
+    if status >= 400:
+        raise transport.TransportError("{} {}".format(status, reason))
+    if body.startswith(b'{"__exception__"'):
+        exception = ujson.loads(body)["__exception__"]
+        raise getattr(exceptions, exception["cls"])(*exception["args"])
+
+
+def percentile(values, p):
+    ''' Nearest-rank percentile of sorted values '''
+    if not values:
+        return 0.0
+    # Rounded first so float error can't push the rank up by one
+    rank = math.ceil(round(p / 100 * len(values), 9)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summary(seconds):
+    ''' Percentiles and max of durations, in milliseconds '''
+    values = sorted(value * 1000 for value in seconds)
+    result = {"p{:g}".format(p): percentile(values, p) for p in PERCENTILES}
+    result["max"] = values[-1] if values else 0.0
+    return result
+
+
+def format_report(report):
+    lines = ["{requests} requests in {duration:.2f}s ({throughput:.1f}/s, "
+             "target {rate}/s)".format(**report)]
+    columns = ["p{:g}".format(p) for p in PERCENTILES] + ["max"]
+    lines.append("{:24} {:>8} {:>8}  {}".format(
+        "operation", "requests", "errors",
+        " ".join("{:>9}".format(column) for column in columns)))
+    for operation, stats in report["operations"].items():
+        for kind in ("latency", "service_time"):
+            name = operation if kind == "latency" else "  (service time)"
+            counts = ("", "")
+            if kind == "latency":
+                counts = (stats["requests"], sum(stats["errors"].values()))
+            lines.append("{:24} {:>8} {:>8}  {}".format(
+                name, *counts, " ".join(
+                    "{:>7.2f}ms".format(stats[kind][column])
+                    for column in columns)))
+    return "\n".join(lines)
+
+
+def constant(request):
+    return lambda: dict(request)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pyservice.loadtest",
+        description="Open-loop load test for a pyservice Service")
+    parser.add_argument("service", help="module:attribute of the Service")
+    parser.add_argument("--operation", action="append", default=[],
+                        metavar="NAME[=JSON]",
+                        help="operation to call, with a constant request")
+    parser.add_argument("--payloads", metavar="module:attribute",
+                        help="dict of operation name -> request factory")
+    parser.add_argument("--rate", type=float, default=100,
+                        help="requests per second")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--raw", action="store_true",
+                        help="send raw HTTP requests instead of using Client")
+    parser.add_argument("--host", help="test a service that's already running")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--json", metavar="PATH", help="save the report")
+    args = parser.parse_args(argv)
+
+    operations = {}
+    if args.payloads:
+        operations.update(common.load(args.payloads))
+    for option in args.operation:
+        name, _, request = option.partition("=")
+        operations[name] = constant(ujson.loads(request) if request else {})
+    test = LoadTest(
+        common.load(args.service), operations, rate=args.rate,
+        duration=args.duration, workers=args.workers, raw=args.raw,
+        host=args.host, port=args.port)
+    report = test.run()
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as file:
+            file.write(ujson.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Per-operation request metrics for services and clients.
+
+    service.metrics.snapshot()["get_item"].requests
+    print(service.metrics.render())
+
+Every request processed records its latency, request and response sizes,
+and the class of any exception it raised.  Observations are written to a
+shard owned by the current thread, so recording never takes a lock; shards
+are only summed when the metrics are read.
+
+Services with api["expose_metrics"] serve render() at the reserved
+__metrics__ operation, in the Prometheus text exposition format.
+"""
+import bisect
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets.  Durations above
+# the last bound are counted in an overflow (+Inf) bucket.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Stats(object):
+    """ Counters and latency histogram for a single operation """
+    __slots__ = ("requests", "errors", "request_bytes", "response_bytes",
+                 "latency", "buckets")
+
+    def __init__(self, size):
+        self.requests = 0
+        # Exception class name -> count
+        self.errors = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        # Total seconds
+        self.latency = 0.0
+        # Non-cumulative counts; the last bucket is the overflow
+        self.buckets = [0] * (size + 1)
+
+    def add(self, other):
+        self.requests += other.requests
+        for name, count in list(other.errors.items()):
+            self.errors[name] = self.errors.get(name, 0) + count
+        self.request_bytes += other.request_bytes
+        self.response_bytes += other.response_bytes
+        self.latency += other.latency
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of Stats by operation.
+
+    Each thread records into its own shard.  Shards of threads that have
+    exited are folded into a single retired shard, so servers that start
+    a thread per request don't accumulate them.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (thread, shard) for every thread that has recorded a request
+        self.shards = []
+        self.retired = {}
+
+    def shard(self):
+        ''' The current thread's operation -> Stats '''
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.sweep()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def sweep(self):
+        ''' Called with the lock held '''
+        shards = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                shards.append((thread, shard))
+            else:
+                self.merge(self.retired, shard)
+        self.shards = shards
+
+    def merge(self, totals, shard):
+        for operation, stats in list(shard.items()):
+            total = totals.get(operation)
+            if total is None:
+                total = totals[operation] = Stats(len(self.buckets))
+            total.add(stats)
+
+    def observe(self, operation, seconds, request_size=0, response_size=0,
+                exception=None):
+        ''' Record a single request '''
+        shard = self.shard()
+        stats = shard.get(operation)
+        if stats is None:
+            stats = shard[operation] = Stats(len(self.buckets))
+        stats.requests += 1
+        stats.request_bytes += request_size
+        stats.response_bytes += response_size
+        stats.latency += seconds
+        stats.buckets[bisect.bisect_left(self.buckets, seconds)] += 1
+        if exception is not None:
+            name = exception.__class__.__name__
+            stats.errors[name] = stats.errors.get(name, 0) + 1
+
+    def snapshot(self):
+        '''
+        Returns the totals across threads as {operation: Stats}.  Requests
+        being recorded while the snapshot is taken may be partially counted.
+        '''
+        totals = {}
+        with self.lock:
+            self.sweep()
+            self.merge(totals, self.retired)
+            for _, shard in self.shards:
+                self.merge(totals, shard)
+        return totals
+
+    def render(self, prefix="pyservice"):
+        ''' The snapshot in the Prometheus text exposition format '''
+        totals = sorted(self.snapshot().items())
+        lines = []
+
+        def family(name, kind, description):
+            lines.append("# HELP {}_{} {}".format(prefix, name, description))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+
+        def sample(name, labels, value):
+            labels = ",".join(
+                '{}="{}"'.format(key, escape(label)) for key, label in labels)
+            lines.append("{}_{}{{{}}} {}".format(prefix, name, labels, value))
+
+        family("requests_total", "counter", "Requests by operation.")
+        for operation, stats in totals:
+            sample("requests_total", [("operation", operation)],
+                   stats.requests)
+        family("errors_total", "counter",
+               "Failed requests by operation and exception class.")
+        for operation, stats in totals:
+            for name, count in sorted(stats.errors.items()):
+                sample("errors_total",
+                       [("operation", operation), ("exception", name)], count)
+        family("request_bytes_total", "counter",
+               "Size of request bodies by operation.")
+        for operation, stats in totals:
+            sample("request_bytes_total", [("operation", operation)],
+                   stats.request_bytes)
+        family("response_bytes_total", "counter",
+               "Size of response bodies by operation.")
+        for operation, stats in totals:
+            sample("response_bytes_total", [("operation", operation)],
+                   stats.response_bytes)
+        family("latency_seconds", "histogram",
+               "Time to process requests by operation.")
+        for operation, stats in totals:
+            count = 0
+            bounds = [repr(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, bucket in zip(bounds, stats.buckets):
+                count += bucket
+                sample("latency_seconds_bucket",
+                       [("operation", operation), ("le", bound)], count)
+            sample("latency_seconds_sum", [("operation", operation)],
+                   repr(stats.latency))
+            sample("latency_seconds_count", [("operation", operation)],
+                   stats.requests)
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    ''' Escape a label value '''
+    return str(value).replace("\\", "\\\\").replace(
+        '"', '\\"').replace("\n", "\\n")
+
+
+def size(body):
+    ''' Length of a serialized body, or 0 when it isn't known (streams) '''
+    if isinstance(body, (str, bytes)):
+        return len(body)
+    return 0
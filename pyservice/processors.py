@@ -2,15 +2,31 @@
 These classes are responsible for managing state during a client/service
 request, particularly to minimize the burden on plugins to manage context
 """
+import asyncio
+import inspect
+import time
+from . import batching
+from . import caching
+from . import codecs
 from . import common
+from . import compression
+from . import deadlines
+from . import metrics
+from . import timing
+from . import transport
 from . import wsgi
-import requests
-missing = object()
 
 
-def service(service, operation, request_body):  # pragma: no cover
+def service(service, operation, request_body,
+            request_codec=codecs.JSON, response_codec=codecs.JSON,
+            timings=None, deadline=None):  # pragma: no cover
     ''' Wrap the Processor class to match the __processor__ interface '''
-    return ServiceProcessor(service, operation, request_body)()
+    if operation == common.BATCH_OPERATION:
+        return batch(service, request_body, request_codec, response_codec,
+                     timings, deadline)
+    return ServiceProcessor(
+        service, operation, request_body, request_codec, response_codec,
+        timings, deadline)()
 
 
 def client(client, operation, request_body):  # pragma: no cover
@@ -18,13 +34,267 @@ def client(client, operation, request_body):  # pragma: no cover
     return ClientProcessor(client, operation, request_body)()
 
 
+def async_service(service, operation, request_body,
+                  request_codec=codecs.JSON,
+                  response_codec=codecs.JSON,
+                  timings=None, deadline=None):  # pragma: no cover
+    ''' Returns a coroutine that processes the request when awaited '''
+    if operation == common.BATCH_OPERATION:
+        return async_batch(service, request_body, request_codec,
+                           response_codec, timings, deadline)
+    return AsyncServiceProcessor(
+        service, operation, request_body, request_codec, response_codec,
+        timings, deadline)()
+
+
+def async_client(client, operation, request_body):  # pragma: no cover
+    ''' Returns a coroutine that processes the request when awaited '''
+    return AsyncClientProcessor(client, operation, request_body)()
+
+
+def load_batch(service, request_body, codec=codecs.JSON):
+    '''
+    Returns (entries, parallel) from a batch request body:
+
+        {
+            "operations": [
+                {"operation": "foo", "request": {...}},
+                ...
+            ],
+            "parallel": false
+        }
+
+    Raises BAD_REQUEST when the body isn't a list of operations.
+    '''
+    batch = {}
+    try:
+        codec.deserialize(request_body, batch)
+        entries = batch["operations"]
+        for entry in entries:
+            entry["operation"]
+    except (ValueError, KeyError, TypeError):
+        raise wsgi.BAD_REQUEST
+    return entries, batch.get("parallel", False)
+
+
+def pack_batch(results, codec=codecs.JSON):
+    return codec.serialize({"results": results})
+
+
+def batch(service, request_body,
+          request_codec=codecs.JSON, response_codec=codecs.JSON,
+          timings=None, deadline=None):
+    '''
+    Run each entry of a batch through its own BatchEntryProcessor, either
+    in order or in parallel on the service's executor.
+
+    Results are returned in the same order as the entries.  Entries aren't
+    timed individually; timings has the batch's deserialize, entries (all
+    of them) and serialize.  Entries share the batch's deadline.
+    '''
+    clock = Clock(timings)
+    clock.switch("deserialize")
+    entries, parallel = load_batch(service, request_body, request_codec)
+    clock.switch("entries")
+
+    def process(entry):
+        return BatchEntryProcessor(
+            service, entry["operation"], entry.get("request") or {},
+            deadline)()
+    if parallel:
+        results = list(service.executor.map(process, entries))
+    else:
+        results = [process(entry) for entry in entries]
+    clock.switch("serialize")
+    body = pack_batch(results, response_codec)
+    clock.switch(None)
+    return body
+
+
+async def async_batch(service, request_body,
+                      request_codec=codecs.JSON, response_codec=codecs.JSON,
+                      timings=None, deadline=None):
+    ''' See batch; parallel entries run concurrently on the event loop '''
+    clock = Clock(timings)
+    clock.switch("deserialize")
+    entries, parallel = load_batch(service, request_body, request_codec)
+    clock.switch("entries")
+    processors = [
+        AsyncBatchEntryProcessor(
+            service, entry["operation"], entry.get("request") or {},
+            deadline)
+        for entry in entries]
+    if parallel:
+        results = await asyncio.gather(*(process() for process in processors))
+    else:
+        results = [await process() for process in processors]
+    clock.switch("serialize")
+    body = pack_batch(results, response_codec)
+    clock.switch(None)
+    return body
+
+
+class Clock(object):
+    """
+    Accumulates the time spent in each phase into timings (seconds by
+    name).  Does nothing when timings is None.
+    """
+    __slots__ = ("timings", "phase", "mark")
+
+    def __init__(self, timings):
+        self.timings = timings
+        self.phase = None
+        self.mark = 0.0
+
+    def switch(self, phase):
+        '''
+        Credit the time since the last switch to the current phase, and
+        start another.  Returns the phase that was running, so nested phases
+        can resume it.  No time is recorded while the phase is None.
+        '''
+        timings = self.timings
+        if timings is None:
+            return None
+        now = time.perf_counter()
+        outer = self.phase
+        if outer is not None:
+            timings[outer] = timings.get(outer, 0.0) + now - self.mark
+        self.phase = phase
+        self.mark = now
+        return outer
+
+
+# Shared by processors that aren't timed, since it never records anything
+UNTIMED = Clock(None)
+
+
+def scope_step(scope):
+    '''
+    Step that gives the processor a chance to (de)serialize, load/dump
+    containers, etc. around the rest of the chain
+    '''
+    def step(processor):
+        if processor.enter_scope(scope):
+            # The processor handled the scope itself, ie. a cache hit
+            return
+        processor.process_request()
+        processor.exit_scope(scope)
+    return step
+
+
+def request_step(plugin):
+    def step(processor):
+        return plugin(processor.context)
+    return step
+
+
+def operation_step(plugin):
+    def step(processor):
+        return plugin(
+            processor.request, processor.response, processor.context)
+    return step
+
+
+def execute_step(processor):
+    processor._execute()
+
+
+def async_scope_step(scope):
+    async def step(processor):
+        if await processor.enter_scope_async(scope):
+            return
+        await processor.process_request()
+        processor.exit_scope(scope)
+    return step
+
+
+def async_execute_step(processor):
+    return processor._execute()
+
+
+def timed_step(phase, step):
+    ''' Credit the time spent in a step (excluding later steps) to phase '''
+    def timed(processor):
+        outer = processor.clock.switch(phase)
+        try:
+            step(processor)
+        finally:
+            processor.clock.switch(outer)
+    return timed
+
+
+def timed_scope_step(scope, enter_phase, exit_phase):
+    ''' scope_step, timing enter_scope and exit_scope as separate phases '''
+    def step(processor):
+        outer = processor.clock.switch(enter_phase)
+        try:
+            if processor.enter_scope(scope):
+                return
+            processor.process_request()
+            processor.clock.switch(exit_phase)
+            processor.exit_scope(scope)
+        finally:
+            processor.clock.switch(outer)
+    return step
+
+
+def async_timed_step(phase, step):
+    async def timed(processor):
+        outer = processor.clock.switch(phase)
+        try:
+            await step(processor)
+        finally:
+            processor.clock.switch(outer)
+    return timed
+
+
+def async_timed_scope_step(scope, enter_phase, exit_phase):
+    async def step(processor):
+        outer = processor.clock.switch(enter_phase)
+        try:
+            if await processor.enter_scope_async(scope):
+                return
+            await processor.process_request()
+            processor.clock.switch(exit_phase)
+            processor.exit_scope(scope)
+        finally:
+            processor.clock.switch(outer)
+    return step
+
+
+def deadline_step(step):
+    '''
+    Raise DEADLINE_EXCEEDED instead of starting a step once the request's
+    deadline has passed.  Works for async steps too, since the check runs
+    before the step's coroutine is created.
+    '''
+    def checked(processor):
+        if deadlines.expired(processor.context.deadline):
+            raise wsgi.DEADLINE_EXCEEDED
+        return step(processor)
+    return checked
+
+
 class Processor(object):
-    def __init__(self, obj, operation):
+    # Step factories used by compile, overridden by AsyncProcessor
+    scope_step = staticmethod(scope_step)
+    request_step = staticmethod(request_step)
+    operation_step = staticmethod(operation_step)
+    execute_step = staticmethod(execute_step)
+    timed_step = staticmethod(timed_step)
+    timed_scope_step = staticmethod(timed_scope_step)
+
+    # A processor is created for every request; slots keep that cheap
+    __slots__ = ("obj", "operation", "context", "request", "request_body",
+                 "response", "response_body", "chain", "index", "clock")
+
+    def __init__(self, obj, operation, request=(), timings=None,
+                 deadline=None):
         """
         Simplifies the chaining contract for plugin authors.  This allows a
         plugin to use context.process_request() without passing the request,
         response, and context objects back into the chained call, and without
-        keeping track of the correct next plugni to call.
+        keeping track of the correct next plugin to call.
         """
         self.obj = obj
         # Don't rely on context's operation to be immutable
@@ -32,100 +302,116 @@ class Processor(object):
 
         self.context = common.Context(self)
         self.context.operation = operation
+        # Seconds spent in each phase by name, or None when not timed
+        self.context.timings = timings
+        self.clock = UNTIMED if timings is None else Clock(timings)
+        # Unix time the caller stops waiting, see deadlines
+        self.context.deadline = deadline
 
-        self.request = common.Container()
+        self.request = common.Container(request)
         self.request_body = None
         self.response = common.Container()
         self.response_body = None
 
-        # request -> operation -> function
-        self.scope = "request"
-        self.transitions = {
-            "request": "operation",
-            "operation": "function",
-            "function": None
-        }
+        # Compiled steps (see Processor.compile), set when processing starts
+        self.chain = None
         self.index = -1
 
+    @classmethod
+    def compile(cls, plugins):
+        '''
+        Flatten the request -> operation -> function chain into a tuple of
+        steps.  Each step takes the processor, and continues the chain
+        (if at all) through processor.process_request().
+
+        Service and Client cache the compiled chain until a plugin is added.
+        '''
+        steps = [cls.scope_step("request")]
+        steps.extend(cls.request_step(plugin) for plugin in plugins["request"])
+        steps.append(cls.scope_step("operation"))
+        steps.extend(
+            cls.operation_step(plugin) for plugin in plugins["operation"])
+        steps.append(cls.scope_step("function"))
+        steps.append(cls.execute_step)
+        return tuple(steps)
+
+    @classmethod
+    def compile_timed(cls, plugins):
+        '''
+        compile, with each plugin, deserialize (enter_scope("operation")),
+        the function and serialize (exit_scope("operation")) timed into
+        processor.clock.  Plugins are timed individually, excluding the
+        rest of the chain they wrap.
+        '''
+        steps = [cls.scope_step("request")]
+        for phase, plugin in zip(timing.phases("request", plugins["request"]),
+                                 plugins["request"]):
+            steps.append(cls.timed_step(phase, cls.request_step(plugin)))
+        steps.append(
+            cls.timed_scope_step("operation", "deserialize", "serialize"))
+        for phase, plugin in zip(
+                timing.phases("operation", plugins["operation"]),
+                plugins["operation"]):
+            steps.append(cls.timed_step(phase, cls.operation_step(plugin)))
+        steps.append(cls.scope_step("function"))
+        steps.append(cls.timed_step("function", cls.execute_step))
+        return tuple(steps)
+
+    @classmethod
+    def compile_deadline(cls, steps):
+        ''' Compiled steps that check the deadline before each step '''
+        return tuple(deadline_step(step) for step in steps)
+
+    def load_chain(self):
+        ''' The compiled steps to process the request with '''
+        return self.obj.chain(self.__class__)
+
     def __call__(self):
         """ Entry point for external callers to begin processing """
-        if self.scope is None:
+        if self.chain is not None:
             raise RuntimeError("Already processed request")
-        self.process_request()
+        self.chain = self.load_chain()
+        try:
+            self.process_request()
+        finally:
+            self.release_context()
         return self.result
 
+    def release_context(self):
+        '''
+        Break the processor <-> context reference cycle once processing is
+        done, so both are freed immediately instead of by the cyclic GC.
+        '''
+        self.context.__process__ = None
+
     def process_request(self):
         """
         Public re-entry point.
 
         Plugins will come in through commons.Context.process_request, which
-        will delegate to its processor's continue_exection (usually this
-        method).  The internal _continue method will also call into this
-        function, to keep state management (request-> operation -> function)
-        separate from lifecycle management (enter|exit scope, execute).
+        will delegate to its processor's process_request (usually this
+        method).  Each call advances to the next compiled step.
         """
-        # If this is the first time we've been in this scope,
-        # give subclasses a chance to (de)serialize, load/dump containers, etc
-        is_first_plugin = self.index == -1
-
-        # Keep a reference to the scope in this function call, since we know
-        # self.scope will mutate as this recurses
-        local_scope = self.scope
-
-        if is_first_plugin:
-            self.enter_scope(local_scope)
-
-        self._continue()
-
-        # If we called enter_scope in this scope, then we also need to call
-        # exit_scope in this scope (the rest of this scope was executed in)
-        # one of the recursive calls above
-        if is_first_plugin:
-            self.exit_scope(local_scope)
-
-    def _continue(self):
-        ''' Call the next plugin '''
-        # When scope is function, there won't be any plugins
-        plugins = self.obj.plugins.get(self.scope, [])
-        n = len(plugins)
         self.index += 1
-
-        # We just processed the last plugin for this scope, either roll over
-        # to the next scope or invoke the function underneath it all
-        if self.index == n:
-
-            # Determine the next scope and continue execution
-            next_scope = self.transitions.get(self.scope, missing)
-            if next_scope is not missing:
-                self.scope = next_scope
-                self.index = -1
-                self.process_request()
-            # Otherwise, we've finished the last set of scoped plugins
-            # (function) and need to call the underlying function
-            else:
-                self._execute()
-
-        # We're still working through the plugins for this scope
-        else:  # self.index < n
-            # This is an assert instead of an exception because there's no
-            # single best way to recover from walking off the end of the
-            # available plugins - return, increment scope, raise?
-            assert self.index < n, "index exceeded length of plugins"
-
-            if self.scope == "request":
-                plugins[self.index](self.context)
-            elif self.scope == "operation":
-                plugins[self.index](self.request, self.response, self.context)
-            # Don't know how to handle plugins of other types, this is likely
-            # a bug.  Raise an error immediately instead of silently hanging
-            else:  # pragma: no cover
-                raise ValueError("Unexpected scope '{}'".format(self.scope))
+        self.chain[self.index](self)
 
     def _execute(self):  # pragma: no cover
         raise NotImplementedError("Subclasses must implement _execute.")
 
+    def record(self, start, exception=None):
+        ''' Record the request in its service or client's metrics, if any '''
+        registry = self.obj.metrics
+        if registry is not None:
+            registry.observe(
+                self.operation, time.perf_counter() - start,
+                metrics.size(self.request_body),
+                metrics.size(self.response_body), exception)
+
     def enter_scope(self, scope):  # pragma: no cover
-        ''' The scope whose execution is about to begin '''
+        '''
+        The scope whose execution is about to begin.  Returning True skips
+        the rest of the scope, including exit_scope.
+        '''
         pass
 
     def exit_scope(self, scope):  # pragma: no cover
@@ -137,11 +423,65 @@ class Processor(object):
         raise NotImplementedError("Subclasses must define result.")
 
 
+class AsyncProcessor(Processor):
+    """
+    Processor whose plugins and _execute are coroutines.
+
+    Plugins continue the request with `await context.process_request()`.
+    Steps are compiled the same way as Processor; process_request returns
+    the next step's coroutine for the caller to await.
+    """
+    __slots__ = ()
+
+    # Plugin steps return the plugin's coroutine, so only the scope and
+    # execute steps need async versions
+    scope_step = staticmethod(async_scope_step)
+    execute_step = staticmethod(async_execute_step)
+    timed_step = staticmethod(async_timed_step)
+    timed_scope_step = staticmethod(async_timed_scope_step)
+
+    async def __call__(self):
+        if self.chain is not None:
+            raise RuntimeError("Already processed request")
+        self.chain = self.load_chain()
+        try:
+            await self.process_request()
+        finally:
+            self.release_context()
+        return self.result
+
+    def process_request(self):
+        self.index += 1
+        return self.chain[self.index](self)
+
+    async def enter_scope_async(self, scope):
+        ''' enter_scope, for processors that may need to await '''
+        return self.enter_scope(scope)
+
+    async def _execute(self):  # pragma: no cover
+        raise NotImplementedError("Subclasses must implement _execute.")
+
+
 class ClientProcessor(Processor):
+    # Iterator over the records of a streamed response
+    __slots__ = ("records",)
+
     def __init__(self, client, operation, request):
-        super().__init__(client, operation)
+        timings = {} if client.api["server_timing"] else None
+        super().__init__(client, operation, request, timings)
         self.context.client = client
-        self.request.update(request)
+        self.records = None
+
+    def __call__(self):
+        start = time.perf_counter()
+        error = None
+        try:
+            return super().__call__()
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            self.record(start, error)
 
     def _execute(self):
         '''
@@ -153,21 +493,115 @@ class ClientProcessor(Processor):
         6. Raise native errors on service exceptions
         '''
 
-        self.request_body = common.serialize(self.request)
+        clock = self.clock
+        try:
+            clock.switch("serialize")
+            uri, data, headers, timeout = self.pack_request()
+            clock.switch("transport")
+            try:
+                response = self.obj.transport.send(
+                    uri, data, headers=headers, timeout=timeout)
+            except transport.TransportError as exception:
+                self.handle_transport_error(exception)
+            clock.switch("deserialize")
+            self.merge_timings(response)
+            self.unpack_response(response)
+        finally:
+            clock.switch(None)
+
+    def pack_request(self):
+        ''' Returns the (uri, data, headers, timeout) to send '''
+        api = self.obj.api
+        self.request_body = self.obj.codec.serialize(self.request)
 
-        pattern = self.obj.api["endpoint"]["client_pattern"]
+        pattern = api["endpoint"]["client_pattern"]
         uri = pattern.format(operation=self.operation)
+        headers = self.obj.headers
+        timeout = api["timeout"]
+        if api["deadline"] and timeout is not None:
+            headers = dict(headers)
+            headers[deadlines.HEADER] = deadlines.header(timeout)
         data = self.request_body
-        timeout = self.obj.api["timeout"]
-        response = requests.post(uri, data=data, timeout=timeout)
+        min_size = api["compress_min_size"]
+        # Length of a str is a lower bound on its encoded length
+        if (api["compress_requests"] and min_size is not None and
+                len(data) >= min_size):
+            if isinstance(data, str):
+                data = data.encode("UTF-8")
+            data = compression.compress(
+                data, compression.ENCODINGS[0], api["compress_level"])
+            headers = dict(headers)
+            headers["Content-Encoding"] = compression.ENCODINGS[0]
+        return uri, data, headers, timeout
 
+    def merge_timings(self, response):
+        '''
+        Add the service's Server-Timing phases to context.timings as
+        "service.<phase>", and the transport time they don't account for
+        as "network".
+        '''
+        timings = self.context.timings
+        if timings is None:
+            return
+        phases = timing.parse(response.headers.get("server-timing"))
+        if not phases:
+            return
+        for phase, seconds in phases.items():
+            timings["service." + phase] = seconds
+        timings["network"] = max(
+            0.0, timings.get("transport", 0.0) - sum(phases.values()))
+
+    def unpack_response(self, response):
         self.handle_http_error(response)
-        self.response_body = response.text
-        common.deserialize(self.response_body, self.response)
+        if transport.is_streaming(response.headers):
+            self.records = Records(self.obj, response)
+            return
+        codec = self.response_codec(response)
+        encoding = response.headers.get("content-encoding")
+        limit = self.obj.api["max_response_size"]
+        if encoding:
+            self.response_body = self.decompress(
+                response.body, encoding, limit)
+            if not codec.binary:
+                self.response_body = self.response_body.decode("UTF-8")
+        elif limit is not None and len(response.body) > limit:
+            self.malformed_response(
+                "Body is larger than {}".format(limit))
+        elif codec.binary:
+            self.response_body = response.body
+        else:
+            self.response_body = response.text
+        codec.deserialize(self.response_body, self.response)
         self.handle_service_exception()
 
+    def decompress(self, body, encoding, limit):
+        ''' Decode a response, limited to limit bytes (None for no limit) '''
+        try:
+            return compression.decompress(
+                body, compression.encoding(encoding), limit)
+        except compression.DecodeError as exception:
+            self.malformed_response(exception)
+
+    def malformed_response(self, reason):
+        self.raise_exception({
+            "cls": "RequestException",
+            "args": ("Malformed response: {}".format(reason),)
+        })
+
+    def response_codec(self, response):
+        ''' The codec named by the response, or the client's codec '''
+        content_type = response.headers.get("content-type")
+        if content_type:
+            codec = self.obj.codecs.get(wsgi.media_type(content_type))
+            if codec is not None:
+                return codec
+        return self.obj.codec
+
     @property
     def result(self):
+        ''' The response, or an iterator of records for streamed responses '''
+        if self.records is not None:
+            return self.records
         return self.response
 
     def handle_http_error(self, response):
@@ -178,6 +612,12 @@ class ClientProcessor(Processor):
                 "args": (message,)
             })
 
+    def handle_transport_error(self, exception):
+        self.raise_exception({
+            "cls": "RequestException",
+            "args": (str(exception),)
+        })
+
     def handle_service_exception(self):
         exception = self.response.get("__exception__", None)
         if exception:
@@ -187,16 +627,133 @@ class ClientProcessor(Processor):
             self.raise_exception(exception)
 
     def raise_exception(self, exception):
-        name = exception["cls"]
-        args = exception["args"]
-        raise getattr(self.obj.exceptions, name)(*args)
+        raise_exception(self.obj, exception)
+
+
+def raise_exception(client, exception):
+    name = exception["cls"]
+    args = exception["args"]
+    raise getattr(client.exceptions, name)(*args)
+
+
+def load_record(client, line):
+    ''' Deserialize a streamed line, raising any exception it carries '''
+    record = common.Container()
+    common.deserialize(line.decode("UTF-8"), record)
+    exception = record.get("__exception__", None)
+    if exception:
+        raise_exception(client, exception)
+    return record
+
+
+class Records(object):
+    """
+    Iterator over the Containers of a streamed response.
+
+    Lines are read from the connection as the iterator is consumed, and the
+    connection is released once the stream is exhausted.  Closing the
+    iterator early (directly, by leaving a `with` block, or by dropping it)
+    discards the connection, even if iteration never started.
+    """
+    def __init__(self, client, response):
+        self.client = client
+        self.response = response
+        self.lines = response.iter_lines()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            for line in self.lines:
+                if line.strip():
+                    return load_record(self.client, line)
+        except transport.TransportError as exception:
+            self.close()
+            raise_exception(self.client, {
+                "cls": "RequestException",
+                "args": (str(exception),)
+            })
+        except BaseException:
+            self.close()
+            raise
+        raise StopIteration
+
+    def close(self):
+        self.lines.close()
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class AsyncRecords(Records):
+    """ Records for AsyncStreamedResponse, iterated with `async for` """
+    # Only async iteration reads from the connection without blocking
+    __iter__ = __next__ = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            async for line in self.lines:
+                if line.strip():
+                    return load_record(self.client, line)
+        except transport.TransportError as exception:
+            await self.aclose()
+            raise_exception(self.client, {
+                "cls": "RequestException",
+                "args": (str(exception),)
+            })
+        except BaseException:
+            await self.aclose()
+            raise
+        raise StopAsyncIteration
+
+    def close(self):
+        # The line generator is finalized by the event loop once it's
+        # collected; the connection can be discarded right away
+        self.response.close()
+
+    async def aclose(self):
+        await self.lines.aclose()
+        self.response.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
 
 
 class ServiceProcessor(Processor):
-    def __init__(self, service, operation, request_body):
-        super().__init__(service, operation)
+    # records is the iterator returned by streaming operations, cache_key
+    # is set when the response should be cached once it's serialized.
+    # flight is the coalescing.Flight this request leads, and following the
+    # one it's waiting on.
+    __slots__ = ("records", "request_codec", "response_codec", "cache_key",
+                 "flight", "following")
+
+    def __init__(self, service, operation, request_body,
+                 request_codec=codecs.JSON, response_codec=codecs.JSON,
+                 timings=None, deadline=None):
+        super().__init__(service, operation, timings=timings,
+                         deadline=deadline)
         self.context.service = service
         self.request_body = request_body
+        self.records = None
+        self.request_codec = request_codec
+        self.response_codec = response_codec
+        self.cache_key = None
+        self.flight = None
+        self.following = None
 
     def __call__(self):
         '''
@@ -206,36 +763,150 @@ class ServiceProcessor(Processor):
         to serialize back to the client, so we have to try/except the entire
         call chain.
         '''
+        start = time.perf_counter()
+        error = None
         try:
             # Don't need to persist the result since we'll
             # return self.result below anyway
             super().__call__()
+        except wsgi.DeadlineExceeded as exception:
+            # Answered with a 504, not serialized.  Requests waiting on
+            # this one have their own deadlines, so they aren't failed
+            error = exception
+            raise
         except Exception as exception:
+            error = exception
+            self.finish_flight(exception=exception)
             self.raise_exception(exception)
         finally:
-            return self.result
+            self.finish_flight()
+            self.record(start, error)
+        return self.result
+
+    def load_chain(self):
+        '''
+        Plugins and phases are timed when the request has timings, and
+        the deadline is checked between them when it has one
+        '''
+        context = self.context
+        return self.obj.chain(
+            self.__class__, timed=context.timings is not None,
+            deadline=context.deadline is not None)
 
     def _execute(self):
         '''
         Invoke the service's function for the current operation
+
+        Operations that return an iterator (ie. generators) stream their
+        records back instead of the response container.
         '''
         func = self.obj.functions[self.operation]
-        func(self.request, self.response, self.context)
+        records = func(self.request, self.response, self.context)
+        if is_iterator(records):
+            self.records = records
 
     def enter_scope(self, scope):
         # Unpack request_body so it's available to operation scoped plugins
         if scope == "operation":
-            common.deserialize(self.request_body, self.request)
+            # Streaming operations read the raw body themselves
+            if hasattr(self.request_body, "read"):
+                self.context.stream = self.request_body
+            else:
+                self.request_codec.deserialize(
+                    self.request_body, self.request)
+                return self.load_shared()
 
     def exit_scope(self, scope):
         # Pack response into response body so we can ship it back on the wire
         # It's important to do this before the request-scope plugins clean up,
         # since their scope may be required to serialize the response body
         if scope == "operation":
-            self.response_body = common.serialize(self.response)
+            self.pack_response()
+            if self.records is None:
+                if self.cache_key is not None:
+                    self.option("cache").set(
+                        self.cache_key, self.response_body)
+                self.finish_flight(body=self.response_body)
+
+    def option(self, name):
+        ''' The value of a Service.operation option for this operation '''
+        options = self.obj.options.get(self.operation)
+        return options and options.get(name)
+
+    def load_shared(self):
+        '''
+        Returns True when the response body was loaded from the operation's
+        cache, or from an identical request that was already in progress.
+        '''
+        cache = self.option("cache")
+        coalescer = self.option("coalescer")
+        if cache is None and coalescer is None:
+            return False
+        key = caching.canonical_key(
+            self.request, self.response_codec.content_type)
+        if key is None:
+            return False
+        if cache is not None:
+            body = cache.get(key)
+            if body is not None:
+                self.response_body = body
+                return True
+            self.cache_key = key
+        if coalescer is not None:
+            flight, leader = coalescer.join(key)
+            if leader:
+                self.flight = flight
+            else:
+                return self.follow(flight)
+        return False
+
+    def follow(self, flight):
+        ''' Wait for the request leading the flight to finish '''
+        if not flight.wait(self.follow_timeout()):
+            return self.stop_following()
+        return self.load_flight(flight)
+
+    def follow_timeout(self):
+        ''' Seconds to wait on a flight: until the deadline, or the timeout '''
+        deadline = self.context.deadline
+        if deadline is None:
+            return self.obj.api["timeout"]
+        return max(0.0, deadline - time.time())
+
+    def stop_following(self):
+        '''
+        The leader didn't finish in time.  Past the deadline the request
+        fails; without one, it's processed without waiting any longer.
+        '''
+        if self.context.deadline is not None:
+            raise wsgi.DEADLINE_EXCEEDED
+        return False
+
+    def load_flight(self, flight):
+        if flight.exception is not None:
+            raise flight.exception
+        if flight.body is None:
+            # The leader didn't produce a response to share
+            return False
+        self.response_body = flight.body
+        self.cache_key = None
+        return True
+
+    def finish_flight(self, body=None, exception=None):
+        ''' Release the requests waiting on the flight this one leads '''
+        flight, self.flight = self.flight, None
+        if flight is not None:
+            self.option("coalescer").finish(flight, body, exception)
+
+    def pack_response(self):
+        if self.records is None:
+            self.response_body = self.response_codec.serialize(self.response)
+        else:
+            self.response_body = serialize_records(self.obj, self.records)
 
     @property
     def result(self):
+        ''' A string, or an iterator of lines for streaming operations '''
         return self.response_body
 
     def raise_exception(self, exception):
@@ -243,20 +914,228 @@ class ServiceProcessor(Processor):
         Because this can occurr when exit_scope('operation') has already
         fired, we have to make sure we re-serialize the response body.
         '''
-        name = exception.__class__.__name__
-        args = exception.args
-
-        # Don't let non-whitelisted exceptions escape if we're not debugging
-        whitelisted = name in self.obj.api["exceptions"]
-        debugging = self.obj.api["debug"]
-        if not whitelisted and not debugging:
-            name = wsgi.INTERNAL_ERROR.__class__.__name__
-            args = wsgi.INTERNAL_ERROR.args
-
         # Don't leak incomplete operation state
+        self.records = None
         self.response.clear()
-        self.response["__exception__"] = {
-            "cls": name,
-            "args": args
-        }
-        self.response_body = common.serialize(self.response)
+        self.response["__exception__"] = exception_payload(
+            self.obj, exception)
+        self.pack_response()
+
+
+def is_iterator(value):
+    return hasattr(value, "__next__")
+
+
+def exception_payload(service, exception):
+    ''' Serializable description of an exception raised by a service '''
+    name = exception.__class__.__name__
+    args = exception.args
+
+    # Don't let non-whitelisted exceptions escape if we're not debugging
+    whitelisted = name in service.api["exceptions"]
+    debugging = service.api["debug"]
+    if not whitelisted and not debugging:
+        name = wsgi.INTERNAL_ERROR.__class__.__name__
+        args = wsgi.INTERNAL_ERROR.args
+    return {"cls": name, "args": args}
+
+
+def serialize_records(service, records):
+    '''
+    Yields one serialized line per record.  An exception while producing
+    records ends the stream with a final {"__exception__": ...} record.
+    '''
+    try:
+        for record in records:
+            yield common.serialize(record) + "\n"
+    except Exception as exception:
+        yield common.serialize(
+            {"__exception__": exception_payload(service, exception)}) + "\n"
+
+
+async def serialize_async_records(service, records):
+    ''' serialize_records for async iterators '''
+    try:
+        async for record in records:
+            yield common.serialize(record) + "\n"
+    except Exception as exception:
+        yield common.serialize(
+            {"__exception__": exception_payload(service, exception)}) + "\n"
+
+
+class BatchEntryProcessor(ServiceProcessor):
+    """
+    Processes a single entry of a batch request through the normal plugin
+    chain.
+
+    The entry's request is already deserialized as part of the batch, and
+    the response container is returned as-is so that the batch can be
+    serialized once.
+    """
+    __slots__ = ("entry_request",)
+
+    def __init__(self, service, operation, request, deadline=None):
+        super().__init__(service, operation, None, deadline=deadline)
+        self.entry_request = request
+
+    def __call__(self):
+        if self.operation not in self.obj.api["operations"]:
+            return unknown_operation()
+        return super().__call__()
+
+    def enter_scope(self, scope):
+        if scope == "operation":
+            self.request.update(self.entry_request)
+
+    def pack_response(self):
+        # Streamed records can't be interleaved with other entries
+        if self.records is not None:
+            self.response["records"] = list(self.records)
+
+    @property
+    def result(self):
+        return self.response
+
+
+def unknown_operation():
+    ''' Batch entry result for an operation the service doesn't expose '''
+    return {"__exception__": {
+        "cls": wsgi.UNKNOWN_OPERATION.__class__.__name__,
+        "args": wsgi.UNKNOWN_OPERATION.args
+    }}
+
+
+class AsyncClientProcessor(AsyncProcessor, ClientProcessor):
+    __slots__ = ()
+
+    async def __call__(self):
+        ''' See ClientProcessor.__call__ '''
+        start = time.perf_counter()
+        error = None
+        try:
+            return await super().__call__()
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            self.record(start, error)
+
+    async def _execute(self):
+        ''' Same as ClientProcessor._execute, awaiting the transport '''
+        clock = self.clock
+        try:
+            clock.switch("serialize")
+            uri, data, headers, timeout = self.pack_request()
+            clock.switch("transport")
+            try:
+                response = await self.obj.transport.send(
+                    uri, data, headers=headers, timeout=timeout)
+            except transport.TransportError as exception:
+                self.handle_transport_error(exception)
+            clock.switch("deserialize")
+            self.merge_timings(response)
+            self.unpack_response(response)
+        finally:
+            clock.switch(None)
+
+    def unpack_response(self, response):
+        if transport.is_streaming(response.headers):
+            self.handle_http_error(response)
+            self.records = AsyncRecords(self.obj, response)
+        else:
+            super().unpack_response(response)
+
+
+class AsyncServiceProcessor(AsyncProcessor, ServiceProcessor):
+    __slots__ = ()
+
+    async def __call__(self):
+        ''' See ServiceProcessor.__call__ '''
+        start = time.perf_counter()
+        error = None
+        try:
+            await super().__call__()
+        except wsgi.DeadlineExceeded as exception:
+            error = exception
+            raise
+        except Exception as exception:
+            error = exception
+            self.finish_flight(exception=exception)
+            self.raise_exception(exception)
+        finally:
+            self.finish_flight()
+            self.record(start, error)
+        return self.result
+
+    async def enter_scope_async(self, scope):
+        if self.enter_scope(scope):
+            return True
+        flight, self.following = self.following, None
+        if flight is None:
+            return False
+        if not await flight.wait_async(self.follow_timeout()):
+            return self.stop_following()
+        return self.load_flight(flight)
+
+    def follow(self, flight):
+        # Waited on by enter_scope_async, without blocking the event loop
+        self.following = flight
+        return False
+
+    async def _execute(self):
+        '''
+        Await coroutine operations directly.  Synchronous operations are run
+        on the service's executor so they don't block the event loop.
+        Batched operations wait on the loop, and run once per batch.
+        '''
+        func = self.obj.functions[self.operation]
+        if isinstance(func, batching.Batcher):
+            await func.call_async(
+                self.request, self.response, self.context, self.obj.executor)
+        elif inspect.iscoroutinefunction(func):
+            await func(self.request, self.response, self.context)
+        elif inspect.isasyncgenfunction(func):
+            self.records = func(self.request, self.response, self.context)
+        else:
+            loop = asyncio.get_running_loop()
+            records = await loop.run_in_executor(
+                self.obj.executor, func,
+                self.request, self.response, self.context)
+            if is_iterator(records):
+                self.records = iter_in_executor(self.obj.executor, records)
+
+    def pack_response(self):
+        if self.records is None:
+            self.response_body = self.response_codec.serialize(self.response)
+        else:
+            self.response_body = serialize_async_records(
+                self.obj, self.records)
+
+
+async def iter_in_executor(executor, records):
+    ''' Pull records from a blocking iterator without blocking the loop '''
+    loop = asyncio.get_running_loop()
+    records = iter(records)
+    done = object()
+    while True:
+        record = await loop.run_in_executor(executor, next, records, done)
+        if record is done:
+            return
+        yield record
+
+
+class AsyncBatchEntryProcessor(AsyncServiceProcessor, BatchEntryProcessor):
+    __slots__ = ()
+
+    async def __call__(self):
+        if self.operation not in self.obj.api["operations"]:
+            return unknown_operation()
+        return await super().__call__()
+
+    async def _execute(self):
+        await super()._execute()
+        # Collect streamed records here, since pack_response can't await
+        if self.records is not None:
+            self.records = [record async for record in self.records]
+
+    pack_response = BatchEntryProcessor.pack_response
@@ -0,0 +1,152 @@
+"""
+Profile single requests on demand.
+
+    service.profiler = Profiler(token, directory="/var/tmp/profiles")
+
+    curl -H "X-Profile: <token>" ...
+
+Requests carrying the profiler's token in the X-Profile header are
+processed (plugins, (de)serialization and the function) under a profiler.
+Other requests aren't affected.  The profile is written to the directory,
+or kept in profiler.profiles when there isn't one, and the response names
+it in an X-Profile-Id header.
+
+Profiles are either cProfile stats (mode="cprofile", load them with
+pstats.Stats) or collapsed stacks from sampling the request's thread
+(mode="sample"), one "root;...;leaf count" line per stack, for flame graph
+tools.
+"""
+import collections
+import cProfile
+import hmac
+import marshal
+import os
+import sys
+import threading
+import time
+
+HEADER = "X-Profile"
+ENVIRON_KEY = "HTTP_X_PROFILE"
+RESPONSE_HEADER = "X-Profile-Id"
+MODES = {"cprofile": ".prof", "sample": ".collapsed"}
+
+
+class Profiler(object):
+    """
+    Only one request is profiled at a time (the interpreter only supports
+    one active cProfile); others that ask while it's running are served
+    normally, without an X-Profile-Id.
+    """
+    def __init__(self, token, directory=None, mode="cprofile",
+                 interval=0.001, keep=16):
+        if not token:
+            raise ValueError("Profiler requires a token")
+        if mode not in MODES:
+            raise ValueError("Unknown mode {}".format(mode))
+        self.token = token.encode("UTF-8")
+        self.directory = directory
+        self.mode = mode
+        # Seconds between samples, when mode is "sample"
+        self.interval = interval
+        self.lock = threading.Lock()
+        # (name, data) of recent profiles, when there's no directory
+        self.profiles = collections.deque(maxlen=keep)
+        self.count = 0
+
+    def authorized(self, header):
+        ''' True when a request's X-Profile header matches the token '''
+        if not header:
+            return False
+        return hmac.compare_digest(header.encode("UTF-8"), self.token)
+
+    def run(self, operation, func, *args):
+        '''
+        Returns (func(*args), name) where name identifies the profile, or
+        is None when another request is already being profiled.
+        '''
+        if not self.lock.acquire(blocking=False):
+            return func(*args), None
+        try:
+            if self.mode == "cprofile":
+                result, data = self.run_cprofile(func, args)
+            else:
+                result, data = self.run_sampled(func, args)
+            return result, self.save(operation, data)
+        finally:
+            self.lock.release()
+
+    def run_cprofile(self, func, args):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            result = func(*args)
+        finally:
+            profile.disable()
+        profile.create_stats()
+        # Same format as Profile.dump_stats
+        return result, marshal.dumps(profile.stats)
+
+    def run_sampled(self, func, args):
+        sampler = Sampler(threading.get_ident(), self.interval)
+        sampler.start()
+        try:
+            result = func(*args)
+        finally:
+            sampler.stop()
+        return result, sampler.collapsed().encode("UTF-8")
+
+    def save(self, operation, data):
+        self.count += 1
+        name = "{}-{}-{}-{}{}".format(
+            time.strftime("%Y%m%dT%H%M%S"), os.getpid(), self.count,
+            operation, MODES[self.mode])
+        if self.directory is None:
+            self.profiles.append((name, data))
+        else:
+            with open(os.path.join(self.directory, name), "wb") as file:
+                file.write(data)
+        return name
+
+
+class Sampler(object):
+    """ Counts the stacks of another thread, sampled every interval """
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is not None:
+            self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self):
+        ''' One "root;...;leaf count" line per stack, most common first '''
+        return "".join(
+            "{} {}\n".format(stack, count)
+            for stack, count in self.stacks.most_common())
+
+
+def collapse(frame):
+    ''' "root;...;leaf" for the stack ending in frame '''
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(
+            code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
@@ -0,0 +1,227 @@
+"""
+Replay captured traffic (see pyservice.capture) against a Service, and
+report how its latency compares to when the traffic was captured, or to an
+earlier replay.
+
+    from pyservice.replay import Replay, format_report
+
+    replay = Replay(service, capture.read(*capture.files(path)), speed=2)
+    print(format_report(replay.run()))
+
+or from the command line:
+
+    python -m pyservice.replay myapp:service /var/log/app/capture \\
+        --speed 2 --json new.json --baseline old.json
+
+Requests are fed through service.wsgi_application in-process unless host
+and port are given, in which case they're POSTed to the service running
+there.  They're sent at the captured pace, scaled by speed (2 is twice as
+fast); speed 0 sends them as fast as the workers can.
+
+Captured durations only cover the service's plugins and function, while
+replayed ones also include reading the body, serializing the response and
+(over HTTP) the network.  Comparing against a baseline replay of the same
+log is apples to apples, and the better check for regressions.
+"""
+import argparse
+import io
+import sys
+import ujson
+from . import capture
+from . import common
+from . import loadtest
+
+
+class Replay(object):
+    """
+    records is an iterable of capture.Record, in the order they were
+    captured.  Records for operations the service doesn't have are sent
+    anyway, and reported as errors.
+    """
+    def __init__(self, service, records, speed=1.0, workers=8,
+                 host=None, port=None):
+        self.service = service
+        self.records = list(records)
+        self.speed = speed
+        self.workers = workers
+        self.host = host
+        self.port = port
+
+    def run(self):
+        ''' Returns the report, see Replay.report '''
+        call = self.wsgi_call() if self.host is None else self.http_call()
+        samples, start = loadtest.drive(
+            self.schedule(), call, self.workers)
+        return self.report(samples, start)
+
+    def schedule(self):
+        ''' (offset, operation, record) at the captured pace, see drive '''
+        if not self.records:
+            return
+        first = self.records[0].timestamp
+        for record in self.records:
+            offset = 0
+            if self.speed:
+                offset = max(record.timestamp - first, 0) / self.speed
+            yield offset, record.operation, record
+
+    def wsgi_call(self):
+        ''' Call the service's wsgi_application in-process '''
+        pattern = self.service.api["endpoint"]["pattern"]
+        exceptions = common.ExceptionFactory()
+
+        def call(operation, record):
+            environ = {
+                "REQUEST_METHOD": "POST",
+                "PATH_INFO": pattern.format(operation=operation),
+                "CONTENT_TYPE": record.content_type,
+                "CONTENT_LENGTH": str(len(record.body)),
+                # Errors are only recognized in JSON responses
+                "HTTP_ACCEPT": "application/json",
+                "wsgi.input": io.BytesIO(record.body)
+            }
+            response = {}
+
+            def start_response(status, headers):
+                response["status"] = status
+            body = b"".join(
+                self.service.wsgi_application(environ, start_response))
+            code, _, reason = response["status"].partition(" ")
+            loadtest.check(int(code), reason, body, exceptions)
+        return call
+
+    def http_call(self):
+        ''' POST to the service at host:port, one connection per thread '''
+        pattern = self.service.api["endpoint"]["pattern"]
+        post = loadtest.http_post(
+            self.host, self.port, self.service.api["timeout"])
+
+        def call(operation, record):
+            post(pattern.format(operation=operation), record.body,
+                 {"Content-Type": record.content_type,
+                  "Accept": "application/json"})
+        return call
+
+    def report(self, samples, start):
+        '''
+        {
+            "speed": replay speed,
+            "duration": seconds until the last response,
+            "requests": total,
+            "operations": {
+                name: {
+                    "requests",
+                    "errors": {exception class: count},
+                    "captured": {"p50", "p90", "p99", "p99.9", "max"},
+                    "replayed": (same, time to serve each request),
+                    "latency": (same, including time queued for a worker),
+                    "delta": replayed - captured, for each percentile
+                }
+            }
+        }
+        Latencies are in milliseconds.
+        '''
+        end = max((sample[3] for sample in samples), default=start)
+        captured = {}
+        for record in self.records:
+            captured.setdefault(record.operation, []).append(record.duration)
+        by_operation = {}
+        for sample in samples:
+            by_operation.setdefault(sample[0], []).append(sample)
+        operations = {}
+        for operation, entries in sorted(by_operation.items()):
+            errors = {}
+            for entry in entries:
+                if entry[4] is not None:
+                    errors[entry[4]] = errors.get(entry[4], 0) + 1
+            stats = operations[operation] = {
+                "requests": len(entries),
+                "errors": errors,
+                "captured": loadtest.summary(captured[operation]),
+                "replayed": loadtest.summary(
+                    [finished - started
+                     for _, _, started, finished, _ in entries]),
+                "latency": loadtest.summary(
+                    [finished - scheduled
+                     for _, scheduled, _, finished, _ in entries])
+            }
+            stats["delta"] = delta(stats["replayed"], stats["captured"])
+        return {
+            "speed": self.speed,
+            "duration": end - start,
+            "requests": len(samples),
+            "operations": operations
+        }
+
+
+def delta(after, before):
+    return {column: after[column] - before[column] for column in after}
+
+
+def compare(report, baseline):
+    '''
+    Set each operation's "delta" against the "replayed" latencies of the
+    same operation in a baseline report, instead of the captured ones.
+    Operations missing from the baseline keep their captured delta.
+    '''
+    for operation, stats in report["operations"].items():
+        previous = baseline["operations"].get(operation)
+        if previous is not None:
+            stats["delta"] = delta(stats["replayed"], previous["replayed"])
+    report["baseline"] = True
+    return report
+
+
+def format_report(report):
+    reference = "baseline" if report.get("baseline") else "captured"
+    lines = ["{} requests in {:.2f}s (speed {:g}), delta against {}".format(
+        report["requests"], report["duration"], report["speed"], reference)]
+    columns = ["p{:g}".format(p) for p in loadtest.PERCENTILES] + ["max"]
+    lines.append("{:24} {:>8} {:>8}  {}".format(
+        "operation", "requests", "errors",
+        " ".join("{:>10}".format(column) for column in columns)))
+    for operation, stats in report["operations"].items():
+        lines.append("{:24} {:>8} {:>8}  {}".format(
+            operation, stats["requests"], sum(stats["errors"].values()),
+            " ".join("{:>8.2f}ms".format(stats["replayed"][column])
+                     for column in columns)))
+        lines.append("{:24} {:>8} {:>8}  {}".format(
+            "  (delta)", "", "", " ".join(
+                "{:>+8.2f}ms".format(stats["delta"][column])
+                for column in columns)))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pyservice.replay",
+        description="Replay captured traffic against a pyservice Service")
+    parser.add_argument("service", help="module:attribute of the Service")
+    parser.add_argument("log", help="capture log, with its rotated backups")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="multiple of the captured pace, 0 for no delay")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--host", help="replay to a service that's running")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--json", metavar="PATH", help="save the report")
+    parser.add_argument("--baseline", metavar="PATH",
+                        help="report from an earlier replay to compare to")
+    args = parser.parse_args(argv)
+
+    records = capture.read(*capture.files(args.log))
+    replay = Replay(
+        common.load(args.service), records, speed=args.speed,
+        workers=args.workers, host=args.host, port=args.port)
+    report = replay.run()
+    if args.json:
+        with open(args.json, "w") as file:
+            file.write(ujson.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(report, ujson.loads(file.read()))
+    print(format_report(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
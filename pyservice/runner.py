@@ -0,0 +1,442 @@
+"""
+Pre-forking server for a Service (or any WSGI application).
+
+    python -m pyservice.runner myapp:service --port 8080 --workers 8 --pin
+
+The application is imported once, in the master process.  Before workers
+are forked its plugin chains are compiled, the warm hook runs, and
+gc.freeze() moves everything allocated so far out of the collector's
+reach.  Collections in the workers then never write to (and so copy) the
+master's pages, and the imported modules are shared copy-on-write by every
+worker instead of each importing its own.  The collector is disabled
+from warming until the workers are forked, so it doesn't leave holes in
+those pages either, and re-enabled in the master once they are.
+
+Workers accept from one listening socket that the master opens with
+SO_REUSEPORT.  With reuse_port each worker listens on its own socket in the
+port's group instead, and the kernel spreads connections between them
+(connections still queued on a worker's socket when it stops are reset).
+pin gives each worker its own CPU, where the platform supports it.
+
+Signals to the master:
+
+    TERM, INT   stop accepting, let workers finish their requests, exit
+    HUP         graceful reload: re-import the application's package (when
+                it was given as "module:attribute"), fork new workers and
+                stop the old ones once they finish their requests
+    QUIT        stop immediately
+
+Workers that die are replaced, after a second if they died within a second
+of starting, so a broken application doesn't fork in a loop.  Threads
+don't survive fork: start anything that needs one (ie. a Watchdog) in the
+post_fork hook, which is called in each worker with (app, index).
+"""
+import argparse
+import gc
+import importlib
+import logging
+import os
+import select
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import wsgiref.simple_server
+from . import common
+from . import processors
+
+logger = logging.getLogger("pyservice.runner")
+access_logger = logging.getLogger("pyservice.runner.access")
+
+# Seconds a worker has to run before dying counts as a crash
+MIN_UPTIME = 1.0
+
+
+class Handler(wsgiref.simple_server.WSGIRequestHandler):
+    ''' Access log to "pyservice.runner.access" instead of stderr '''
+    def log_message(self, format, *args):
+        access_logger.info("%s " + format, self.address_string(), *args)
+
+
+class WSGIServer(wsgiref.simple_server.WSGIServer):
+    ''' Serves an application on a socket that's already listening '''
+    def __init__(self, sock, app, handler=Handler):
+        super().__init__(sock.getsockname()[:2], handler,
+                         bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        host, self.server_port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.setup_environ()
+        self.set_app(app)
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    # server_close waits for requests in progress
+    daemon_threads = False
+
+
+class Worker(object):
+    """ The master's record of a worker process """
+    __slots__ = ("index", "generation", "pid", "started", "deadline")
+
+    def __init__(self, index, generation, pid):
+        self.index = index
+        self.generation = generation
+        self.pid = pid
+        self.started = time.monotonic()
+        # Killed if it's still running after this, once asked to stop
+        self.deadline = None
+
+
+class Runner(object):
+    """
+    app is a Service (or any WSGI application), or "module:attribute" to
+    import one from.
+    workers defaults to the number of CPUs.  threaded workers serve each
+    request on its own thread; otherwise they serve one at a time.
+
+    pin is True to pin each worker to one of the CPUs this process may run
+    on, or a list of CPUs to pin them to.  warm is called with the app
+    before workers are forked.  Workers that are asked to stop have
+    timeout seconds to finish their requests.
+    """
+    def __init__(self, app, host="127.0.0.1", port=8000, workers=None,
+                 threaded=False, reuse_port=False, pin=False, warm=None,
+                 post_fork=None, timeout=30, backlog=1024):
+        self.target = None
+        if isinstance(app, str):
+            self.target = app
+            app = common.load(app)
+        self.app = app
+        self.host = host
+        self.port = port
+        self.address = None
+        self.workers = workers or os.cpu_count() or 1
+        self.threaded = threaded
+        self.reuse_port = reuse_port
+        self.cpus = cpus(pin)
+        self.warm = warm
+        self.post_fork = post_fork
+        self.timeout = timeout
+        self.backlog = backlog
+        self.socket = None
+        # pid -> Worker
+        self.children = {}
+        # index -> when to restart the worker that crashed there
+        self.restarts = {}
+        self.generation = 0
+        self.signals = []
+        self.wakeup = None
+        self.stopping = False
+
+    def listen(self):
+        '''
+        Open the socket workers accept from, or only bind it when they
+        listen on their own.  Returns the (host, port) it's bound to.
+        '''
+        if self.socket is None:
+            self.socket = bind(self.host, self.port)
+            if not self.reuse_port:
+                self.socket.listen(self.backlog)
+                # Every worker wakes for a new connection; the ones that
+                # lose the race to accept it shouldn't block
+                self.socket.setblocking(False)
+            self.address = self.socket.getsockname()[:2]
+        return self.address
+
+    def run(self):
+        ''' Serve until the master is told to stop '''
+        self.listen()
+        self.install()
+        try:
+            logger.info("Listening on %s:%d with %d workers",
+                        self.address[0], self.address[1], self.workers)
+            self.fork_workers()
+            self.supervise()
+        finally:
+            self.uninstall()
+            self.socket.close()
+            self.socket = None
+
+    def fork_workers(self):
+        '''
+        Prepare the app and fork a worker for every index.  The collector is
+        off from warming until the workers are forked, so it doesn't leave
+        holes in the pages they share; the master turns it back on after.
+        '''
+        gc.disable()
+        try:
+            self.prepare()
+            for index in range(self.workers):
+                self.spawn(index)
+        finally:
+            gc.enable()
+
+    def prepare(self):
+        ''' Warm the app, then freeze the heap the workers will share '''
+        compile_chains(self.app)
+        if self.warm is not None:
+            self.warm(self.app)
+        gc.freeze()
+
+    def install(self):
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup[1])
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                       signal.SIGQUIT, signal.SIGCHLD):
+            signal.signal(signum, self.handle)
+
+    def uninstall(self):
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                       signal.SIGQUIT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        for fd in self.wakeup:
+            os.close(fd)
+
+    def handle(self, signum, frame):
+        self.signals.append(signum)
+
+    def supervise(self):
+        while self.children or not self.stopping:
+            select.select([self.wakeup[0]], [], [], 1.0)
+            try:
+                os.read(self.wakeup[0], 1024)
+            except BlockingIOError:
+                pass
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                elif signum == signal.SIGQUIT:
+                    self.stop(graceful=False)
+                elif signum == signal.SIGHUP and not self.stopping:
+                    self.reload()
+            self.reap()
+            self.enforce_deadlines()
+            self.restart()
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid:
+            worker = self.children[pid] = Worker(index, self.generation, pid)
+            logger.info("Started worker %d (pid %d)", index, pid)
+            return worker
+        code = 1
+        try:
+            self.serve(index)
+            code = 0
+        except BaseException:
+            logger.exception("Worker %d failed", index)
+        finally:
+            os._exit(code)
+
+    def serve(self, index):
+        ''' Runs in the worker until it's asked to stop '''
+        master = os.getppid()
+        stopped = threading.Event()
+        signal.set_wakeup_fd(-1)
+        for fd in self.wakeup:
+            os.close(fd)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+        for signum in (signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_IGN)
+        for signum in (signal.SIGQUIT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        gc.enable()
+        if self.cpus:
+            os.sched_setaffinity(0, {self.cpus[index % len(self.cpus)]})
+
+        sock = self.socket
+        if self.reuse_port:
+            sock = bind(*self.address)
+            sock.listen(self.backlog)
+            self.socket.close()
+        server_class = ThreadingWSGIServer if self.threaded else WSGIServer
+        # Services and Dispatchers, or any other WSGI application
+        app = getattr(self.app, "wsgi_application", self.app)
+        server = server_class(sock, app)
+        if self.post_fork is not None:
+            self.post_fork(self.app, index)
+        thread = threading.Thread(target=server.serve_forever, args=(0.5,))
+        thread.start()
+        # Don't outlive the master
+        while not stopped.wait(1.0) and os.getppid() == master:
+            pass
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:  # pragma: no cover
+                return
+            if not pid:
+                return
+            worker = self.children.pop(pid, None)
+            if worker is None:  # pragma: no cover
+                continue
+            expected = (self.stopping or worker.deadline is not None or
+                        worker.generation != self.generation)
+            if expected:
+                logger.info("Worker %d (pid %d) stopped", worker.index, pid)
+                continue
+            logger.warning("Worker %d (pid %d) died with status %d",
+                           worker.index, pid, status)
+            delay = 0
+            if time.monotonic() - worker.started < MIN_UPTIME:
+                delay = MIN_UPTIME
+            self.restarts[worker.index] = time.monotonic() + delay
+
+    def restart(self):
+        now = time.monotonic()
+        for index, due in list(self.restarts.items()):
+            if self.stopping:
+                self.restarts.clear()
+            elif due <= now:
+                del self.restarts[index]
+                self.spawn(index)
+
+    def reload(self):
+        '''
+        Fork a new generation of workers from a freshly imported app, then
+        stop the old ones gracefully.  When the import fails the old
+        workers keep serving.
+        '''
+        if self.target is not None:
+            gc.unfreeze()
+            unload(self.target)
+            gc.collect()
+            try:
+                self.app = common.load(self.target)
+            except Exception:
+                logger.exception("Reload failed, keeping the old workers")
+                gc.freeze()
+                return
+        old = list(self.children.values())
+        self.generation += 1
+        self.restarts.clear()
+        self.fork_workers()
+        self.terminate(old)
+        logger.info("Reloaded, generation %d", self.generation)
+
+    def stop(self, graceful=True):
+        self.stopping = True
+        self.restarts.clear()
+        if graceful:
+            self.terminate(self.children.values())
+        else:
+            for worker in self.children.values():
+                kill(worker.pid, signal.SIGKILL)
+
+    def terminate(self, workers):
+        ''' Ask workers to stop, and kill them if they take too long '''
+        deadline = time.monotonic() + self.timeout
+        for worker in workers:
+            if worker.deadline is None:
+                worker.deadline = deadline
+                kill(worker.pid, signal.SIGTERM)
+
+    def enforce_deadlines(self):
+        now = time.monotonic()
+        for worker in self.children.values():
+            if worker.deadline is not None and worker.deadline < now:
+                logger.warning("Killing worker %d (pid %d)",
+                               worker.index, worker.pid)
+                kill(worker.pid, signal.SIGKILL)
+
+
+def bind(host, port):
+    ''' A socket bound with SO_REUSEADDR and SO_REUSEPORT '''
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def cpus(pin):
+    ''' CPUs to pin workers to, or None '''
+    if not pin:
+        return None
+    if not hasattr(os, "sched_setaffinity"):  # pragma: no cover
+        logger.warning("CPU pinning isn't supported on this platform")
+        return None
+    if pin is True:
+        return sorted(os.sched_getaffinity(0))
+    return list(pin)
+
+
+def compile_chains(app):
+    ''' Compile a Service's plugin chains, so workers share them '''
+    chain = getattr(app, "chain", None)
+    if chain is None:
+        return
+    timings = [False, True] if app.api["server_timing"] else [False]
+    deadlines = [False, True] if app.api["deadline"] else [False]
+    for processor in (processors.ServiceProcessor,
+                      processors.BatchEntryProcessor):
+        for timed in timings:
+            for deadline in deadlines:
+                chain(processor, timed, deadline)
+
+
+def kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:  # pragma: no cover
+        pass
+
+
+def unload(target):
+    ''' Forget the target's top-level package, so it's imported again '''
+    package = target.partition(":")[0].split(".")[0]
+    for name in list(sys.modules):
+        if name == package or name.startswith(package + "."):
+            del sys.modules[name]
+    importlib.invalidate_caches()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pyservice.runner",
+        description="Pre-forking server for a pyservice Service")
+    parser.add_argument("app", help="module:attribute of the application")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--threaded", action="store_true",
+                        help="serve each request on its own thread")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="one listening socket per worker")
+    parser.add_argument("--pin", action="store_true",
+                        help="pin each worker to a CPU")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds workers have to finish when stopping")
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(process)d] %(message)s")
+    if not args.access_log:
+        access_logger.setLevel(logging.WARNING)
+    runner = Runner(
+        args.app, host=args.host, port=args.port, workers=args.workers,
+        threaded=args.threaded, reuse_port=args.reuse_port, pin=args.pin,
+        timeout=args.timeout)
+    runner.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
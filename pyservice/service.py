@@ -1,52 +1,241 @@
+import concurrent.futures
+from . import asgi
+from . import batching
+from . import coalescing
+from . import codecs
 from . import common
+from . import deadlines
+from . import metrics
 from . import processors
+from . import profiling
 from . import wsgi
 
 
 class Service(object):
     # Processor class to use when handling WSGI operations.
     # Invoked as:
-    #   response = __process__(service, operation, body)
+    #   response = __process__(
+    #       service, operation, body, request_codec, response_codec, timings,
+    #       deadline)
+    # where timings is a dict to record phases in, or None, and deadline is
+    # the unix time the caller stops waiting, or None
     __process__ = processors.service
+    # Coroutine equivalent of __process__, used by asgi_application
+    __async_process__ = processors.async_service
+
+    # Maximum number of threads used to run synchronous operations
+    # when serving through asgi_application
+    __workers__ = 16
+
+    # Codecs the service understands, by content type.  Each request is
+    # decoded by its Content-Type, and encoded by its Accept header.
+    __codecs__ = (codecs.JSON, codecs.MSGPACK)
+
+    # Registry that every request is recorded in, see metrics.Metrics.
+    # None disables metrics.
+    __metrics__ = metrics.Metrics
 
     def __init__(self, **api):
         self.api = api
         common.load_defaults(api)
         # Inserts regex at api["endpoint"]["service_pattern"]
         common.construct_service_pattern(api["endpoint"])
+        # Request path -> operation, see wsgi.route
+        self.routes = common.construct_routes(
+            api["endpoint"], api["operations"])
 
         self.plugins = {
             "request": [],
             "operation": []
         }
+        # Compiled plugin chains by processor class, see Processor.compile
+        self.chains = {}
         self.functions = {}
+        # Options passed to Service.operation, by operation name
+        self.options = {}
         self.exceptions = common.ExceptionFactory()
+        self.codecs = {codec.content_type: codec for codec in self.__codecs__}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.__workers__)
+        self.metrics = self.__metrics__ and self.__metrics__()
+        # profiling.Profiler for requests that ask to be profiled, if any
+        self.profiler = None
+        # watchdog.Watchdog that samples slow wsgi requests, if any
+        self.watchdog = None
+        if api["expose_metrics"] and self.metrics is not None:
+            common.add_route(
+                self.routes, api["endpoint"], common.METRICS_OPERATION)
 
     def plugin(self, scope, *, func=None):
+        '''
+        Register a plugin.  Plugins should only be added through this
+        method, so that compiled chains are rebuilt.
+        '''
         if scope not in ["request", "operation"]:
             raise ValueError("Unknown scope {}".format(scope))
         # Return decorator that takes function
         if not func:
             return lambda func: self.plugin(scope=scope, func=func)
         self.plugins[scope].append(func)
+        self.chains.clear()
         return func
 
-    def operation(self, name, *, func=None):
+    def chain(self, processor, timed=False, deadline=False):
+        '''
+        Returns the compiled plugin chain for a processor class.  Timed
+        chains record each phase of the request, see timing.  deadline
+        chains stop between steps once the request's deadline passes.
+        '''
+        key = (processor, timed, deadline)
+        chain = self.chains.get(key)
+        if chain is None:
+            compile = processor.compile_timed if timed else processor.compile
+            chain = compile(self.plugins)
+            if deadline:
+                chain = processor.compile_deadline(chain)
+            self.chains[key] = chain
+        return chain
+
+    def deadline(self, req):
+        '''
+        The request's deadline, if the service honors them.  Requests that
+        arrive after it are answered with a 504 before reading the body.
+        '''
+        if not self.api["deadline"]:
+            return None
+        deadline = req.deadline
+        if deadlines.expired(deadline):
+            raise wsgi.DEADLINE_EXCEEDED
+        return deadline
+
+    def operation(self, name, *, func=None,
+                  batched=False, max_batch=32, max_wait_ms=5,
+                  max_body_size=None, stream=False, cache=None,
+                  coalesce=False):
+        '''
+        Bind a function to an operation.
+
+        When batched is True, concurrent requests are collected into batches
+        of up to max_batch requests, waiting at most max_wait_ms for a batch
+        to fill.  The function is called once per batch with lists:
+            func(requests, responses, contexts)
+        Under asgi it may be a coroutine function.
+
+        max_body_size overrides api["max_body_size"] for this operation.
+        When stream is True the request body isn't deserialized; instead
+        context.stream is a binary file of the raw body.  Large streamed
+        bodies are spooled to disk rather than held in memory.
+
+        cache is a caching.Cache for serialized responses, keyed on the
+        request.  Cache hits skip operation plugins and the function.
+
+        When coalesce is True, identical requests that arrive while one is
+        in progress wait for and share its response, instead of running
+        the operation again.
+        '''
         if name not in self.api["operations"]:
             raise ValueError("Unknown operation {}".format(name))
+        # The operation may have been added to the api after __init__
+        common.add_route(self.routes, self.api["endpoint"], name)
+        if stream and (cache is not None or coalesce):
+            raise ValueError(
+                "Streaming operations can't be cached or coalesced")
+        options = {
+            "batched": batched,
+            "max_batch": max_batch,
+            "max_wait_ms": max_wait_ms,
+            "max_body_size": max_body_size,
+            "stream": stream,
+            "cache": cache,
+            "coalesce": coalesce
+        }
         # Return decorator that takes function
         if not func:
-            return lambda func: self.operation(name=name, func=func)
-        self.functions[name] = func
+            return lambda func: self.operation(name, func=func, **options)
+        if batched:
+            self.functions[name] = batching.Batcher(
+                func, max_batch, max_wait_ms)
+        else:
+            self.functions[name] = func
+        self.options[name] = options
+        if coalesce:
+            self.options[name]["coalescer"] = coalescing.Coalescer()
         return func
 
+    def body_options(self, operation):
+        ''' Returns (max_body_size, stream) for an operation's requests '''
+        options = self.options.get(operation)
+        if options is None:
+            return self.api["max_body_size"], False
+        max_size = options["max_body_size"] or self.api["max_body_size"]
+        return max_size, options["stream"]
+
+    def compression(self, encoding):
+        '''
+        Returns (encoding, level, min_size) for compressing a response in
+        the negotiated encoding, or None when responses aren't compressed.
+        '''
+        min_size = self.api["compress_min_size"]
+        if encoding is None or min_size is None:
+            return None
+        return encoding, self.api["compress_level"], min_size
+
+    def timings(self):
+        ''' A dict to record the phases of a request in, if enabled '''
+        return {} if self.api["server_timing"] else None
+
+    def process(self, environ, resp, operation, body, *args):
+        '''
+        __process__ for a wsgi request, under the watchdog and profiler
+        when they're enabled
+        '''
+        watchdog = self.watchdog
+        if watchdog is not None:
+            watched = watchdog.watch(operation, metrics.size(body))
+        try:
+            if not self.profiling(environ):
+                return self.__process__(operation, body, *args)
+            result, name = self.profiler.run(
+                operation, self.__process__, operation, body, *args)
+            if name is not None:
+                resp.headers.append((profiling.RESPONSE_HEADER, name))
+            return result
+        finally:
+            if watchdog is not None:
+                watchdog.release(watched)
+
+    def profiling(self, environ):
+        ''' True when a wsgi request carries the profiler's token '''
+        return self.profiler is not None and self.profiler.authorized(
+            environ.get(profiling.ENVIRON_KEY))
+
+    def scrape(self, resp):
+        ''' Respond with the service's metrics; the body isn't read '''
+        resp.content_type = metrics.CONTENT_TYPE
+        resp.body = self.metrics.render()
+
     def wsgi_application(self, environ, start_response):
         # environ isn't validated until we ask for operation or body
         req = wsgi.Request(self, environ)
         resp = wsgi.Response(start_response)
 
         try:
-            resp.body = self.__process__(req.operation, req.body)
+            operation = req.operation
+            if operation == common.METRICS_OPERATION:
+                self.scrape(resp)
+            else:
+                request_codec, response_codec = req.codecs
+                resp.content_type = response_codec.content_type
+                resp.compression = self.compression(req.encoding)
+                resp.timings = timings = self.timings()
+                deadline = self.deadline(req)
+                clock = processors.Clock(timings)
+                clock.switch("read")
+                body = req.body
+                clock.switch(None)
+                resp.body = self.process(
+                    req.environ, resp, operation, body, request_codec,
+                    response_codec, timings, deadline)
         except Exception as exception:
             # Defined failure case -
             # invalid body, unknown path/operation
@@ -56,4 +245,50 @@ class Service(object):
             else:
                 resp.exception(wsgi.INTERNAL_ERROR)
         finally:
-            return resp.send()
+            body = resp.send()
+            if isinstance(body, list):
+                req.close()
+                return body
+            # Streamed records may still read the request as they're sent
+            return wsgi.ClosingIterator(body, req.close)
+
+    async def asgi_application(self, scope, receive, send):
+        '''
+        ASGI entry point.
+
+        Operations may be coroutine functions, which are awaited on the event
+        loop, or regular functions, which run on self.executor.  Plugins
+        must be coroutine functions that await context.process_request().
+        '''
+        if scope["type"] == "lifespan":
+            return await asgi.lifespan(receive, send)
+        req = asgi.Request(self, scope, receive)
+        resp = asgi.Response(send)
+
+        try:
+            try:
+                operation = req.operation
+                if operation == common.METRICS_OPERATION:
+                    self.scrape(resp)
+                else:
+                    request_codec, response_codec = req.codecs
+                    resp.content_type = response_codec.content_type
+                    resp.compression = self.compression(req.encoding)
+                    resp.timings = timings = self.timings()
+                    deadline = self.deadline(req)
+                    clock = processors.Clock(timings)
+                    clock.switch("read")
+                    body = await req.body(*self.body_options(operation))
+                    clock.switch(None)
+                    resp.body = await self.__async_process__(
+                        operation, body, request_codec, response_codec,
+                        timings, deadline)
+            except Exception as exception:
+                if isinstance(exception, wsgi.RequestException):
+                    resp.exception(exception)
+                else:
+                    resp.exception(wsgi.INTERNAL_ERROR)
+            # Streamed records may still read the request as they're sent
+            await resp.send()
+        finally:
+            req.close()
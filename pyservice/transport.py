@@ -0,0 +1,546 @@
+"""
+Transports are responsible for moving a serialized request body to a service
+endpoint and returning the raw response.  Clients hold a single transport
+which may be shared across threads.
+
+The interface is intentionally small, so that alternate implementations
+(different http libraries, test doubles, in-process calls) only need to
+implement `send`:
+
+    response = transport.send(uri, body, headers=None, timeout=None)
+
+where the returned object exposes `status_code`, `reason`, `headers` and
+`text`.  Async transports implement the same interface with a coroutine:
+
+    response = await transport.send(uri, body, headers=None, timeout=None)
+"""
+import asyncio
+import collections
+import functools
+import http.client
+import threading
+import time
+import urllib.parse
+
+
+class TransportError(Exception):
+    """Wraps connection failures, timeouts and malformed responses."""
+
+
+class Response(object):
+    """
+    Raw response returned from a transport.
+
+    Headers are stored with lowercase names.
+    """
+    def __init__(self, status_code, reason, headers, body):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    @property
+    def text(self):
+        return self.body.decode("UTF-8")
+
+
+# Responses with these content types are streamed line by line instead of
+# being read in full.
+STREAMING_TYPES = {"application/x-ndjson"}
+
+
+def is_streaming(headers):
+    content_type = headers.get("content-type", "")
+    return content_type.split(";", 1)[0].strip() in STREAMING_TYPES
+
+
+class StreamedResponse(Response):
+    """
+    Response whose body is read lazily, one line at a time.
+
+    The connection is returned to its pool once every line has been read;
+    closing the response early discards the connection.
+    """
+    def __init__(self, status_code, reason, headers, raw, release, discard):
+        super().__init__(status_code, reason, headers, None)
+        self.raw = raw
+        self.release = release
+        self.discard = discard
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = b"".join(self.iter_lines())
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    def iter_lines(self):
+        try:
+            line = self.raw.readline()
+            while line:
+                yield line
+                line = self.raw.readline()
+        except (OSError, http.client.HTTPException) as exception:
+            self.close()
+            raise TransportError(str(exception)) from exception
+        except BaseException:
+            self.close()
+            raise
+        # Before 3.13, readline() doesn't mark a Content-Length response
+        # complete, and the connection refuses new requests until it is.
+        self.raw.close()
+        self.finish(self.release)
+
+    def finish(self, callback):
+        if self.raw is not None:
+            self.raw = None
+            callback()
+
+    def close(self):
+        self.finish(self.discard)
+
+
+class Transport(object):
+    def send(self, uri, body, headers=None, timeout=None):  # pragma: no cover
+        raise NotImplementedError("Subclasses must implement send.")
+
+    def close(self):  # pragma: no cover
+        ''' Release any resources held by the transport '''
+        pass
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive connections to a single host.
+
+    pool_size - maximum number of idle connections to keep open
+    max_connections - maximum number of connections (idle or in use) at any
+        time.  When exhausted, callers block until a connection is returned.
+        None for no limit.
+    idle_timeout - idle connections older than this (in seconds) are closed
+        instead of being reused.  None to keep connections forever.
+    """
+    def __init__(self, factory, pool_size, max_connections, idle_timeout):
+        self.factory = factory
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        # (connection, last used) pairs; the right side is the most recently
+        # released, so expired connections collect on the left.
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+        self.slots = None
+        if max_connections is not None:
+            self.slots = threading.BoundedSemaphore(max_connections)
+
+    def acquire(self, timeout=None):
+        '''
+        Returns a (connection, reused) tuple.
+
+        Raises TransportError when max_connections are in use and none are
+        released within timeout seconds.
+        '''
+        if self.slots and not self.slots.acquire(timeout=timeout):
+            raise TransportError("Timed out waiting for a free connection")
+        with self.lock:
+            self._reap(time.monotonic())
+            if self.idle:
+                return self.idle.pop()[0], True
+        return self.factory(), False
+
+    def release(self, connection):
+        ''' Return a healthy connection to the pool '''
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append((connection, time.monotonic()))
+                connection = None
+        if connection:
+            connection.close()
+        if self.slots:
+            self.slots.release()
+
+    def discard(self, connection):
+        ''' Close a broken connection and free its slot '''
+        connection.close()
+        if self.slots:
+            self.slots.release()
+
+    def reap(self):
+        ''' Close any connections that have been idle too long '''
+        with self.lock:
+            self._reap(time.monotonic())
+
+    def _reap(self, now):
+        if self.idle_timeout is None:
+            return
+        while self.idle and now - self.idle[0][1] > self.idle_timeout:
+            self.idle.popleft()[0].close()
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.popleft()[0].close()
+
+
+class PooledTransport(Transport):
+    """
+    Keeps connections alive per (scheme, host, port) and reuses them across
+    calls.  Safe to share across threads.
+
+    See ConnectionPool for pool_size, max_connections and idle_timeout.
+    ssl_context is passed through to https connections.
+    """
+    connection_classes = {
+        "http": http.client.HTTPConnection,
+        "https": http.client.HTTPSConnection
+    }
+
+    def __init__(self, pool_size=10, max_connections=None, idle_timeout=60,
+                 ssl_context=None):
+        self.pool_size = pool_size
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        # Fast path - no lock once the pool exists
+        pool = self.pools.get(key)
+        if pool is None:
+            with self.lock:
+                pool = self.pools.get(key)
+                if pool is None:
+                    factory = self.connection_factory(scheme, host, port)
+                    pool = self.pools[key] = ConnectionPool(
+                        factory, self.pool_size,
+                        self.max_connections, self.idle_timeout)
+        return pool
+
+    def connection_factory(self, scheme, host, port):
+        try:
+            cls = self.connection_classes[scheme]
+        except KeyError:
+            raise TransportError("Unsupported scheme '{}'".format(scheme))
+        kwargs = {}
+        if scheme == "https" and self.ssl_context:
+            kwargs["context"] = self.ssl_context
+        return lambda: cls(host, port, **kwargs)
+
+    def send(self, uri, body, headers=None, timeout=None):
+        url = urllib.parse.urlsplit(uri)
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        pool = self.pool(url.scheme, url.hostname, url.port)
+
+        connection, reused = pool.acquire(timeout)
+        try:
+            response = self._request(connection, path, body, headers, timeout)
+        except (ConnectionError, http.client.BadStatusLine):
+            # The server may close an idle keep-alive connection at any time.
+            # Only a reused connection can be stale, so retry exactly once
+            # on a fresh connection before giving up.
+            pool.discard(connection)
+            if not reused:
+                raise TransportError("Connection failed")
+            connection, _ = pool.acquire(timeout)
+            try:
+                response = self._request(
+                    connection, path, body, headers, timeout)
+            except (OSError, http.client.HTTPException) as exception:
+                pool.discard(connection)
+                raise TransportError(str(exception)) from exception
+        except (OSError, http.client.HTTPException) as exception:
+            pool.discard(connection)
+            raise TransportError(str(exception)) from exception
+
+        response_headers = {
+            key.lower(): value for key, value in response.getheaders()}
+        if response.will_close:
+            done = functools.partial(pool.discard, connection)
+        else:
+            done = functools.partial(pool.release, connection)
+        discard = functools.partial(pool.discard, connection)
+        if is_streaming(response_headers):
+            return StreamedResponse(
+                response.status, response.reason, response_headers,
+                response, done, discard)
+
+        try:
+            # Read the full body so the connection can be reused
+            data = response.read()
+        except (OSError, http.client.HTTPException) as exception:
+            discard()
+            raise TransportError(str(exception)) from exception
+        done()
+        return Response(
+            response.status, response.reason, response_headers, data)
+
+    def _request(self, connection, path, body, headers, timeout):
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        if isinstance(body, str):
+            body = body.encode("UTF-8")
+        connection.request("POST", path, body=body, headers=headers or {})
+        return connection.getresponse()
+
+    def reap(self):
+        ''' Close idle connections that have exceeded idle_timeout '''
+        for pool in list(self.pools.values()):
+            pool.reap()
+
+    def close(self):
+        for pool in list(self.pools.values()):
+            pool.close()
+
+
+class AsyncConnection(object):
+    """
+    Minimal HTTP/1.1 client connection over asyncio streams.
+
+    Supports Content-Length, chunked and close-delimited response bodies.
+    """
+    def __init__(self, host, port, reader, writer):
+        self.host = "{}:{}".format(host, port)
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port, ssl=None):
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl)
+        return cls(host, port, reader, writer)
+
+    def close(self):
+        self.writer.close()
+
+    async def request(self, path, body, headers):
+        lines = [
+            "POST {} HTTP/1.1".format(path),
+            "Host: {}".format(self.host),
+            "Content-Length: {}".format(len(body))
+        ]
+        lines.extend("{}: {}".format(*item) for item in headers.items())
+        head = "\r\n".join(lines) + "\r\n\r\n"
+        self.writer.write(head.encode("latin-1") + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Remote end closed connection")
+        try:
+            version, status, reason = status_line.decode(
+                "latin-1").rstrip("\r\n").split(" ", 2)
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+
+        will_close = (version == "HTTP/1.0" or
+                      response_headers.get("connection", "") == "close")
+        encoding = response_headers.get("transfer-encoding", "")
+        if "chunked" in encoding.lower():
+            chunks = self._iter_chunked()
+        elif "content-length" in response_headers:
+            length = int(response_headers["content-length"])
+            chunks = self._iter_length(length)
+        else:
+            chunks = self._iter_close()
+            will_close = True
+
+        if is_streaming(response_headers):
+            response = AsyncStreamedResponse(
+                status, reason, response_headers, chunks)
+        else:
+            data = b"".join([chunk async for chunk in chunks])
+            response = Response(status, reason, response_headers, data)
+        return response, will_close
+
+    async def _iter_length(self, length):
+        while length > 0:
+            chunk = await self.reader.read(min(length, 65536))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", length)
+            length -= len(chunk)
+            yield chunk
+
+    async def _iter_close(self):
+        chunk = await self.reader.read(65536)
+        while chunk:
+            yield chunk
+            chunk = await self.reader.read(65536)
+
+    async def _iter_chunked(self):
+        while True:
+            size = await self.reader.readline()
+            size = int(size.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # Discard trailers
+                while (await self.reader.readline()) not in (b"\r\n", b""):
+                    pass
+                return
+            yield await self.reader.readexactly(size)
+            await self.reader.readexactly(2)
+
+
+class AsyncStreamedResponse(StreamedResponse):
+    """
+    StreamedResponse for AsyncPooledTransport; iter_lines is an async
+    generator.  release and discard are set by the transport.
+    """
+    def __init__(self, status_code, reason, headers, chunks):
+        super().__init__(status_code, reason, headers, chunks, None, None)
+
+    @property
+    def body(self):
+        if self._body is None:
+            raise RuntimeError("Streamed body must be read with iter_lines")
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    async def iter_lines(self):
+        buffer = b""
+        try:
+            async for chunk in self.raw:
+                buffer += chunk
+                lines = buffer.split(b"\n")
+                buffer = lines.pop()
+                for line in lines:
+                    yield line + b"\n"
+            if buffer:
+                yield buffer
+        except (OSError, ValueError, asyncio.IncompleteReadError) as exception:
+            self.close()
+            raise TransportError(str(exception)) from exception
+        except BaseException:
+            self.close()
+            raise
+        self.finish(self.release)
+
+
+class AsyncConnectionPool(ConnectionPool):
+    """
+    ConnectionPool for a single event loop, where the factory is a coroutine
+    and waiting for a free connection doesn't block the loop.
+    """
+    def __init__(self, factory, pool_size, max_connections, idle_timeout):
+        super().__init__(factory, pool_size, None, idle_timeout)
+        if max_connections is not None:
+            self.slots = asyncio.BoundedSemaphore(max_connections)
+
+    async def acquire(self, timeout=None):
+        ''' timeout covers both waiting for a slot and connecting '''
+        start = time.monotonic()
+        if self.slots:
+            try:
+                await asyncio.wait_for(self.slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise TransportError(
+                    "Timed out waiting for a free connection")
+        now = time.monotonic()
+        with self.lock:
+            self._reap(now)
+            if self.idle:
+                return self.idle.pop()[0], True
+        if timeout is not None:
+            timeout = max(0.0, timeout - (now - start))
+        try:
+            try:
+                return (await asyncio.wait_for(self.factory(), timeout)), False
+            except asyncio.TimeoutError:
+                raise TransportError("Timed out opening a connection")
+        except BaseException:
+            if self.slots:
+                self.slots.release()
+            raise
+
+
+class AsyncPooledTransport(PooledTransport):
+    """
+    asyncio counterpart to PooledTransport.  Connections are kept alive per
+    (scheme, host, port) and shared by every coroutine on the event loop
+    that created them.
+    """
+    def pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        pool = self.pools.get(key)
+        if pool is None:
+            factory = self.connection_factory(scheme, host, port)
+            pool = self.pools[key] = AsyncConnectionPool(
+                factory, self.pool_size,
+                self.max_connections, self.idle_timeout)
+        return pool
+
+    def connection_factory(self, scheme, host, port):
+        if scheme not in self.connection_classes:
+            raise TransportError("Unsupported scheme '{}'".format(scheme))
+        ssl = None
+        if scheme == "https":
+            ssl = self.ssl_context or True
+        return lambda: AsyncConnection.open(host, port, ssl=ssl)
+
+    async def send(self, uri, body, headers=None, timeout=None):
+        url = urllib.parse.urlsplit(uri)
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        port = url.port or (443 if url.scheme == "https" else 80)
+        pool = self.pool(url.scheme, url.hostname, port)
+        if isinstance(body, str):
+            body = body.encode("UTF-8")
+        headers = headers or {}
+
+        try:
+            connection, reused = await pool.acquire(timeout)
+        except OSError as exception:
+            raise TransportError(str(exception)) from exception
+        try:
+            response, will_close = await asyncio.wait_for(
+                connection.request(path, body, headers), timeout)
+        except (ConnectionError, asyncio.IncompleteReadError,
+                http.client.BadStatusLine) as exception:
+            # See PooledTransport.send - stale keep-alive connections are
+            # retried once on a fresh connection
+            pool.discard(connection)
+            if not reused:
+                raise TransportError(str(exception)) from exception
+            try:
+                connection, _ = await pool.acquire(timeout)
+            except OSError as exception:
+                raise TransportError(str(exception)) from exception
+            try:
+                response, will_close = await asyncio.wait_for(
+                    connection.request(path, body, headers), timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    http.client.HTTPException) as exception:
+                pool.discard(connection)
+                raise TransportError(str(exception)) from exception
+        except (OSError, asyncio.TimeoutError, http.client.HTTPException,
+                ValueError) as exception:
+            pool.discard(connection)
+            raise TransportError(str(exception)) from exception
+
+        if will_close:
+            done = functools.partial(pool.discard, connection)
+        else:
+            done = functools.partial(pool.release, connection)
+        if isinstance(response, AsyncStreamedResponse):
+            response.release = done
+            response.discard = functools.partial(pool.discard, connection)
+        else:
+            done()
+        return response
@@ -0,0 +1,110 @@
+"""
+Catch rare slow requests in the act.
+
+    service.watchdog = Watchdog(threshold=0.5)
+
+The watchdog tracks the requests each thread is processing.  Once one has
+run longer than the threshold, a background thread samples its stack every
+interval until it finishes, and then logs the collapsed stacks (see
+profiling.collapse) with the operation, request size and duration to the
+"pyservice.watchdog" logger.  Requests that finish in time only cost a dict
+insert and pop, so it can stay on in production.
+"""
+import collections
+import logging
+import sys
+import threading
+import time
+from . import profiling
+
+logger = logging.getLogger("pyservice.watchdog")
+
+
+class Watched(object):
+    """ A request in progress """
+    __slots__ = ("thread_id", "operation", "size", "start", "stacks",
+                 "samples", "logged")
+
+    def __init__(self, thread_id, operation, size, start):
+        self.thread_id = thread_id
+        self.operation = operation
+        self.size = size
+        self.start = start
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.logged = False
+
+
+class Watchdog(object):
+    """
+    threshold and interval are in seconds.  Requests that are still
+    running after max_samples samples are logged then, and not sampled
+    any further.
+    """
+    def __init__(self, threshold=1.0, interval=0.01, max_samples=1000,
+                 logger=logger):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_samples = max_samples
+        self.logger = logger
+        # thread id -> Watched
+        self.requests = {}
+        # Held while sampling, so a request isn't logged mid-sample
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def watch(self, operation, size):
+        ''' Start tracking the current thread's request '''
+        watched = Watched(
+            threading.get_ident(), operation, size, time.perf_counter())
+        self.requests[watched.thread_id] = watched
+        return watched
+
+    def release(self, watched):
+        ''' The request is done; log it if it was slow '''
+        self.requests.pop(watched.thread_id, None)
+        if watched.samples:
+            with self.lock:
+                if not watched.logged:
+                    self.log(watched, time.perf_counter() - watched.start)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                self.sample()
+
+    def sample(self):
+        ''' Called with the lock held '''
+        now = time.perf_counter()
+        frames = None
+        for watched in list(self.requests.values()):
+            if watched.logged or now - watched.start < self.threshold:
+                continue
+            if frames is None:
+                frames = sys._current_frames()
+            frame = frames.get(watched.thread_id)
+            if frame is None:
+                continue
+            watched.stacks[profiling.collapse(frame)] += 1
+            watched.samples += 1
+            if watched.samples >= self.max_samples:
+                self.log(watched, now - watched.start, running=True)
+        # Don't hold on to other threads' frames between samples
+        frames = None
+
+    def log(self, watched, duration, running=False):
+        watched.logged = True
+        stacks = "".join(
+            "{} {}\n".format(stack, count)
+            for stack, count in watched.stacks.most_common())
+        self.logger.warning(
+            "Slow request to '%s' (%d bytes) %s %.3fs, %d samples:\n%s",
+            watched.operation, watched.size,
+            "still running after" if running else "took",
+            duration, watched.samples, stacks)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
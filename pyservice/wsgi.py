@@ -1,4 +1,9 @@
 import http.client
+import tempfile
+from . import codecs
+from . import compression
+from . import deadlines
+from . import timing
 
 
 class setter(object):
@@ -15,13 +20,30 @@ class RequestException(Exception):
     def __init__(self, status):
         self.status = status
 
+
+class DeadlineExceeded(RequestException):
+    """ The caller stopped waiting before the request was done """
+    def __init__(self):
+        super().__init__(504)
+
+
 MISSING = object()
+BAD_REQUEST = RequestException(400)
+NOT_ACCEPTABLE = RequestException(406)
 LENGTH_REQUIRED = RequestException(411)
 REQUEST_TOO_LARGE = RequestException(413)
+UNSUPPORTED_MEDIA_TYPE = RequestException(415)
 INTERNAL_ERROR = RequestException(500)
 UNKNOWN_OPERATION = RequestException(404)
+DEADLINE_EXCEEDED = DeadlineExceeded()
 HTTP_CODES = {i[0]: "{} {}".format(*i) for i in http.client.responses.items()}
+# Default limit for request bodies.  Streamed bodies larger than this are
+# spooled to a temporary file instead of being held in memory.
 MEMFILE_MAX = 102400
+# Largest single read from wsgi.input
+BUFFER_SIZE = 65536
+# Content type of streamed responses - one serialized record per line
+STREAMING_TYPE = "application/x-ndjson"
 
 
 def is_request_exception(response):  # pragma: no cover
@@ -71,25 +93,88 @@ class Request(object):
     def __init__(self, service, environ):
         self.service = service
         self.environ = environ
+        self._operation = None
+        self._codecs = None
         self._body = MISSING
 
     @property
     def operation(self):
-        path = self.environ["PATH_INFO"]
-        match = self.service.api["endpoint"]["service_pattern"].search(path)
-        if not match:
-            raise UNKNOWN_OPERATION
-        operation = match.groupdict()["operation"]
-        if operation not in self.service.api["operations"]:
-                raise UNKNOWN_OPERATION
-        return operation
+        if self._operation is None:
+            self._operation = route(self.service, self.environ["PATH_INFO"])
+        return self._operation
+
+    @property
+    def codecs(self):
+        ''' (request codec, response codec) negotiated from the headers '''
+        if self._codecs is None:
+            self._codecs = negotiate(
+                self.service.codecs,
+                self.environ.get("CONTENT_TYPE"),
+                self.environ.get("HTTP_ACCEPT"))
+        return self._codecs
+
+    @property
+    def encoding(self):
+        ''' The preferred response encoding named by Accept-Encoding '''
+        return compression.negotiate(self.environ.get("HTTP_ACCEPT_ENCODING"))
+
+    @property
+    def deadline(self):
+        ''' Unix time the caller stops waiting, or None (see deadlines) '''
+        return deadlines.parse(self.environ.get(deadlines.ENVIRON_KEY))
 
     @property
     def body(self):
+        '''
+        The decoded body, or a file for operations that stream their
+        request.  Limits are per-operation when the operation has already
+        been routed, otherwise the service's defaults apply.  Limits apply
+        to the decompressed size of compressed bodies.
+
+        Bodies for binary codecs are returned as bytes.
+        '''
         if self._body is MISSING:
-            self._body = load_body(self.environ)
+            max_size, stream = self.service.body_options(self._operation)
+            if stream:
+                self._body = spool_body(self.environ, max_size)
+            elif self.codecs[0].binary:
+                self._body = read_body(self.environ, max_size)
+            else:
+                self._body = load_body(self.environ, max_size)
         return self._body
 
+    def close(self):
+        ''' Release the spooled body of a streaming request '''
+        close_body(self._body)
+
+
+def close_body(body):
+    if hasattr(body, "close"):
+        body.close()
+
+
+class ClosingIterator(object):
+    """
+    Streamed response body that calls `callback` once the server closes it.
+
+    Records are produced while the response is being sent, so resources
+    they read from (ie. the spooled request body) must outlive the
+    application call.  The server calls close after the last chunk is sent,
+    or when the client disconnects.
+    """
+    def __init__(self, body, callback):
+        self.body = body
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            close_body(self.body)
+        finally:
+            self.callback()
+
 
 class Response(object):
     """
@@ -112,6 +197,14 @@ class Response(object):
     """
     def __init__(self, start_response):
         self.status = 500
+        # Sent with non-empty bodies when set, see Service.wsgi_application
+        self.content_type = None
+        # (encoding, level, min_size) to compress bodies with, if any
+        self.compression = None
+        # Phases sent in a Server-Timing header, if any
+        self.timings = None
+        # Additional (name, value) headers
+        self.headers = []
         self.body = ''
         self.start_response = start_response
 
@@ -126,23 +219,88 @@ class Response(object):
 
     @setter
     def body(self, value):
-        '''MUST be a unicode string.  MUST be empty for non-200 statuses'''
+        '''
+        MUST be a unicode string, bytes (for binary codecs), or an iterator
+        of unicode lines for streaming operations.  MUST be empty for non-200
+        statuses
+        '''
         if value:
             self.status = 200
 
-        # Unicode -> bytes
-        value = value.encode('UTF-8')
-        self._headers = [("Content-Length", str(len(value)))]
+        if isinstance(value, str):
+            # Unicode -> bytes
+            value = value.encode('UTF-8')
+        elif not isinstance(value, bytes):
+            # Length is unknown, the server will chunk or close the stream
+            self._headers = [("Content-Type", STREAMING_TYPE)]
+            self._body = (line.encode('UTF-8') for line in value)
+            return
+
+        self._headers = headers = []
+        if value:
+            if self.content_type:
+                headers.append(("Content-Type", self.content_type))
+            if self.compression:
+                value, encoding = compression.maybe_compress(
+                    value, *self.compression)
+                if encoding:
+                    headers.append(("Content-Encoding", encoding))
+                headers.append(("Vary", "Accept-Encoding"))
+        headers.insert(0, ("Content-Length", str(len(value))))
 
         # WSGI spec needs iterable of bytes
         self._body = [value]
 
     def send(self):
         ''' Start the response and return the raw body '''
-        self.start_response(self._status, self._headers)
+        headers = self._headers + self.headers
+        if self.timings:
+            headers.append(("Server-Timing", timing.header(self.timings)))
+        self.start_response(self._status, headers)
         return self._body
 
 
+def route(service, path):
+    """ Returns the service's operation for a path, or raises a 404 """
+    operation = service.routes.get(path)
+    if operation is None:
+        raise UNKNOWN_OPERATION
+    return operation
+
+
+def media_type(header):
+    ''' "application/json; charset=utf-8" -> "application/json" '''
+    return header.split(";", 1)[0].strip().lower()
+
+
+def negotiate(available, content_type, accept):
+    '''
+    Returns the (request codec, response codec) for the given Content-Type
+    and Accept headers, from a dict of codecs by content type.
+
+    Requests without a Content-Type are JSON.  The response uses the
+    request's codec unless Accept names a different codec first.  Quality
+    values aren't weighed - the first supported type wins.
+    '''
+    if content_type:
+        request_codec = available.get(media_type(content_type))
+        if request_codec is None:
+            raise UNSUPPORTED_MEDIA_TYPE
+    else:
+        request_codec = codecs.JSON
+    if not accept or accept == content_type:
+        return request_codec, request_codec
+
+    for option in accept.split(","):
+        option = media_type(option)
+        if option in ("*/*", "application/*", request_codec.content_type):
+            return request_codec, request_codec
+        response_codec = available.get(option)
+        if response_codec is not None:
+            return request_codec, response_codec
+    raise NOT_ACCEPTABLE
+
+
 def content_length(environ):
     """ Returns the content length, or -1 if none is provided """
     return int(environ.get('CONTENT_LENGTH', -1))
@@ -153,15 +311,125 @@ def chunked_body(environ):
     return "chunked" in environ.get('HTTP_TRANSFER_ENCODING', '').lower()
 
 
-def load_body(environ):
-    clen = content_length(environ)
-    if chunked_body(environ) or clen < 0:
-        raise LENGTH_REQUIRED
-    if clen > MEMFILE_MAX:
+def iter_body(environ, max_size):
+    """
+    Yields the raw request body in chunks of at most BUFFER_SIZE bytes.
+
+    Chunked bodies are decoded here unless the server has already done so
+    (wsgi.input_terminated).  Raises REQUEST_TOO_LARGE as soon as max_size
+    is exceeded, so oversized bodies are never fully read.
+    """
+    stream = environ.get('wsgi.input')
+    if chunked_body(environ):
+        if stream is None:
+            raise BAD_REQUEST
+        if environ.get('wsgi.input_terminated'):
+            chunks = iter_terminated(stream)
+        else:
+            chunks = iter_chunked(stream)
+    else:
+        clen = content_length(environ)
+        if clen < 0:
+            raise LENGTH_REQUIRED
+        if clen > max_size:
+            raise REQUEST_TOO_LARGE
+        if stream is None:
+            # wsgi.input is missing, empty body
+            return
+        chunks = iter_length(stream, clen)
+
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > max_size:
+            raise REQUEST_TOO_LARGE
+        yield chunk
+
+
+def iter_decoded(environ, max_size):
+    """
+    iter_body, decompressing bodies with a Content-Encoding.  max_size
+    limits both the encoded and the decoded size.
+    """
+    chunks = iter_body(environ, max_size)
+    try:
+        encoding = compression.encoding(
+            environ.get('HTTP_CONTENT_ENCODING'))
+        if encoding is None:
+            yield from chunks
+        else:
+            yield from compression.iter_decompress(chunks, encoding, max_size)
+    except compression.SizeExceeded:
         raise REQUEST_TOO_LARGE
+    except compression.UnsupportedEncoding:
+        raise UNSUPPORTED_MEDIA_TYPE
+    except compression.DecodeError:
+        raise BAD_REQUEST
+
+
+def iter_length(stream, length):
+    while length > 0:
+        chunk = stream.read(min(length, BUFFER_SIZE))
+        if not chunk:
+            return
+        length -= len(chunk)
+        yield chunk
+
+
+def iter_terminated(stream):
+    chunk = stream.read(BUFFER_SIZE)
+    while chunk:
+        yield chunk
+        chunk = stream.read(BUFFER_SIZE)
+
+
+def iter_chunked(stream):
+    """ Decode a chunked transfer encoding, see bottle's _iter_chunked """
+    while True:
+        header = stream.readline(BUFFER_SIZE)
+        if not header.endswith(b"\r\n"):
+            raise BAD_REQUEST
+        size = header.split(b";", 1)[0].strip()
+        try:
+            remaining = int(size, 16)
+        except ValueError:
+            raise BAD_REQUEST
+        if remaining == 0:
+            # Discard trailers
+            while stream.readline(BUFFER_SIZE) not in (b"\r\n", b""):
+                pass
+            return
+        while remaining > 0:
+            chunk = stream.read(min(remaining, BUFFER_SIZE))
+            if not chunk:
+                raise BAD_REQUEST
+            remaining -= len(chunk)
+            yield chunk
+        if stream.read(2) != b"\r\n":
+            raise BAD_REQUEST
+
+
+def read_body(environ, max_size=MEMFILE_MAX):
+    """ Returns the full request body as bytes """
+    return b"".join(iter_decoded(environ, max_size))
+
+
+def load_body(environ, max_size=MEMFILE_MAX):
+    """ Returns the full request body as a string """
+    return read_body(environ, max_size).decode("UTF-8")
+
+
+def spool_body(environ, max_size=MEMFILE_MAX):
+    """
+    Returns a binary file containing the request body, positioned at the
+    start.  Bodies larger than MEMFILE_MAX are written to a temporary file.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=MEMFILE_MAX)
     try:
-        data = environ['wsgi.input'].read(clen)
-        return data.decode("UTF-8")
-    except KeyError:
-        # wsgi.input is missing, return empty string
-        return ""
+        for chunk in iter_decoded(environ, max_size):
+            body.write(chunk)
+    except BaseException:
+        body.close()
+        raise
+    body.seek(0)
+    return body
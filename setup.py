@@ -9,8 +9,11 @@ setup(
     author='Joe Cross',
     author_email='joe.mcross@gmail.com',
     url='http://github.com/numberoverzero/pyservice/',
-    packages=find_packages(exclude=('tests', 'examples')),
-    install_requires=['requests', 'ujson'],
+    packages=find_packages(
+        exclude=('tests', 'examples', 'benchmarks', 'benchmarks.*')),
+    install_requires=['ujson'],
+    extras_require={'msgpack': ['msgpack>=1.0']},
+    python_requires='>=3.7',
     license='MIT',
     platforms='any',
     classifiers=[
@@ -19,10 +22,10 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Topic :: Internet :: WWW/HTTP :: Dynamic Content :: CGI Tools/Libraries',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Topic :: Internet :: WWW/HTTP :: Dynamic Content :: '
+        'CGI Tools/Libraries',
         'Topic :: Internet :: WWW/HTTP :: WSGI',
         'Topic :: Internet :: WWW/HTTP :: WSGI :: Application',
         'Topic :: Internet :: WWW/HTTP :: WSGI :: Middleware',
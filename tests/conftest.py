@@ -88,3 +88,29 @@ def environment():
         'CONTENT_LENGTH': str(length),
         'wsgi.input': io.BytesIO(bytes(body, 'utf8'))
     }
+
+
+@pytest.fixture
+def wsgi_call(start_response):
+    '''
+    Function that sends a request body (str or bytes) to an operation
+    through service.wsgi_application and returns the response body.  Extra
+    environ keys (ie. CONTENT_TYPE, or a deadline) are given as environ.
+    The status and headers are stored on start_response.
+
+    Usage:
+
+    def test_foo(service, wsgi_call, start_response):
+        wsgi_call(service, "foo", '{"value": 1}')
+        assert start_response.status == "200 OK"
+    '''
+    def call(service, operation="foo", body="{}", environ=None):
+        if isinstance(body, str):
+            body = body.encode("UTF-8")
+        environ = dict(environ or {}, **{
+            "PATH_INFO": "/test/" + operation,
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body)
+        })
+        return b"".join(service.wsgi_application(environ, start_response))
+    return call
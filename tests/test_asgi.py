@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+from pyservice import asgi, wsgi
+
+
+def receiver(*chunks):
+    ''' ASGI receive channel that yields the given body chunks '''
+    messages = [{"type": "http.request", "body": chunk, "more_body": True}
+                for chunk in chunks]
+    messages[-1]["more_body"] = False
+
+    async def receive():
+        return messages.pop(0)
+    return receive
+
+
+def test_request_operation(service):
+    ''' Correctly matches against path '''
+    request = asgi.Request(service, {"path": "/test/foo"}, None)
+    assert request.operation == "foo"
+
+
+def test_request_unknown_operation(service):
+    ''' Throw when operation isn't expected '''
+    request = asgi.Request(service, {"path": "/test/not_foo"}, None)
+    with pytest.raises(wsgi.RequestException):
+        request.operation
+
+
+def test_request_body_chunks(service):
+    ''' Body is reassembled from multiple receive messages '''
+    request = asgi.Request(service, {}, receiver(b"Hello, ", b"World"))
+    assert asyncio.run(request.body()) == "Hello, World"
+
+
+def test_request_body_too_large(service):
+    ''' MEMFILE_MAX applies to the received body '''
+    chunk = b"x" * (wsgi.MEMFILE_MAX // 2 + 1)
+    request = asgi.Request(service, {}, receiver(chunk, chunk))
+    with pytest.raises(wsgi.RequestException):
+        asyncio.run(request.body())
+
+
+def test_request_content_length_too_large(service):
+    ''' Reject large bodies before reading when length is known '''
+    headers = [(b"content-length", str(wsgi.MEMFILE_MAX + 1).encode())]
+    request = asgi.Request(service, {"headers": headers}, None)
+    with pytest.raises(wsgi.RequestException):
+        asyncio.run(request.body())
+
+
+def test_response_send():
+    ''' Start and body messages are sent '''
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    response = asgi.Response(send)
+    response.body = "ಠ_ಠ"
+    asyncio.run(response.send())
+
+    assert sent[0]["status"] == 200
+    assert sent[0]["headers"] == [(b"content-length", b"7")]
+    assert sent[1]["body"] == "ಠ_ಠ".encode("UTF-8")
+
+
+def test_response_exception():
+    ''' Setting an exception clears the body '''
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    response = asgi.Response(send)
+    response.body = "This will be cleared"
+    response.exception(wsgi.RequestException(404))
+    asyncio.run(response.send())
+
+    assert sent[0]["status"] == 404
+    assert sent[1]["body"] == b""
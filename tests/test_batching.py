@@ -0,0 +1,136 @@
+import asyncio
+import concurrent.futures
+import threading
+import pytest
+from pyservice import batching
+
+
+def run_concurrently(func, count):
+    ''' Call func(i) from count threads at once, return exceptions by i '''
+    exceptions = {}
+    barrier = threading.Barrier(count)
+
+    def target(i):
+        barrier.wait()
+        try:
+            func(i)
+        except Exception as exception:
+            exceptions[i] = exception
+    threads = [threading.Thread(target=target, args=(i,))
+               for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return exceptions
+
+
+def test_single_request():
+    ''' A lone request runs as a batch of one after max_wait_ms '''
+    calls = []
+
+    def func(requests, responses, contexts):
+        calls.append(len(requests))
+        for request, response in zip(requests, responses):
+            response["value"] = request["value"] * 2
+
+    batcher = batching.Batcher(func, 8, 1)
+    response = {}
+    batcher({"value": 2}, response, None)
+
+    assert response == {"value": 4}
+    assert calls == [1]
+
+
+def test_concurrent_requests_batched():
+    ''' Concurrent requests share calls, each gets its own response '''
+    calls = []
+
+    def func(requests, responses, contexts):
+        calls.append(len(requests))
+        for request, response in zip(requests, responses):
+            response["value"] = request["value"] * 2
+
+    batcher = batching.Batcher(func, 4, 1000)
+    responses = [{} for _ in range(8)]
+
+    exceptions = run_concurrently(
+        lambda i: batcher({"value": i}, responses[i], None), 8)
+
+    assert not exceptions
+    assert responses == [{"value": i * 2} for i in range(8)]
+    # Full batches are dispatched without waiting for max_wait_ms
+    assert calls == [4, 4]
+
+
+def test_exception_shared_by_batch():
+    ''' Every request in a failed batch raises the exception '''
+    def func(requests, responses, contexts):
+        raise ValueError("bad batch")
+
+    batcher = batching.Batcher(func, 3, 1000)
+    exceptions = run_concurrently(lambda i: batcher({}, {}, None), 3)
+
+    assert len(exceptions) == 3
+    assert all(isinstance(e, ValueError) for e in exceptions.values())
+
+
+def test_invalid_max_batch():
+    ''' Batches must hold at least one request '''
+    with pytest.raises(ValueError):
+        batching.Batcher(None, 0, 1)
+
+
+def test_async_coroutine_batched():
+    ''' Coroutine batch functions are awaited once per batch on the loop '''
+    calls = []
+
+    async def func(requests, responses, contexts):
+        calls.append(len(requests))
+        for request, response in zip(requests, responses):
+            response["value"] = request["value"] * 2
+
+    batcher = batching.Batcher(func, 32, 1000)
+    responses = [{} for _ in range(40)]
+
+    async def run():
+        await asyncio.gather(*(
+            batcher.call_async({"value": i}, responses[i], None)
+            for i in range(40)))
+    asyncio.run(run())
+
+    assert responses == [{"value": i * 2} for i in range(40)]
+    assert calls == [32, 8]
+
+
+def test_async_function_runs_once_per_batch():
+    ''' Blocking batch functions take one executor thread per batch '''
+    calls = []
+
+    def func(requests, responses, contexts):
+        calls.append(len(requests))
+        if len(requests) > 1:
+            raise ValueError("bad batch")
+
+    batcher = batching.Batcher(func, 32, 1)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def run():
+        return await asyncio.gather(*(
+            batcher.call_async({}, {}, None, executor) for _ in range(20)),
+            return_exceptions=True)
+    results = asyncio.run(run())
+    executor.shutdown()
+
+    assert calls == [20]
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_coroutine_function_called_sync():
+    ''' Coroutine batch functions can't be called from a thread '''
+    async def func(requests, responses, contexts):
+        pass  # pragma: no cover
+
+    batcher = batching.Batcher(func, 1, 1)
+    with pytest.raises(TypeError):
+        batcher({}, {}, None)
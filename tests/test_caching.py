@@ -0,0 +1,190 @@
+import os
+import pytest
+from pyservice import caching
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_hit_and_miss():
+    ''' Stored values are returned, and counted '''
+    cache = caching.Cache()
+    assert cache.get("key") is None
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert cache.stats() == {
+        "hits": 1, "misses": 1, "evictions": 0, "size": 1, "bytes": 5}
+
+
+def test_cache_lru_eviction():
+    ''' The least recently used entry is evicted first '''
+    cache = caching.Cache(max_size=2)
+    cache.set("first", "1")
+    cache.set("second", "2")
+    cache.get("first")
+    cache.set("third", "3")
+
+    assert cache.get("second") is None
+    assert cache.get("first") == "1"
+    assert cache.get("third") == "3"
+    assert cache.evictions == 1
+
+
+def test_cache_ttl():
+    ''' Entries expire after ttl seconds '''
+    clock = Clock()
+    cache = caching.Cache(ttl=10, clock=clock)
+    cache.set("key", "value")
+    clock.now = 9
+    assert cache.get("key") == "value"
+    clock.now = 10
+    assert cache.get("key") is None
+    assert len(cache) == 0
+
+
+def test_cache_max_bytes():
+    ''' Total stored size is bounded '''
+    cache = caching.Cache(max_bytes=10)
+    cache.set("first", "x" * 6)
+    cache.set("second", "x" * 6)
+    assert cache.get("first") is None
+    assert cache.bytes == 6
+
+    # Values larger than the whole cache aren't stored
+    cache.set("third", "x" * 11)
+    assert cache.get("third") is None
+    assert cache.get("second") == "x" * 6
+
+
+def test_cache_replace():
+    ''' Setting an existing key replaces it '''
+    cache = caching.Cache()
+    cache.set("key", "old value")
+    cache.set("key", "new")
+    assert cache.get("key") == "new"
+    assert cache.bytes == 3
+
+
+def test_cache_invalid_size():
+    with pytest.raises(ValueError):
+        caching.Cache(max_size=0)
+
+
+def test_canonical_key():
+    ''' Key order doesn't matter; content type does '''
+    first = caching.canonical_key({"a": 1, "b": {"c": 2, "d": 3}}, "json")
+    second = caching.canonical_key({"b": {"d": 3, "c": 2}, "a": 1}, "json")
+    assert first == second
+    assert caching.canonical_key({"a": 1}, "msgpack") != \
+        caching.canonical_key({"a": 1}, "json")
+    assert caching.canonical_key({"a": b"bytes"}, "json") is None
+
+
+def test_shared_cache_hit_and_miss():
+    ''' str and bytes values keep their type '''
+    cache = caching.SharedCache(slots=16, slot_size=128)
+    assert cache.get("key") is None
+    cache.set("key", "value")
+    cache.set(("json", '{"id":1}'), b"\x00bytes")
+    assert cache.get("key") == "value"
+    assert cache.get(("json", '{"id":1}')) == b"\x00bytes"
+    assert cache.stats() == {
+        "hits": 2, "misses": 1, "evictions": 0, "size": 2}
+
+
+def test_shared_cache_eviction():
+    ''' The least recently read entry in a full set is evicted '''
+    clock = Clock()
+    cache = caching.SharedCache(slots=2, slot_size=128, ways=2, clock=clock)
+    cache.set("first", "1")
+    clock.now = 1
+    cache.set("second", "2")
+    clock.now = 2
+    cache.get("first")
+    clock.now = 3
+    cache.set("third", "3")
+
+    assert cache.get("second") is None
+    assert cache.get("first") == "1"
+    assert cache.get("third") == "3"
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+
+def test_shared_cache_ttl_and_replace():
+    ''' Entries expire, and setting a key replaces it in place '''
+    clock = Clock()
+    cache = caching.SharedCache(slots=8, slot_size=128, ttl=10, clock=clock)
+    cache.set("key", "old value")
+    cache.set("key", "new")
+    assert len(cache) == 1
+    clock.now = 9
+    assert cache.get("key") == "new"
+    clock.now = 10
+    assert cache.get("key") is None
+
+
+def test_shared_cache_too_large():
+    ''' Entries that don't fit in a slot aren't stored '''
+    cache = caching.SharedCache(slots=4, slot_size=64)
+    cache.set("key", "x" * 30)
+    assert cache.get("key") is None
+    cache.set("key", "x" * 20)
+    assert cache.get("key") == "x" * 20
+    with pytest.raises(ValueError):
+        caching.SharedCache(slot_size=40)
+
+
+def test_shared_cache_torn_read():
+    ''' Slots that are being written read as misses '''
+    cache = caching.SharedCache(slots=1, slot_size=128, ways=1)
+    cache.set("key", "value")
+    cache.SEQUENCE.pack_into(cache.memory, 0, 3)
+    assert cache.get("key") is None
+    cache.SEQUENCE.pack_into(cache.memory, 0, 4)
+    assert cache.get("key") == "value"
+
+
+def test_shared_cache_clear():
+    ''' Every slot is emptied '''
+    cache = caching.SharedCache(slots=8, slot_size=128)
+    cache.set("key", "value")
+    cache.clear()
+    assert cache.get("key") is None
+    assert len(cache) == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_shared_cache_across_processes():
+    ''' Processes forked after the cache is created share it '''
+    cache = caching.SharedCache(slots=64, slot_size=128)
+    cache.set("parent", "1")
+    pid = os.fork()
+    if not pid:  # pragma: no cover
+        code = 0 if cache.get("parent") == "1" else 1
+        cache.set("child", b"2")
+        os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert cache.get("child") == b"2"
+
+
+def test_shared_cache_operation(service):
+    ''' Services can cache responses in a SharedCache '''
+    calls = []
+    cache = caching.SharedCache(slots=16, slot_size=256)
+
+    @service.operation("foo", cache=cache)
+    def foo(request, response, context):
+        calls.append(request.id)
+        response.id = request.id
+
+    for _ in range(2):
+        body = service.__process__("foo", '{"id": 1}')
+        assert body == '{"id":1}'
+    assert calls == [1]
@@ -0,0 +1,163 @@
+import asyncio
+import io
+import pytest
+from pyservice import capture
+from pyservice import codecs
+from pyservice import loadtest
+from pyservice import replay
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join("capture"))
+
+
+def test_capture_and_read(service, wsgi_call, path):
+    ''' Sampled requests are logged with their raw body and codec '''
+    service.codecs[codecs.MSGPACK_TYPE] = codecs.MSGPACK
+    service.operation("foo", func=lambda request, response, context: None)
+    plugin = capture.Capture(path, sample=1)
+    service.plugin("request", func=plugin)
+
+    wsgi_call(service, "foo", b'{"id": 1}',
+              {"CONTENT_TYPE": "application/json"})
+    wsgi_call(service, "foo", codecs.MSGPACK.serialize({"id": 2}),
+              {"CONTENT_TYPE": codecs.MSGPACK_TYPE})
+    plugin.close()
+
+    first, second = capture.read(*capture.files(path))
+    assert first.operation == "foo"
+    assert first.content_type == "application/json"
+    assert first.body == b'{"id": 1}'
+    assert first.duration >= 0
+    assert second.content_type == codecs.MSGPACK_TYPE
+    assert codecs.MSGPACK.serialize({"id": 2}) == second.body
+    assert first.timestamp <= second.timestamp
+
+
+def test_sample_rate(service, wsgi_call, path):
+    ''' Requests the sample doesn't pick aren't logged '''
+    service.operation("foo", func=lambda request, response, context: None)
+    plugin = capture.Capture(path, sample=0.5)
+    plugin.random = iter([0.9, 0.1, 0.5]).__next__
+    service.plugin("request", func=plugin)
+    for id in range(3):
+        wsgi_call(service, "foo", '{{"id": {}}}'.format(id))
+
+    [record] = capture.read(path)
+    assert record.body == b'{"id": 1}'
+
+
+def test_async_capture(service, path):
+    ''' AsyncCapture logs requests to async services '''
+    service.operation("foo", func=lambda request, response, context: None)
+    plugin = capture.AsyncCapture(path, sample=1)
+    service.plugin("request", func=plugin)
+    asyncio.run(service.__async_process__("foo", '{"id": 1}'))
+
+    [record] = capture.read(path)
+    assert record.body == b'{"id": 1}'
+
+
+def test_rotation(path):
+    ''' Files are rotated by size, keeping the newest backups '''
+    log = capture.Log(path, max_bytes=100, backups=2)
+    for index in range(5):
+        log.append(capture.Record(index, 0, "foo", "application/json",
+                                  b"x" * 40))
+    log.close()
+
+    assert capture.files(path) == [path + ".2", path + ".1", path]
+    records = list(capture.read(*capture.files(path)))
+    assert [record.timestamp for record in records] == [2, 3, 4]
+
+
+def test_truncated_record(path):
+    ''' A partial record at the end of a file is ignored '''
+    log = capture.Log(path)
+    log.append(capture.Record(1, 0, "foo", "application/json", b"{}"))
+    log.append(capture.Record(2, 0, "foo", "application/json", b"{}"))
+    log.close()
+    with open(path, "rb+") as file:
+        file.truncate(file.seek(0, 2) - 1)
+
+    assert [record.timestamp for record in capture.read(path)] == [1]
+
+
+def test_not_a_capture(path):
+    ''' Files without the magic header are rejected '''
+    with open(path, "wb") as file:
+        file.write(b"hello")
+    with pytest.raises(ValueError):
+        list(capture.read(path))
+
+
+def records(*entries):
+    return [capture.Record(timestamp, 0.001, operation, "application/json",
+                           body)
+            for timestamp, operation, body in entries]
+
+
+def test_replay_in_process(service):
+    ''' Records are fed through wsgi_application, errors are reported '''
+    calls = []
+    service.operation("foo", func=lambda request, response, context:
+                      calls.append(request.id))
+
+    @service.operation("bar")
+    def fail(request, response, context):
+        raise ValueError("always fails")
+
+    report = replay.Replay(service, records(
+        (10.0, "foo", b'{"id": 1}'), (10.01, "bar", b"{}"),
+        (10.02, "foo", b'{"id": 2}')), speed=0, workers=1).run()
+
+    assert calls == [1, 2]
+    foo, bar = report["operations"]["foo"], report["operations"]["bar"]
+    assert foo["requests"] == 2 and not foo["errors"]
+    # Unexpected exceptions are hidden from callers
+    assert bar["errors"] == {"RequestException": 1}
+    assert foo["captured"]["p50"] == pytest.approx(1.0)
+    assert foo["delta"]["p50"] == pytest.approx(
+        foo["replayed"]["p50"] - foo["captured"]["p50"])
+    assert "foo" in replay.format_report(report)
+
+
+def test_replay_speed(service):
+    ''' Records are sent at the captured pace, scaled by speed '''
+    service.operation("foo", func=lambda request, response, context: None)
+    entries = records((100.0, "foo", b"{}"), (100.2, "foo", b"{}"))
+
+    report = replay.Replay(service, entries, speed=2).run()
+    assert report["duration"] >= 0.1
+    schedule = replay.Replay(service, entries, speed=0).schedule()
+    assert [offset for offset, _, _ in schedule] == [0, 0]
+
+
+def test_replay_http(service):
+    ''' Records can be replayed to a running service '''
+    service.operation("foo", func=lambda request, response, context: None)
+    server = loadtest.serve(service)
+    try:
+        host, port = server.server_address[:2]
+        report = replay.Replay(
+            service, records((1.0, "foo", b"{}"), (1.0, "missing", b"{}")),
+            speed=0, host=host, port=port).run()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert not report["operations"]["foo"]["errors"]
+    assert report["operations"]["missing"]["errors"] == {"TransportError": 1}
+
+
+def test_compare():
+    ''' Deltas can be taken against an earlier replay '''
+    stats = {"replayed": {"p50": 3.0}, "delta": {"p50": 2.0}}
+    report = {"operations": {"foo": dict(stats), "bar": dict(stats)}}
+    baseline = {"operations": {"foo": {"replayed": {"p50": 2.5}}}}
+
+    replay.compare(report, baseline)
+    assert report["operations"]["foo"]["delta"] == {"p50": 0.5}
+    assert report["operations"]["bar"]["delta"] == {"p50": 2.0}
+    assert report["baseline"]
@@ -1,5 +1,11 @@
+import asyncio
+import collections
+import threading
+import time
 import pytest
-from pyservice import Client
+import ujson
+from pyservice import AsyncClient, Client, caching
+from pyservice.common import Container
 
 
 def test_load_api_defaults():
@@ -113,3 +119,235 @@ def test_operation_calls_process(client):
     result = client.foo(key="value")
     assert result == return_value
     assert process_args == ["foo", {"key": "value"}]
+
+
+def test_async_client_calls_process(api):
+    ''' AsyncClient operations return awaitables '''
+    client = AsyncClient(**api)
+
+    async def process(*args):
+        return args
+    client.__process__ = process
+
+    result = asyncio.run(client.foo(key="value"))
+    assert result == ("foo", {"key": "value"})
+
+
+def test_async_client_round_trip(api):
+    ''' async plugins and transport are awaited '''
+    client = AsyncClient(**api)
+    called = []
+
+    class Transport:
+        async def send(self, uri, data, headers=None, timeout=None):
+            called.append(uri)
+            return collections.namedtuple(
+                "Response", ["status_code", "text", "reason", "headers"],
+                defaults=[{}])(
+                200, ujson.dumps({"echo": ujson.loads(data)}), "OK")
+    client.transport = Transport()
+
+    @client.plugin(scope="request")
+    async def request_plugin(context):
+        called.append("request")
+        await context.process_request()
+
+    @client.plugin(scope="operation")
+    async def operation_plugin(request, response, context):
+        called.append("operation")
+        await context.process_request()
+        response.plugin = True
+
+    response = asyncio.run(client.foo(key="value"))
+    assert response.echo == {"key": "value"}
+    assert response.plugin
+    assert called == [
+        "request", "operation", "http://localhost:8080/test/foo"]
+
+
+def test_async_client_remote_exception(api):
+    ''' Service exceptions are raised from the awaited call '''
+    client = AsyncClient(**api)
+
+    class Transport:
+        async def send(self, uri, data, headers=None, timeout=None):
+            body = ujson.dumps({"__exception__": {
+                "cls": "FooException", "args": ["text"]}})
+            return collections.namedtuple(
+                "Response", ["status_code", "text", "reason", "headers"],
+                defaults=[{}])(
+                200, body, "OK")
+    client.transport = Transport()
+
+    with pytest.raises(client.exceptions.FooException):
+        asyncio.run(client.foo())
+
+
+def test_batch_single_round_trip(client):
+    ''' Entries are sent in one call and unpacked into results '''
+    calls = []
+
+    def process(operation, request):
+        calls.append((operation, request))
+        return {"results": [
+            {"value": 1},
+            {"__exception__": {"cls": "FooException", "args": ["text"]}}
+        ]}
+    client.__process__ = process
+
+    with client.batch(parallel=True) as batch:
+        first = batch.foo(key="value")
+        second = batch.bar()
+
+    assert calls == [("__batch__", {
+        "operations": [
+            {"operation": "foo", "request": {"key": "value"}},
+            {"operation": "bar", "request": {}}
+        ],
+        "parallel": True
+    })]
+    assert first.result().value == 1
+    with pytest.raises(client.exceptions.FooException):
+        second.result()
+
+
+def test_batch_result_before_execute(client):
+    ''' Results aren't available until the batch executes '''
+    batch = client.batch()
+    result = batch.foo()
+    with pytest.raises(RuntimeError):
+        result.result()
+
+
+def test_batch_unknown_operation(client):
+    ''' ValueError for an unknown operation '''
+    with pytest.raises(ValueError):
+        client.batch().unknown_operation
+
+
+def test_cache_operation(client):
+    ''' Identical calls are memoized; responses are copies '''
+    calls = []
+
+    def process(operation, request):
+        calls.append(request)
+        return Container(value=request["key"])
+    client.__process__ = process
+    client.cache("foo", caching.Cache())
+
+    first = client.foo(key=1)
+    first.value = "changed"
+    assert client.foo(key=1) == {"value": 1}
+    assert client.foo(key=2) == {"value": 2}
+    assert client.bar(key=1) is not None
+    assert len(calls) == 3
+
+
+def test_cache_nested_copies(client):
+    ''' Changing a nested value of a response doesn't change the cache '''
+    def process(operation, request):
+        return Container(items=[1, 2], config={"debug": False})
+    client.__process__ = process
+    cache = client.cache("foo", caching.Cache(max_bytes=1000))
+
+    client.foo()["items"].append(99)
+    hit = client.foo()
+    hit["items"].append(99)
+    hit.config["debug"] = True
+    assert client.foo() == {"items": [1, 2], "config": {"debug": False}}
+    # Sized by the serialized response, not its number of keys
+    assert cache.bytes == len('{"items":[1,2],"config":{"debug":false}}')
+
+
+def test_cache_unknown_operation(client):
+    with pytest.raises(ValueError):
+        client.cache("unknown", caching.Cache())
+
+
+def test_cache_exceptions_not_cached(client):
+    ''' Failed calls are retried '''
+    calls = []
+
+    def process(operation, request):
+        calls.append(request)
+        raise client.exceptions.FooException()
+    client.__process__ = process
+    client.cache("foo", caching.Cache())
+
+    for _ in range(2):
+        with pytest.raises(client.exceptions.FooException):
+            client.foo()
+    assert len(calls) == 2
+
+
+def test_cache_singleflight(client):
+    ''' Concurrent identical calls share one request '''
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def process(operation, request):
+        calls.append(request)
+        started.set()
+        release.wait(1)
+        return Container(value=1)
+    client.__process__ = process
+    client.cache("foo", caching.Cache())
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.foo()))
+               for _ in range(8)]
+    threads[0].start()
+    started.wait(1)
+    for thread in threads[1:]:
+        thread.start()
+    # Followers that arrive after the call completes hit the cache instead
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{"value": 1}] * 8
+    assert len(calls) == 1
+
+
+def test_async_cache_singleflight(api):
+    ''' Concurrent identical coroutines share one request '''
+    client = AsyncClient(**api)
+    calls = []
+
+    async def process(operation, request):
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        return Container(value=1)
+    client.__process__ = process
+    client.cache("foo", caching.Cache())
+
+    async def run():
+        results = await asyncio.gather(*(client.foo() for _ in range(8)))
+        return results + [await client.foo()]
+
+    assert asyncio.run(run()) == [{"value": 1}] * 9
+    assert len(calls) == 1
+
+
+def test_async_cache_shares_exceptions(api):
+    ''' Every waiting coroutine gets the exception '''
+    client = AsyncClient(**api)
+    calls = []
+
+    async def process(operation, request):
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        raise client.exceptions.FooException()
+    client.__process__ = process
+    client.cache("foo", caching.Cache())
+
+    async def run():
+        return await asyncio.gather(
+            *(client.foo() for _ in range(4)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, client.exceptions.FooException)
+               for result in results)
+    assert len(calls) == 1
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+from pyservice import coalescing
+
+
+def test_join_leader_and_followers():
+    ''' The first caller leads; the flight is dropped once finished '''
+    coalescer = coalescing.Coalescer()
+    flight, leader = coalescer.join("key")
+    same, follower = coalescer.join("key")
+    other, other_leader = coalescer.join("other")
+
+    assert leader and not follower and other_leader
+    assert same is flight and other is not flight
+
+    coalescer.finish(flight, body="body")
+    assert flight.body == "body"
+    assert len(coalescer) == 1
+    assert coalescer.join("key")[1]
+
+
+def test_flight_wait_threads():
+    ''' Blocked waiters are released by finish '''
+    flight = coalescing.Flight("key")
+    results = []
+    waiter = threading.Thread(
+        target=lambda: (flight.wait(), results.append(flight.body)))
+    waiter.start()
+    flight.finish(body="body")
+    waiter.join(1)
+    assert results == ["body"]
+
+
+def test_flight_wait_async():
+    ''' Coroutines are released, even when finished from another thread '''
+    flight = coalescing.Flight("key")
+
+    async def run():
+        waiters = [asyncio.ensure_future(flight.wait_async())
+                   for _ in range(3)]
+        await asyncio.sleep(0)
+        threading.Thread(
+            target=flight.finish, kwargs={"exception": ValueError()}).start()
+        await asyncio.wait_for(asyncio.gather(*waiters), 1)
+        # Waiting on a finished flight returns immediately
+        await flight.wait_async()
+
+    asyncio.run(run())
+    assert isinstance(flight.exception, ValueError)
+
+
+def test_flight_wait_timeout():
+    ''' Waits return False when the flight doesn't finish in time '''
+    flight = coalescing.Flight("key")
+    assert not flight.wait(0.01)
+    assert not asyncio.run(flight.wait_async(0.01))
+    # Timed out waiters aren't released later
+    assert not flight.waiters
+
+    flight.finish(body="body")
+    assert flight.wait(0.01)
+    assert asyncio.run(flight.wait_async(0.01))
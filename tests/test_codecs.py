@@ -0,0 +1,75 @@
+import pytest
+from pyservice import codecs, common
+
+
+VALUES = [
+    None, True, False,
+    0, 1, 127, 128, 255, 256, 65535, 65536, 2 ** 32, 2 ** 64 - 1,
+    -1, -32, -33, -128, -129, -32768, -32769, -2 ** 31 - 1, -2 ** 63,
+    0.5, -1.25e300,
+    "", "short", "x" * 31, "x" * 32, "x" * 256, "x" * 65536, "ಠ_ಠ",
+    b"", b"\x00\xff", b"x" * 256, b"x" * 65536,
+    [], [1, "two", [3]], list(range(16)), list(range(65536)),
+    {}, {"nested": {"key": [1, 2]}}, {str(i): i for i in range(16)}
+]
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_pack_round_trip(value):
+    ''' Every supported type survives pack -> unpack '''
+    assert codecs.unpack(codecs.pack(value)) == value
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_pack_matches_reference(value):
+    ''' The pure python encoding is interchangeable with msgpack's '''
+    msgpack = pytest.importorskip("msgpack")
+    assert codecs.pack(value) == msgpack.packb(value, use_bin_type=True)
+    assert msgpack.unpackb(codecs.pack(value), raw=False) == value
+
+
+def test_pack_compact():
+    ''' Small values use single byte encodings '''
+    assert codecs.pack({"a": 1}) == b"\x81\xa1a\x01"
+    assert codecs.pack(-1) == b"\xff"
+
+
+def test_pack_tuples_and_subclasses():
+    ''' Tuples pack as arrays, dict/int/str subclasses as their base '''
+    class Flag(int):
+        pass
+    container = common.Container(args=("a", Flag(3)))
+    assert codecs.unpack(codecs.pack(container)) == {"args": ["a", 3]}
+
+
+def test_pack_unsupported():
+    ''' Unknown types and out of range integers can't be packed '''
+    with pytest.raises(TypeError):
+        codecs.pack(object())
+    with pytest.raises(OverflowError):
+        codecs.pack(2 ** 64)
+
+
+@pytest.mark.parametrize("data", [
+    b"", b"\xa5abc", b"\xc1", b"\x01\x02", b"\xcd\x01", b"\x81\x91\x01\x01"])
+def test_unpack_malformed(data):
+    ''' Truncated, unknown or trailing data raises ValueError '''
+    with pytest.raises(ValueError):
+        codecs.unpack(data)
+
+
+@pytest.mark.parametrize("codec", [
+    codecs.JSON, codecs.MSGPACK,
+    codecs.MsgPackCodec(pack=codecs.pack, unpack=codecs.unpack)])
+def test_codec_round_trip(codec):
+    ''' serialize and deserialize into a container '''
+    container = common.Container()
+    codec.deserialize(codec.serialize({"value": [1, "a"]}), container)
+    assert container.value == [1, "a"]
+
+
+def test_msgpack_codec_requires_map():
+    ''' Bodies must decode to a map '''
+    codec = codecs.MsgPackCodec(pack=codecs.pack, unpack=codecs.unpack)
+    with pytest.raises(ValueError):
+        codec.deserialize(codecs.pack([1, 2]), {})
@@ -171,3 +171,47 @@ def test_exception_factory_caches_attributes():
     factory = Observer()
     assert factory.FooException is factory.FooException
     assert calls == 1
+
+
+def test_container_delete():
+    ''' del Container.foo removes the key '''
+    container = common.Container(foo="bar")
+    del container.foo
+    assert "foo" not in container
+    with pytest.raises(AttributeError):
+        del container.foo
+
+
+def test_container_is_own_dict():
+    ''' Attributes are stored as keys, so hits skip __getattr__ '''
+    container = common.Container()
+    container.foo = "bar"
+    assert container.__dict__ is container
+    assert container == {"foo": "bar"}
+
+
+def test_context_stores_plugin_attributes():
+    ''' Plugins can store arbitrary objects on the context '''
+    context = common.Context(None)
+    context.operation = "foo"
+    context.db = o = object()
+    assert context.db is o
+
+
+def test_construct_routes():
+    ''' Every operation and the batch operation are routed '''
+    routes = common.construct_routes({"pattern": "/api/{operation}"}, ["foo"])
+    assert routes == {
+        "/api/foo": "foo",
+        "/api/foo/": "foo",
+        "/api/__batch__": "__batch__",
+        "/api/__batch__/": "__batch__"
+    }
+
+
+def test_route_prefix():
+    ''' Only complete segments before {operation} are the prefix '''
+    assert common.route_prefix({"pattern": "/{operation}"}) == []
+    assert common.route_prefix(
+        {"pattern": "/api/v1/{operation}"}) == ["api", "v1"]
+    assert common.route_prefix({"pattern": "/api/op_{operation}"}) == ["api"]
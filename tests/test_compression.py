@@ -0,0 +1,83 @@
+import zlib
+import pytest
+from pyservice import compression
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "deflate"])
+def test_round_trip(encoding):
+    ''' compress and decompress are inverses '''
+    data = b"Hello, World! " * 100
+    compressed = compression.compress(data, encoding, level=9)
+    assert len(compressed) < len(data)
+    assert compression.decompress(compressed, encoding) == data
+
+
+def test_gzip_interoperable():
+    ''' gzip bodies are readable by zlib's gzip mode '''
+    compressed = compression.compress(b"Hello", "gzip")
+    assert zlib.decompress(compressed, 16 + zlib.MAX_WBITS) == b"Hello"
+
+
+def test_maybe_compress_threshold():
+    ''' Bodies under min_size, or without an encoding, are sent as-is '''
+    data = b"x" * 100
+    assert compression.maybe_compress(data, "gzip", 6, 101) == (data, None)
+    assert compression.maybe_compress(data, None, 6, 1) == (data, None)
+    assert compression.maybe_compress(data, "gzip", 6, None) == (data, None)
+    compressed, encoding = compression.maybe_compress(data, "gzip", 6, 100)
+    assert encoding == "gzip"
+    assert compression.decompress(compressed, "gzip") == data
+
+
+def test_decompress_bomb():
+    ''' Decoding stops as soon as the limit is exceeded '''
+    bomb = compression.compress(b"\0" * (50 * 1024 * 1024), "gzip", 9)
+    decompressor = compression.Decompressor("gzip", max_size=1024)
+    with pytest.raises(compression.SizeExceeded):
+        decompressor.feed(bomb)
+    # Never more than one block past the limit
+    assert decompressor.size <= 1024 + compression.BLOCK_SIZE
+
+
+def test_decompress_chunks():
+    ''' Input can arrive in arbitrary chunks '''
+    data = bytes(range(256)) * 100
+    compressed = compression.compress(data, "deflate")
+    chunks = [compressed[i:i + 7] for i in range(0, len(compressed), 7)]
+    assert b"".join(
+        compression.iter_decompress(chunks, "deflate")) == data
+
+
+def test_decompress_malformed():
+    ''' Garbage and truncated bodies raise DecodeError '''
+    with pytest.raises(compression.DecodeError):
+        compression.decompress(b"not gzip", "gzip")
+    truncated = compression.compress(b"Hello" * 100, "gzip")[:-10]
+    with pytest.raises(compression.DecodeError):
+        compression.decompress(truncated, "gzip")
+
+
+def test_unsupported_encoding():
+    ''' Only gzip, deflate and identity are understood '''
+    with pytest.raises(compression.UnsupportedEncoding):
+        compression.decompress(b"", "br")
+    with pytest.raises(compression.UnsupportedEncoding):
+        compression.encoding("gzip, deflate")
+    assert compression.encoding("identity") is None
+    assert compression.encoding(" GZIP ") == "gzip"
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("br", None),
+    ("deflate", "deflate"),
+    ("deflate, gzip", "gzip"),
+    ("gzip;q=0, deflate", "deflate"),
+    ("gzip; q=0.5", "gzip"),
+    ("*", "gzip"),
+    ("gzip;q=0, deflate;q=0.0", None),
+])
+def test_negotiate(header, expected):
+    ''' The preferred accepted encoding is chosen '''
+    assert compression.negotiate(header) == expected
@@ -0,0 +1,154 @@
+import asyncio
+import io
+import time
+import pytest
+from pyservice import Client, Service, deadlines, processors, wsgi
+
+
+@pytest.fixture
+def api(api):
+    ''' Deadlines are off by default '''
+    api["deadline"] = True
+    return api
+
+
+class Unreadable(io.RawIOBase):
+    def read(self, size=-1):
+        raise AssertionError("body was read")
+
+
+def test_header_and_parse():
+    ''' Deadlines are absolute unix times '''
+    assert deadlines.header(2.5, now=100) == "102.500000"
+    assert deadlines.parse("102.500000") == 102.5
+    for value in (None, "", "soon", "nan", "inf"):
+        assert deadlines.parse(value) is None
+    # wsgi and asgi read the header the client sends
+    assert deadlines.ENVIRON_KEY == "HTTP_X_DEADLINE"
+    assert deadlines.SCOPE_HEADER == b"x-deadline"
+
+
+def test_off_by_default():
+    ''' Absolute deadlines need synchronized clocks, so they're opt-in '''
+    assert not Client().api["deadline"]
+    assert not Service().api["deadline"]
+
+
+def test_remaining(service, wsgi_call):
+    ''' Operations see the deadline and the time left before it '''
+    seen = []
+    service.operation("foo", func=lambda request, response, context:
+                      seen.append((context.deadline, context.remaining())))
+    deadline = time.time() + 10
+    wsgi_call(service, environ={
+        deadlines.ENVIRON_KEY: "{:.6f}".format(deadline)})
+    wsgi_call(service)
+
+    (first, remaining), second = seen
+    assert first == pytest.approx(deadline)
+    assert 9 < remaining <= 10
+    assert second == (None, None)
+
+
+def test_expired_on_arrival(service, start_response):
+    ''' Requests that arrive late get a 504 without reading the body '''
+    calls = []
+    service.operation("foo", func=lambda request, response, context:
+                      calls.append(request))
+    environ = {
+        "PATH_INFO": "/test/foo",
+        "CONTENT_LENGTH": "2",
+        "wsgi.input": Unreadable(),
+        deadlines.ENVIRON_KEY: str(time.time() - 1)
+    }
+    assert service.wsgi_application(environ, start_response) == [b""]
+    assert start_response.status == "504 Gateway Timeout"
+    assert not calls
+
+
+def test_expired_between_plugins(service, wsgi_call, start_response):
+    ''' The rest of the chain is skipped once the deadline passes '''
+    calls = []
+
+    @service.plugin("request")
+    def slow(context):
+        calls.append("slow")
+        time.sleep(0.05)
+        context.process_request()
+
+    @service.plugin("request")
+    def skipped(context):
+        calls.append("skipped")
+        context.process_request()
+    service.operation("foo", func=lambda request, response, context:
+                      calls.append("function"))
+
+    wsgi_call(service, environ={
+        deadlines.ENVIRON_KEY: str(time.time() + 0.02)})
+    assert start_response.status == "504 Gateway Timeout"
+    assert calls == ["slow"]
+    assert service.metrics.snapshot()["foo"].errors == {
+        "DeadlineExceeded": 1}
+
+    # Plenty of time, nothing is skipped
+    calls.clear()
+    wsgi_call(service, environ={
+        deadlines.ENVIRON_KEY: str(time.time() + 10)})
+    assert start_response.status == "200 OK"
+    assert calls == ["slow", "skipped", "function"]
+
+
+def test_batch_entries(service):
+    ''' Entries share the batch's deadline '''
+    @service.plugin("request")
+    def slow(context):
+        time.sleep(0.05)
+        context.process_request()
+    service.operation("foo", func=lambda request, response, context: None)
+
+    body = '{"operations": [{"operation": "foo"}, {"operation": "foo"}]}'
+    with pytest.raises(wsgi.DeadlineExceeded):
+        processors.batch(service, body, deadline=time.time() + 0.02)
+
+
+def test_disabled(service, wsgi_call, start_response):
+    ''' Services with api["deadline"] False ignore the header '''
+    service.api["deadline"] = False
+    seen = []
+    service.operation("foo", func=lambda request, response, context:
+                      seen.append(context.deadline))
+    wsgi_call(service, environ={
+        deadlines.ENVIRON_KEY: str(time.time() - 1)})
+    assert start_response.status == "200 OK"
+    assert seen == [None]
+
+
+def test_asgi_expired(service):
+    ''' asgi services answer late requests with a 504 '''
+    service.operation("foo", func=lambda request, response, context: None)
+    sent = []
+
+    async def receive():
+        raise AssertionError("body was read")
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/test/foo", "headers": [
+        (b"x-deadline", str(time.time() - 1).encode())]}
+    asyncio.run(service.asgi_application(scope, receive, send))
+    assert sent[0]["status"] == 504
+
+
+def test_client_sends_deadline(client):
+    ''' Clients send now + timeout, unless disabled '''
+    processor = processors.ClientProcessor(client, "foo", {})
+    before = time.time()
+    _, _, headers, timeout = processor.pack_request()
+    deadline = deadlines.parse(headers[deadlines.HEADER])
+    assert before + timeout <= deadline <= time.time() + timeout
+    assert deadlines.HEADER not in client.headers
+
+    client.api["deadline"] = False
+    processor = processors.ClientProcessor(client, "foo", {})
+    assert deadlines.HEADER not in processor.pack_request()[2]
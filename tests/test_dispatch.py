@@ -0,0 +1,83 @@
+import asyncio
+import io
+import pytest
+import ujson
+from pyservice import Dispatcher, Service
+
+
+def make_service(pattern, name):
+    service = Service(endpoint={"pattern": pattern}, operations=["foo"])
+    service.operation(
+        "foo", func=lambda request, response, context:
+        response.update(service=name))
+    return service
+
+
+@pytest.fixture
+def dispatcher():
+    return Dispatcher(
+        make_service("/{operation}", "root"),
+        make_service("/api/{operation}", "api"),
+        make_service("/api/v2/{operation}", "v2"),
+        make_service("/other/op_{operation}", "prefixed"))
+
+
+def call(dispatcher, path, start_response):
+    environ = {
+        "PATH_INFO": path,
+        "CONTENT_LENGTH": "2",
+        "wsgi.input": io.BytesIO(b"{}")
+    }
+    body = dispatcher(environ, start_response)[0]
+    return body and ujson.loads(body)
+
+
+@pytest.mark.parametrize("path, name", [
+    ("/foo", "root"),
+    ("/api/foo", "api"),
+    ("/api/foo/", "api"),
+    ("/api/v2/foo", "v2"),
+    ("/other/op_foo", "prefixed"),
+])
+def test_dispatch(dispatcher, start_response, path, name):
+    ''' The service with the longest matching prefix handles the request '''
+    assert call(dispatcher, path, start_response) == {"service": name}
+
+
+@pytest.mark.parametrize("path", [
+    "/api/v3/foo", "/api/bar", "/other/foo", "/missing/foo"])
+def test_dispatch_unknown(dispatcher, start_response, path):
+    ''' Unknown paths are 404 '''
+    call(dispatcher, path, start_response)
+    assert start_response.status == "404 Not Found"
+
+
+def test_dispatch_no_root(start_response):
+    ''' Paths outside every mounted prefix are 404 '''
+    dispatcher = Dispatcher(make_service("/api/{operation}", "api"))
+    call(dispatcher, "/foo", start_response)
+    assert start_response.status == "404 Not Found"
+
+
+def test_mount_conflict(dispatcher):
+    ''' Only one service can be mounted at a prefix '''
+    with pytest.raises(ValueError):
+        dispatcher.mount(make_service("/api/{operation}", "duplicate"))
+
+
+def test_dispatch_asgi(dispatcher):
+    ''' asgi requests are dispatched the same way '''
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"{}"}
+
+    async def send(message):
+        sent.append(message)
+
+    for path in ["/api/v2/foo", "/api/v3/foo"]:
+        scope = {"type": "http", "path": path, "headers": []}
+        asyncio.run(dispatcher.asgi_application(scope, receive, send))
+
+    assert ujson.loads(sent[1]["body"]) == {"service": "v2"}
+    assert sent[2]["status"] == 404
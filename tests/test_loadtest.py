@@ -0,0 +1,89 @@
+import time
+import pytest
+from pyservice import loadtest
+
+
+def test_percentile():
+    ''' Nearest-rank percentiles '''
+    values = list(range(1, 1001))
+    assert loadtest.percentile(values, 50) == 500
+    assert loadtest.percentile(values, 99) == 990
+    assert loadtest.percentile(values, 99.9) == 999
+    assert loadtest.percentile(values, 100) == 1000
+    assert loadtest.percentile([7], 99.9) == 7
+    assert loadtest.percentile([], 50) == 0.0
+
+
+def test_summary():
+    ''' Durations are summarized in milliseconds '''
+    summary = loadtest.summary([0.001, 0.002, 0.003, 0.004])
+    assert summary == {
+        "p50": 2.0, "p90": 4.0, "p99": 4.0, "p99.9": 4.0, "max": 4.0}
+
+
+def test_unknown_operation(service):
+    ''' Operations must be in the service's api '''
+    with pytest.raises(ValueError):
+        loadtest.LoadTest(service, {"missing": dict})
+    with pytest.raises(ValueError):
+        loadtest.LoadTest(service, {})
+
+
+@pytest.mark.parametrize("raw", [False, True])
+def test_run(service, raw):
+    ''' Requests are sent to a local server and reported per operation '''
+    service.operation("foo", func=lambda request, response, context:
+                      response.update(request))
+
+    @service.operation("bar")
+    def fail(request, response, context):
+        raise ValueError("always fails")
+
+    test = loadtest.LoadTest(
+        service, {"foo": lambda: {"value": 1}, "bar": dict},
+        weights={"foo": 3, "bar": 1}, rate=200, duration=0.2, workers=4,
+        raw=raw, seed=1)
+    report = test.run()
+
+    assert report["requests"] == 40
+    foo, bar = report["operations"]["foo"], report["operations"]["bar"]
+    assert foo["requests"] + bar["requests"] == 40
+    assert foo["requests"] > bar["requests"]
+    assert not foo["errors"]
+    assert sum(bar["errors"].values()) == bar["requests"]
+    assert set(foo["latency"]) == {"p50", "p90", "p99", "p99.9", "max"}
+    assert "foo" in loadtest.format_report(report)
+
+
+def test_coordinated_omission(service):
+    ''' Time queued behind slow requests counts towards latency '''
+    @service.operation("foo")
+    def foo(request, response, context):
+        time.sleep(0.02)
+
+    # One worker can only serve 50/s, so requests queue up
+    test = loadtest.LoadTest(
+        service, {"foo": dict}, rate=100, duration=0.2, workers=1)
+    stats = test.run()["operations"]["foo"]
+
+    assert stats["service_time"]["p99"] < 50
+    assert stats["latency"]["p99"] > 150
+
+
+def test_http_post_drops_failed_connection(service):
+    ''' A timed out connection isn't reused by the thread's next request '''
+    @service.operation("foo")
+    def foo(request, response, context):
+        time.sleep(request.sleep)
+
+    server = loadtest.serve(service)
+    try:
+        post = loadtest.http_post(*server.server_address[:2], timeout=0.1)
+        headers = {"Content-Type": "application/json"}
+        with pytest.raises(OSError):
+            post("/test/foo", '{"sleep": 0.3}', headers)
+        for _ in range(3):
+            post("/test/foo", '{"sleep": 0}', headers)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,193 @@
+import asyncio
+import collections
+import io
+import threading
+import pytest
+import ujson
+from pyservice import AsyncClient, Client, Service, metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Metrics(buckets=(0.1, 1.0))
+
+
+def test_observe(registry):
+    ''' Requests, sizes, errors and latency buckets are recorded '''
+    registry.observe("foo", 0.05, 10, 20)
+    registry.observe("foo", 0.1, 1, 2, ValueError())
+    registry.observe("foo", 5, exception=KeyError())
+    registry.observe("bar", 0.5, exception=ValueError())
+
+    totals = registry.snapshot()
+    foo = totals["foo"]
+    assert foo.requests == 3
+    assert foo.request_bytes == 11
+    assert foo.response_bytes == 22
+    assert foo.latency == pytest.approx(5.15)
+    # Bounds are inclusive, the last bucket is the overflow
+    assert foo.buckets == [2, 0, 1]
+    assert foo.errors == {"ValueError": 1, "KeyError": 1}
+    assert totals["bar"].buckets == [0, 1, 0]
+
+
+def test_threads_aggregated(registry):
+    ''' Each thread records into its own shard, snapshots sum them all '''
+    def record():
+        for _ in range(100):
+            registry.observe("foo", 0.01)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert registry.snapshot()["foo"].requests == 800
+
+    # Shards of exited threads are folded together
+    assert not registry.shards
+    registry.observe("foo", 0.01)
+    assert len(registry.shards) == 1
+    assert registry.snapshot()["foo"].requests == 801
+
+
+def test_render(registry):
+    ''' Snapshots are rendered in the text exposition format '''
+    registry.observe("foo", 0.5, 3, 4, ValueError())
+    lines = registry.render().splitlines()
+
+    assert "# TYPE pyservice_requests_total counter" in lines
+    assert 'pyservice_requests_total{operation="foo"} 1' in lines
+    assert ('pyservice_errors_total{operation="foo",exception="ValueError"}'
+            ' 1') in lines
+    assert 'pyservice_request_bytes_total{operation="foo"} 3' in lines
+    assert 'pyservice_response_bytes_total{operation="foo"} 4' in lines
+    assert "# TYPE pyservice_latency_seconds histogram" in lines
+    # Buckets are cumulative
+    assert ('pyservice_latency_seconds_bucket{operation="foo",le="0.1"} 0'
+            in lines)
+    assert ('pyservice_latency_seconds_bucket{operation="foo",le="1.0"} 1'
+            in lines)
+    assert ('pyservice_latency_seconds_bucket{operation="foo",le="+Inf"} 1'
+            in lines)
+    assert 'pyservice_latency_seconds_sum{operation="foo"} 0.5' in lines
+    assert 'pyservice_latency_seconds_count{operation="foo"} 1' in lines
+
+
+def test_escape():
+    ''' Label values are escaped '''
+    assert metrics.escape('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+
+def test_service_records(service, wsgi_call):
+    ''' Service requests are recorded by operation, errors by class '''
+    service.operation("foo", func=lambda request, response, context:
+                      response.update(value=request.value))
+
+    @service.operation("bar")
+    def bar(request, response, context):
+        raise KeyError("missing")
+
+    wsgi_call(service, "foo", '{"value": 1}')
+    response = wsgi_call(service, "bar", "{}")
+
+    totals = service.metrics.snapshot()
+    assert totals["foo"].requests == 1
+    assert totals["foo"].request_bytes == len('{"value": 1}')
+    assert totals["foo"].response_bytes == len('{"value":1}')
+    assert not totals["foo"].errors
+    assert totals["bar"].errors == {"KeyError": 1}
+    assert totals["bar"].response_bytes == len(response)
+
+
+def test_async_service_records(service):
+    ''' asgi requests are recorded the same way '''
+    @service.operation("foo")
+    async def foo(request, response, context):
+        raise ValueError()
+
+    async def receive():
+        return {"type": "http.request", "body": b"{}"}
+
+    async def send(message):
+        pass
+
+    scope = {"type": "http", "path": "/test/foo", "headers": []}
+    asyncio.run(service.asgi_application(scope, receive, send))
+    assert service.metrics.snapshot()["foo"].errors == {"ValueError": 1}
+
+
+def test_expose_metrics(api, wsgi_call, start_response):
+    ''' Metrics are only served when the api asks for them '''
+    service = Service(**api)
+    service.operation("foo", func=lambda request, response, context: None)
+    wsgi_call(service, "foo", "{}")
+    wsgi_call(service, "__metrics__", "")
+    assert start_response.status == "404 Not Found"
+
+    api["expose_metrics"] = True
+    service = Service(**api)
+    service.operation("foo", func=lambda request, response, context: None)
+    wsgi_call(service, "foo", "{}")
+    # Scrapers don't send a body
+    environ = {"PATH_INFO": "/test/__metrics__"}
+    body = b"".join(service.wsgi_application(environ, start_response))
+    assert start_response.status == "200 OK"
+    assert ("Content-Type", metrics.CONTENT_TYPE) in start_response.headers
+    assert b'pyservice_requests_total{operation="foo"} 1' in body
+
+
+def test_metrics_disabled(api, wsgi_call, start_response):
+    ''' Setting __metrics__ to None disables recording '''
+    class Unmetered(Service):
+        __metrics__ = None
+    api["expose_metrics"] = True
+    service = Unmetered(**api)
+    service.operation("foo", func=lambda request, response, context: None)
+    wsgi_call(service, "foo", "{}")
+    assert start_response.status == "200 OK"
+    wsgi_call(service, "__metrics__", "")
+    assert start_response.status == "404 Not Found"
+
+
+Response = collections.namedtuple(
+    "Response", ["status_code", "text", "reason", "headers"], defaults=[{}])
+
+
+def test_client_records(api):
+    ''' Client calls are recorded, including remote exceptions '''
+    client = Client(**api)
+
+    class Transport:
+        def send(self, uri, data, headers=None, timeout=None):
+            if uri.endswith("bar"):
+                body = ujson.dumps({"__exception__": {
+                    "cls": "Missing", "args": []}})
+            else:
+                body = data
+            return Response(200, body, "OK")
+    client.transport = Transport()
+
+    client.foo(key="value")
+    with pytest.raises(client.exceptions.Missing):
+        client.bar()
+
+    totals = client.metrics.snapshot()
+    size = len(ujson.dumps({"key": "value"}))
+    assert totals["foo"].requests == 1
+    assert totals["foo"].request_bytes == size
+    assert totals["foo"].response_bytes == size
+    assert totals["bar"].errors == {"Missing": 1}
+
+
+def test_async_client_records(api):
+    ''' AsyncClient calls are recorded '''
+    client = AsyncClient(**api)
+
+    class Transport:
+        async def send(self, uri, data, headers=None, timeout=None):
+            return Response(200, data, "OK")
+    client.transport = Transport()
+
+    asyncio.run(client.foo(key="value"))
+    assert client.metrics.snapshot()["foo"].requests == 1
@@ -1,34 +1,39 @@
+import gc
+import io
 import ujson
 import pytest
 import collections
-from pyservice import processors, Client
+from pyservice import codecs, compression, processors, transport, wsgi, Client
 
 
-class RequestPostCapture:
+class TransportCapture:
     Response = collections.namedtuple(
-        "Response", ["status_code", "text", "reason"])
+        "Response", ["status_code", "text", "reason", "headers"],
+        defaults=[{}])
 
     def __init__(self, status_code, text, reason=None):
         self.response = self.Response(status_code, text, reason=reason)
 
-    def post(self, uri, data, timeout):
+    def send(self, uri, data, headers=None, timeout=None):
         self.uri = uri
         self.data = data
+        self.headers = headers
         self.timeout = timeout
         return self.response
 
 
 @pytest.fixture
-def set_response(monkeypatch):
+def set_response(client):
     '''
-    Patch requests.post to return the given status, text, and reason.
+    Replace the client's transport to return the given status, text, and
+    reason.
 
-    The return value can be used to inspect the captured input to the patched
-    method.  Available fields are uri, data, timeout.
+    The return value can be used to inspect the captured input to the
+    transport.  Available fields are uri, data, headers, timeout.
     '''
     def make_capture(status_code, text, reason=None):
-        capture = RequestPostCapture(status_code, text, reason=reason)
-        monkeypatch.setattr("requests.post", capture.post)
+        capture = TransportCapture(status_code, text, reason=reason)
+        client.transport = capture
         return capture
     return make_capture
 
@@ -103,6 +108,47 @@ def test_processor_plugin_scopes():
     assert called == ["request", "operation"]
 
 
+def test_processor_short_circuit():
+    ''' Plugins that don't continue skip the rest of the chain '''
+    process = Processor("my_operation", "not used")
+
+    @process.obj.plugin(scope="operation")
+    def cache_plugin(request, response, context):
+        pass
+
+    process()
+    assert process.calls["_execute"] == 0
+    assert process.calls[("enter_scope", "function")] == 0
+    # Scopes that were entered are still exited
+    assert process.calls[("exit_scope", "operation")] == 1
+    assert process.calls[("exit_scope", "request")] == 1
+
+
+def test_processor_chain_cached():
+    ''' Chains are compiled once per processor class '''
+    process = Processor("my_operation", "not used")
+    client = process.obj
+    chain = client.chain(Processor)
+
+    assert client.chain(Processor) is chain
+    # 3 scopes + execute
+    assert len(chain) == 4
+
+
+def test_processor_chain_invalidated():
+    ''' Adding a plugin recompiles the chain '''
+    process = Processor("my_operation", "not used")
+    client = process.obj
+    chain = client.chain(Processor)
+
+    @client.plugin(scope="request")
+    def plugin(context):
+        context.process_request()
+
+    assert client.chain(Processor) is not chain
+    assert len(client.chain(Processor)) == 5
+
+
 def test_client_processor_posts(client, set_response):
     ''' Result should be unpacked from request.post '''
     operation = "foo"
@@ -134,6 +180,18 @@ def test_client_handle_http_error(client, set_response):
         process()
 
 
+def test_client_wraps_transport_error(client):
+    ''' Transport failures are raised as RequestException '''
+    class FailingTransport:
+        def send(self, uri, data, headers=None, timeout=None):
+            raise transport.TransportError("Connection refused")
+    client.transport = FailingTransport()
+    process = processors.ClientProcessor(client, "foo", {})
+
+    with pytest.raises(client.exceptions.RequestException):
+        process()
+
+
 def test_client_handle_remote_error(client, set_response):
     ''' Correctly raise a remote exception '''
     operation = "foo"
@@ -156,6 +214,113 @@ def test_client_handle_remote_error(client, set_response):
         process()
 
 
+def test_client_processor_codec(client, set_response):
+    ''' Requests use the client's codec, responses their content type '''
+    client.codec = client.codecs["application/x-msgpack"]
+    capture = set_response(200, None)
+    capture.response = transport.Response(
+        200, "OK", {"content-type": "application/json"}, b'{"echo": 1}')
+
+    response = processors.ClientProcessor(client, "foo", {"key": 1})()
+    assert codecs.unpack(capture.data) == {"key": 1}
+    assert capture.headers["Content-Type"] == "application/x-msgpack"
+    assert capture.headers["Accept"] == "application/x-msgpack"
+    assert response.echo == 1
+
+
+def test_client_processor_compression(client, set_response):
+    ''' Large requests are compressed, compressed responses decoded '''
+    client.api["compress_requests"] = True
+    capture = set_response(200, None)
+    body = compression.compress(ujson.dumps({"echo": 1}).encode(), "gzip")
+    capture.response = transport.Response(
+        200, "OK", {"content-encoding": "gzip"}, body)
+
+    response = processors.ClientProcessor(
+        client, "foo", {"key": "x" * 2000})()
+    assert capture.headers["Content-Encoding"] == "gzip"
+    assert capture.headers["Accept-Encoding"] == "gzip, deflate"
+    assert ujson.loads(compression.decompress(capture.data, "gzip")) == {
+        "key": "x" * 2000}
+    assert response.echo == 1
+
+    # Small requests aren't compressed
+    processors.ClientProcessor(client, "foo", {"key": "x"})()
+    assert "Content-Encoding" not in capture.headers
+
+
+def test_client_requests_uncompressed_by_default(client, set_response):
+    ''' Requests aren't compressed unless compress_requests is set '''
+    capture = set_response(200, "{}")
+    processors.ClientProcessor(client, "foo", {"key": "x" * 2000})()
+    assert "Content-Encoding" not in capture.headers
+    assert capture.headers["Accept-Encoding"] == "gzip, deflate"
+
+
+def test_client_response_size_limit(client, set_response):
+    ''' Responses are limited to max_response_size, once decoded '''
+    capture = set_response(200, None)
+    body = ujson.dumps({"key": "x" * 2000}).encode()
+    client.api["max_response_size"] = 1000
+    for response in [
+            transport.Response(200, "OK", {}, body),
+            transport.Response(200, "OK", {"content-encoding": "gzip"},
+                               compression.compress(body, "gzip"))]:
+        capture.response = response
+        with pytest.raises(client.exceptions.RequestException):
+            processors.ClientProcessor(client, "foo", {})()
+
+    # Unlimited by default
+    client.api["max_response_size"] = None
+    assert processors.ClientProcessor(client, "foo", {})().key == "x" * 2000
+
+
+def test_client_processor_malformed_compression(client, set_response):
+    ''' Undecodable responses raise RequestException '''
+    capture = set_response(200, None)
+    capture.response = transport.Response(
+        200, "OK", {"content-encoding": "gzip"}, b"garbage")
+    with pytest.raises(client.exceptions.RequestException):
+        processors.ClientProcessor(client, "foo", {})()
+
+
+class StreamCapture:
+    ''' Transport that returns a streamed response with the given lines '''
+    def __init__(self, *lines):
+        self.closed = False
+        self.response = transport.StreamedResponse(
+            200, "OK", {"content-type": "application/x-ndjson"},
+            io.BytesIO(b"".join(lines)), self.close, self.close)
+
+    def close(self):
+        self.closed = True
+
+    def send(self, uri, data, headers=None, timeout=None):
+        return self.response
+
+
+def test_client_streamed_records(client):
+    ''' Streamed responses are iterated lazily as containers '''
+    client.transport = StreamCapture(b'{"n": 1}\n', b"\n", b'{"n": 2}\n')
+    records = processors.ClientProcessor(client, "foo", {})()
+
+    assert not client.transport.closed
+    assert [record.n for record in records] == [1, 2]
+    assert client.transport.closed
+
+
+def test_client_streamed_exception(client):
+    ''' An exception record ends the stream with a native exception '''
+    client.transport = StreamCapture(
+        b'{"n": 1}\n',
+        b'{"__exception__": {"cls": "FooException", "args": ["text"]}}\n')
+    records = processors.ClientProcessor(client, "foo", {})()
+
+    assert next(records).n == 1
+    with pytest.raises(client.exceptions.FooException):
+        next(records)
+
+
 def test_client_debug_remote_error(client, set_response):
     '''
     Plugins should have access to the response body after an
@@ -275,3 +440,98 @@ def test_service_processor_redacts_non_whitelist(service):
         }
     }
     assert ujson.loads(result) == expected
+
+
+def test_service_batch_runs_each_entry(service):
+    ''' Every entry runs through the plugin chain, in order '''
+    called = []
+
+    @service.plugin(scope="operation")
+    def plugin(request, response, context):
+        called.append(context.operation)
+        context.process_request()
+
+    @service.operation("foo")
+    def foo(request, response, context):
+        response.value = request.value * 2
+
+    @service.operation("bar")
+    def bar(request, response, context):
+        response.value = request.value + 1
+
+    body = ujson.dumps({"operations": [
+        {"operation": "foo", "request": {"value": 2}},
+        {"operation": "bar", "request": {"value": 2}}
+    ]})
+    result = ujson.loads(processors.batch(service, body))
+
+    assert result == {"results": [{"value": 4}, {"value": 3}]}
+    assert called == ["foo", "bar"]
+
+
+def test_service_batch_parallel(service):
+    ''' Parallel entries run on the executor, results keep their order '''
+    @service.operation("foo")
+    def foo(request, response, context):
+        response.value = request.value
+
+    body = ujson.dumps({"parallel": True, "operations": [
+        {"operation": "foo", "request": {"value": i}} for i in range(20)
+    ]})
+    result = ujson.loads(processors.batch(service, body))
+
+    assert result == {"results": [{"value": i} for i in range(20)]}
+
+
+def test_service_batch_entry_exceptions(service):
+    ''' Failed entries serialize their exception without failing the batch '''
+    service.api["exceptions"].append("FooException")
+
+    @service.operation("foo")
+    def foo(request, response, context):
+        raise service.exceptions.FooException("args")
+
+    body = ujson.dumps({"operations": [
+        {"operation": "foo", "request": {}},
+        {"operation": "unknown", "request": {}}
+    ]})
+    result = ujson.loads(processors.batch(service, body))
+
+    assert result == {"results": [
+        {"__exception__": {"cls": "FooException", "args": ["args"]}},
+        {"__exception__": {"cls": "RequestException", "args": [404]}}
+    ]}
+
+
+def test_service_batch_malformed(service):
+    ''' A body without a list of operations is a bad request '''
+    with pytest.raises(wsgi.RequestException):
+        processors.batch(service, ujson.dumps({"operations": ["foo"]}))
+
+
+def test_service_processor_no_reference_cycles(service):
+    ''' Processors and contexts are freed without the GC '''
+    @service.plugin(scope="request")
+    def plugin(context):
+        context.process_request()
+
+    @service.operation("foo")
+    def foo(request, response, context):
+        response.key = request.key
+
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(10):
+            processors.ServiceProcessor(service, "foo", '{"key": 1}')()
+        # Only the request and response Containers, which are their own
+        # __dict__
+        assert gc.collect() == 2 * 10
+    finally:
+        gc.enable()
+
+
+def test_processor_slots(client):
+    ''' Processors don't allocate an instance __dict__ '''
+    process = processors.ClientProcessor(client, "foo", {})
+    assert not hasattr(process, "__dict__")
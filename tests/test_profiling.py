@@ -0,0 +1,93 @@
+import pstats
+import sys
+import time
+import pytest
+from pyservice import profiling
+
+
+@pytest.fixture
+def profile(wsgi_call, start_response):
+    ''' Function that calls foo with a token, returning its profile name '''
+    def call(service, token):
+        environ = {}
+        if token is not None:
+            environ[profiling.ENVIRON_KEY] = token
+        wsgi_call(service, environ=environ)
+        return dict(start_response.headers).get(profiling.RESPONSE_HEADER)
+    return call
+
+
+@pytest.fixture
+def slow_service(service):
+    @service.operation("foo")
+    def slow_operation(request, response, context):
+        time.sleep(0.02)
+        response.done = True
+    return service
+
+
+def test_profiler_validation():
+    ''' A token is required, and the mode must be known '''
+    with pytest.raises(ValueError):
+        profiling.Profiler("")
+    with pytest.raises(ValueError):
+        profiling.Profiler("token", mode="unknown")
+
+
+def test_authorized():
+    ''' Only the exact token is authorized '''
+    profiler = profiling.Profiler("secret")
+    assert profiler.authorized("secret")
+    assert not profiler.authorized("secret2")
+    assert not profiler.authorized("")
+    assert not profiler.authorized(None)
+
+
+def test_cprofile_request(slow_service, profile, start_response, tmp_path):
+    ''' Authorized requests are profiled into the directory '''
+    slow_service.profiler = profiling.Profiler(
+        "secret", directory=str(tmp_path))
+    name = profile(slow_service, "secret")
+    assert start_response.status == "200 OK"
+    assert name.endswith("-foo.prof")
+
+    stats = pstats.Stats(str(tmp_path / name))
+    functions = [function for _, _, function in stats.stats]
+    assert "slow_operation" in functions
+
+
+def test_sampled_request(slow_service, profile):
+    ''' Sampled profiles are collapsed stacks, kept when there's no dir '''
+    slow_service.profiler = profiling.Profiler("secret", mode="sample")
+    name = profile(slow_service, "secret")
+    assert name.endswith("-foo.collapsed")
+
+    [(saved, data)] = slow_service.profiler.profiles
+    assert saved == name
+    assert "slow_operation" in data.decode("UTF-8")
+
+
+def test_unauthorized_request(slow_service, profile, start_response):
+    ''' Requests without the token are served without profiling '''
+    slow_service.profiler = profiling.Profiler("secret")
+    assert profile(slow_service, None) is None
+    assert profile(slow_service, "guess") is None
+    assert start_response.status == "200 OK"
+    assert not slow_service.profiler.profiles
+
+
+def test_one_profile_at_a_time():
+    ''' Requests aren't profiled while another one is '''
+    profiler = profiling.Profiler("secret")
+    with profiler.lock:
+        assert profiler.run("foo", lambda x: x * 2, 3) == (6, None)
+    result, name = profiler.run("foo", lambda x: x * 2, 3)
+    assert result == 6
+    assert name is not None
+
+
+def test_collapse():
+    ''' Stacks run from the root to the given frame '''
+    stack = profiling.collapse(sys._getframe())
+    assert stack.split(";")[-1].startswith("test_collapse (")
+    assert stack.count(";") > 0
@@ -0,0 +1,176 @@
+import gc
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import pytest
+import ujson
+from pyservice import runner
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(os, "fork"), reason="runner needs fork")
+
+APP = '''
+import gc
+import os
+import pyservice
+
+VERSION = {version}
+
+service = pyservice.Service(
+    endpoint={{"scheme": "http", "pattern": "/api/{{operation}}",
+              "host": "localhost", "port": 8080}},
+    operations=["info"])
+
+
+@service.operation("info")
+def info(request, response, context):
+    response.version = VERSION
+    response.pid = os.getpid()
+    response.frozen = gc.get_freeze_count()
+'''
+
+
+def write_app(directory, version):
+    with open(os.path.join(directory, "runner_app.py"), "w") as file:
+        file.write(APP.format(version=version))
+
+
+def call(port):
+    request = urllib.request.Request(
+        "http://127.0.0.1:{}/api/info".format(port), data=b"{}",
+        headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return ujson.loads(response.read())
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            result = condition()
+            if result:
+                return result
+        except OSError:
+            pass
+        time.sleep(0.05)
+    raise AssertionError("Timed out")
+
+
+@pytest.fixture
+def run(tmpdir):
+    ''' Start the runner on a free port; returns (process, port) '''
+    processes = []
+    write_app(str(tmpdir), 1)
+
+    def start(*args):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [str(tmpdir), os.path.dirname(os.path.dirname(__file__))])
+        process = subprocess.Popen(
+            [sys.executable, "-m", "pyservice.runner", "runner_app:service",
+             "--port", str(port), "--workers", "2", "--timeout", "5"] +
+            list(args), env=env, cwd=str(tmpdir),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(process)
+        wait_for(lambda: call(port))
+        return process, port
+    yield start
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+@pytest.mark.parametrize("reuse_port", [False, True])
+def test_serve(run, reuse_port):
+    ''' Workers serve from the frozen heap forked from the master '''
+    process, port = run(*(["--reuse-port"] if reuse_port else []))
+    response = call(port)
+    assert response["version"] == 1
+    assert response["pid"] != process.pid
+    assert response["frozen"] > 0
+
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(timeout=10) == 0
+
+
+def test_restart_worker(run):
+    ''' Workers that die are replaced '''
+    process, port = run()
+    pid = call(port)["pid"]
+    os.kill(pid, signal.SIGKILL)
+    wait_for(lambda: call(port)["pid"] != pid)
+    # Both workers are still running: the dead one's been replaced
+    pids = set()
+    wait_for(lambda: pids.add(call(port)["pid"]) or len(pids) == 2)
+    assert pid not in pids
+
+
+def test_reload(run, tmpdir):
+    ''' HUP re-imports the application and replaces the workers '''
+    process, port = run()
+    old = call(port)["pid"]
+    write_app(str(tmpdir), 2)
+    process.send_signal(signal.SIGHUP)
+    wait_for(lambda: call(port)["version"] == 2)
+    assert call(port)["pid"] != old
+
+
+def test_runner_from_string(tmpdir, monkeypatch):
+    ''' Apps are imported by name without turning the collector off '''
+    write_app(str(tmpdir), 1)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    try:
+        app = runner.Runner("runner_app:service", port=0)
+        assert app.app is sys.modules["runner_app"].service
+        assert app.target == "runner_app:service"
+        assert gc.isenabled()
+    finally:
+        runner.unload("runner_app:service")
+    with pytest.raises(ValueError):
+        runner.Runner("runner_app")
+
+
+def test_cpus():
+    ''' Workers are pinned to the CPUs they're allowed to run on '''
+    assert runner.cpus(False) is None
+    assert runner.cpus([3, 1]) == [3, 1]
+    if hasattr(os, "sched_getaffinity"):
+        assert runner.cpus(True) == sorted(os.sched_getaffinity(0))
+
+
+def test_listen(service):
+    ''' The master's socket is only listening when workers share it '''
+    shared = runner.Runner(service, port=0, workers=1)
+    separate = runner.Runner(service, port=0, workers=1, reuse_port=True)
+    try:
+        host, port = shared.listen()
+        assert port
+        # Workers with their own sockets can join the port
+        separate.port = port
+        assert separate.listen() == (host, port)
+        assert not shared.socket.getblocking()
+    finally:
+        shared.socket.close()
+        separate.socket.close()
+
+
+def test_compile_chains(service):
+    ''' Chains are compiled before forking so workers share them '''
+    service.api["deadline"] = False
+    runner.compile_chains(service)
+    assert len(service.chains) == 2
+    service.api["server_timing"] = True
+    runner.compile_chains(service)
+    assert len(service.chains) == 4
+    service.api["deadline"] = True
+    runner.compile_chains(service)
+    assert len(service.chains) == 8
+    runner.compile_chains(lambda environ, start_response: None)
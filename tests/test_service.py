@@ -1,5 +1,10 @@
+import asyncio
+import io
+import threading
+import time
 import pytest
-from pyservice import Service
+import ujson
+from pyservice import Service, caching, codecs, compression, processors, wsgi
 
 
 def test_load_api_defaults():
@@ -114,10 +119,12 @@ def test_wsgi_application(service, environment, start_response):
 
     result = service.wsgi_application(environ, start_response)
     assert result == [bytes(return_value, 'utf8')]
-    assert process_args == ["foo", body]
+    assert process_args == [
+        "foo", body, codecs.JSON, codecs.JSON, None, None]
     assert start_response.status == '200 OK'
-    assert start_response.headers == [('Content-Length',
-                                       str(len(return_value)))]
+    assert start_response.headers == [
+        ('Content-Length', str(len(return_value))),
+        ('Content-Type', 'application/json')]
 
 
 def test_wsgi_unknown_operation(service, environment, start_response):
@@ -148,3 +155,585 @@ def test_wsgi_unknown_exception(service, environment, start_response):
     assert result == [b'']
     assert start_response.status == '500 Internal Server Error'
     assert start_response.headers == [('Content-Length', '0')]
+
+
+def call_asgi(service, path, body):
+    ''' Run service.asgi_application and return (status, body) '''
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body.encode("UTF-8")}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": path, "headers": []}
+    asyncio.run(service.asgi_application(scope, receive, send))
+    return sent[0]["status"], sent[1]["body"].decode("UTF-8")
+
+
+def test_asgi_coroutine_operation(service):
+    ''' Coroutine operations and plugins are awaited '''
+    called = []
+
+    @service.plugin(scope="request")
+    async def request_plugin(context):
+        called.append("request")
+        await context.process_request()
+
+    @service.operation("foo")
+    async def foo(request, response, context):
+        called.append("foo")
+        response.value = request.value
+
+    status, body = call_asgi(service, "/test/foo", '{"value": 1}')
+    assert status == 200
+    assert ujson.loads(body) == {"value": 1}
+    assert called == ["request", "foo"]
+
+
+def test_asgi_sync_operation_uses_executor(service):
+    ''' Synchronous operations run off the event loop thread '''
+    threads = []
+
+    @service.operation("foo")
+    def foo(request, response, context):
+        threads.append(threading.current_thread())
+
+    status, body = call_asgi(service, "/test/foo", '{}')
+    assert status == 200
+    assert threads[0] is not threading.main_thread()
+
+
+def test_asgi_unknown_operation(service):
+    ''' Response is 404 when operation is unknown '''
+    status, body = call_asgi(service, "/test/not_an_operation", '')
+    assert status == 404
+    assert body == ''
+
+
+def test_asgi_lifespan(service):
+    ''' lifespan events are acknowledged '''
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(service.asgi_application(
+        {"type": "lifespan"}, receive, send))
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+
+
+def test_asgi_batch(service):
+    ''' Batches are served through asgi, entries run concurrently '''
+    @service.operation("foo")
+    async def foo(request, response, context):
+        response.value = request.value
+
+    body = ujson.dumps({"parallel": True, "operations": [
+        {"operation": "foo", "request": {"value": i}} for i in range(5)
+    ]})
+    status, body = call_asgi(service, "/test/__batch__", body)
+    assert status == 200
+    assert ujson.loads(body) == {"results": [{"value": i} for i in range(5)]}
+
+
+def test_batched_operation_binding(service):
+    ''' batched operations are wrapped in a Batcher '''
+    @service.operation("foo", batched=True, max_batch=4, max_wait_ms=1)
+    def foo(requests, responses, contexts):
+        for request, response in zip(requests, responses):
+            response.value = request.value
+
+    batcher = service.functions["foo"]
+    assert batcher.func is foo
+    assert batcher.max_batch == 4
+
+    status, body = call_asgi(service, "/test/foo", '{"value": 3}')
+    assert ujson.loads(body) == {"value": 3}
+
+
+def test_asgi_coroutine_batched_operation(service):
+    ''' Coroutine batch functions are awaited under asgi '''
+    @service.operation("foo", batched=True, max_batch=4, max_wait_ms=1)
+    async def foo(requests, responses, contexts):
+        for request, response in zip(requests, responses):
+            response.value = request.value
+
+    status, body = call_asgi(service, "/test/foo", '{"value": 3}')
+    assert ujson.loads(body) == {"value": 3}
+
+
+def test_stream_operation(service, environment, start_response):
+    ''' Streaming operations read context.stream instead of request '''
+    @service.operation("foo", stream=True)
+    def foo(request, response, context):
+        response.size = len(context.stream.read())
+        response.request = request
+
+    body = "x" * (wsgi.MEMFILE_MAX * 2)
+    environ = environment(body, len(body))
+    environ["PATH_INFO"] = "/test/foo"
+
+    # The api's default limit still applies to streamed bodies
+    service.wsgi_application(environ, start_response)
+    assert start_response.status.startswith('413')
+
+    service.options["foo"]["max_body_size"] = len(body)
+    environ = environment(body, len(body))
+    environ["PATH_INFO"] = "/test/foo"
+    result = service.wsgi_application(environ, start_response)
+    assert ujson.loads(result[0]) == {"size": len(body), "request": {}}
+
+
+def test_wsgi_streaming_operation(service, environment, start_response):
+    ''' Generator operations stream one serialized record per line '''
+    service.api["exceptions"].append("Stop")
+
+    @service.operation("foo")
+    def foo(request, response, context):
+        for value in range(request.count):
+            yield {"value": value}
+        raise service.exceptions.Stop("done")
+
+    environ = environment('{"count": 2}', 12)
+    environ["PATH_INFO"] = "/test/foo"
+    result = service.wsgi_application(environ, start_response)
+
+    assert start_response.status == '200 OK'
+    assert start_response.headers == [
+        ("Content-Type", "application/x-ndjson")]
+    assert [ujson.loads(line) for line in result] == [
+        {"value": 0},
+        {"value": 1},
+        {"__exception__": {"cls": "Stop", "args": ["done"]}}
+    ]
+
+
+def test_asgi_streaming_operation(service):
+    ''' Async generator operations send one body message per record '''
+    sent = []
+
+    @service.operation("foo")
+    async def foo(request, response, context):
+        for value in range(request.count):
+            yield {"value": value}
+
+    async def receive():
+        return {"type": "http.request", "body": b'{"count": 2}'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/test/foo", "headers": []}
+    asyncio.run(service.asgi_application(scope, receive, send))
+
+    assert sent[0]["headers"] == [(b"content-type", b"application/x-ndjson")]
+    assert [message["body"] for message in sent[1:]] == [
+        b'{"value":0}\n', b'{"value":1}\n', b""]
+    assert not sent[-1].get("more_body", False)
+
+
+def test_stream_records_from_request(service, environment, start_response):
+    ''' Streamed request bodies stay open until the response is sent '''
+    streams = []
+
+    @service.operation("foo", stream=True)
+    def foo(request, response, context):
+        streams.append(context.stream)
+        for line in context.stream:
+            yield {"line": line.decode("UTF-8").strip()}
+
+    environ = environment("a\nb\n", 4)
+    environ["PATH_INFO"] = "/test/foo"
+    result = service.wsgi_application(environ, start_response)
+    assert [ujson.loads(line) for line in result] == [
+        {"line": "a"}, {"line": "b"}]
+    assert not streams[0].closed
+    result.close()
+    assert streams[0].closed
+
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"a\nb\n"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/test/foo", "headers": []}
+    asyncio.run(service.asgi_application(scope, receive, send))
+    assert [message["body"] for message in sent[1:]] == [
+        b'{"line":"a"}\n', b'{"line":"b"}\n', b""]
+    assert streams[1].closed
+
+
+def test_wsgi_msgpack_round_trip(service, environment, start_response):
+    ''' Requests are decoded and responses encoded by the headers '''
+    @service.operation("foo")
+    def foo(request, response, context):
+        response.value = request.value + 1
+
+    body = codecs.pack({"value": 1})
+    environ = {
+        "PATH_INFO": "/test/foo",
+        "CONTENT_LENGTH": str(len(body)),
+        "CONTENT_TYPE": "application/x-msgpack",
+        "HTTP_ACCEPT": "application/json",
+        "wsgi.input": io.BytesIO(body)
+    }
+    result = service.wsgi_application(environ, start_response)
+    assert ujson.loads(result[0]) == {"value": 2}
+    assert ("Content-Type", "application/json") in start_response.headers
+
+
+def test_wsgi_unsupported_media_type(service, environment, start_response):
+    ''' Unknown content types are rejected before the body is read '''
+    service.operation("foo", func=lambda *args: None)
+    environ = environment("<xml/>", 6)
+    environ["PATH_INFO"] = "/test/foo"
+    environ["CONTENT_TYPE"] = "text/xml"
+    service.wsgi_application(environ, start_response)
+    assert start_response.status == "415 Unsupported Media Type"
+
+
+def test_asgi_msgpack_round_trip(service):
+    ''' Binary codecs are negotiated from the asgi headers '''
+    sent = []
+
+    @service.operation("foo")
+    async def foo(request, response, context):
+        response.value = request.value + 1
+
+    async def receive():
+        return {"type": "http.request", "body": codecs.pack({"value": 1})}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/test/foo",
+             "headers": [(b"content-type", b"application/x-msgpack")]}
+    asyncio.run(service.asgi_application(scope, receive, send))
+
+    assert (b"content-type", b"application/x-msgpack") in sent[0]["headers"]
+    assert codecs.unpack(sent[1]["body"]) == {"value": 2}
+
+
+def test_wsgi_compression(service, start_response):
+    ''' Compressed requests are decoded, large responses compressed '''
+    @service.operation("foo")
+    def foo(request, response, context):
+        response.value = request.value * 2
+
+    body = compression.compress(ujson.dumps({"value": "x" * 1000}).encode(),
+                                "deflate")
+    environ = {
+        "PATH_INFO": "/test/foo",
+        "CONTENT_LENGTH": str(len(body)),
+        "HTTP_CONTENT_ENCODING": "deflate",
+        "HTTP_ACCEPT_ENCODING": "gzip, deflate",
+        "wsgi.input": io.BytesIO(body)
+    }
+    result = service.wsgi_application(environ, start_response)
+
+    assert ("Content-Encoding", "gzip") in start_response.headers
+    body = compression.decompress(result[0], "gzip")
+    assert ujson.loads(body) == {"value": "x" * 2000}
+
+
+def test_wsgi_compression_disabled(service, start_response):
+    ''' Responses aren't compressed when compress_min_size is None '''
+    service.api["compress_min_size"] = None
+    service.operation("foo", func=lambda request, response, context:
+                      response.update(value="x" * 2000))
+    environ = {
+        "PATH_INFO": "/test/foo",
+        "CONTENT_LENGTH": "2",
+        "HTTP_ACCEPT_ENCODING": "gzip",
+        "wsgi.input": io.BytesIO(b"{}")
+    }
+    result = service.wsgi_application(environ, start_response)
+    assert ujson.loads(result[0]) == {"value": "x" * 2000}
+
+
+def test_asgi_compression(service):
+    ''' Compressed asgi requests are decoded, and responses compressed '''
+    sent = []
+
+    @service.operation("foo")
+    async def foo(request, response, context):
+        response.value = request.value * 2
+
+    body = compression.compress(ujson.dumps({"value": "x" * 1000}).encode(),
+                                "gzip")
+
+    async def receive():
+        return {"type": "http.request", "body": body}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/test/foo", "headers": [
+        (b"content-encoding", b"gzip"), (b"accept-encoding", b"gzip")]}
+    asyncio.run(service.asgi_application(scope, receive, send))
+
+    assert (b"content-encoding", b"gzip") in sent[0]["headers"]
+    response = compression.decompress(sent[1]["body"], "gzip")
+    assert ujson.loads(response) == {"value": "x" * 2000}
+
+
+def test_asgi_compressed_body_limit(service):
+    ''' The limit applies to the decompressed asgi body '''
+    body = compression.compress(b"x" * 200000, "gzip")
+
+    async def receive():
+        return {"type": "http.request", "body": body}
+
+    async def send(message):
+        sent.append(message)
+    sent = []
+    service.operation("foo", func=lambda *args: None)
+    scope = {"type": "http", "path": "/test/foo",
+             "headers": [(b"content-encoding", b"gzip")]}
+    asyncio.run(service.asgi_application(scope, receive, send))
+    assert sent[0]["status"] == 413
+
+
+def test_cached_operation(service, start_response):
+    ''' Identical requests are served from the cache '''
+    called = []
+    cache = caching.Cache()
+
+    @service.plugin(scope="request")
+    def request_plugin(context):
+        called.append("request")
+        context.process_request()
+
+    @service.plugin(scope="operation")
+    def operation_plugin(request, response, context):
+        called.append("operation")
+        context.process_request()
+
+    @service.operation("foo", cache=cache)
+    def foo(request, response, context):
+        called.append("foo")
+        response.value = request.a + request.b
+
+    def call(body):
+        environ = {
+            "PATH_INFO": "/test/foo",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body.encode())
+        }
+        result = service.wsgi_application(environ, start_response)
+        return ujson.loads(result[0])
+
+    assert call('{"a": 1, "b": 2}') == {"value": 3}
+    assert call('{"b":2,"a":1}') == {"value": 3}
+    assert called == ["request", "operation", "foo", "request"]
+    assert cache.stats()["hits"] == 1
+
+    assert call('{"a": 2, "b": 2}') == {"value": 4}
+    assert len(cache) == 2
+
+
+def test_cached_operation_exceptions(service):
+    ''' Failed requests aren't cached '''
+    cache = caching.Cache()
+    calls = []
+
+    @service.operation("foo", cache=cache)
+    def foo(request, response, context):
+        calls.append(request)
+        raise ValueError("Not cached")
+
+    for _ in range(2):
+        status, body = call_asgi(service, "/test/foo", "{}")
+        assert "__exception__" in ujson.loads(body)
+    assert len(calls) == 2
+    assert len(cache) == 0
+
+
+def test_cached_streaming_operation(service):
+    ''' Streaming requests can't be cached '''
+    with pytest.raises(ValueError):
+        service.operation("foo", func=lambda *args: None,
+                          stream=True, cache=caching.Cache())
+
+
+def test_coalesced_operation(service):
+    ''' Identical concurrent requests share one call '''
+    calls = []
+    release = threading.Event()
+
+    @service.operation("foo", coalesce=True)
+    def foo(request, response, context):
+        calls.append(request)
+        release.wait(1)
+        response.value = request.value
+
+    def process(body):
+        results.append(processors.service(service, "foo", body))
+    results = []
+
+    leader = threading.Thread(target=process, args=('{"value": 1}',))
+    leader.start()
+    while not calls:
+        time.sleep(0.001)
+    followers = [threading.Thread(target=process, args=(body,))
+                 for body in ['{"value": 1}', '{ "value":1 }', '{"value": 2}']]
+    for thread in followers:
+        thread.start()
+    while len(calls) < 2:
+        time.sleep(0.001)
+    # Give the identical followers time to join the leader's flight
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert sorted(results) == [
+        '{"value":1}', '{"value":1}', '{"value":1}', '{"value":2}']
+    assert len(calls) == 2
+    assert len(service.options["foo"]["coalescer"]) == 0
+
+
+def test_coalesced_operation_exception(service):
+    ''' Followers share the leader's exception; nothing is retained '''
+    service.api["exceptions"].append("Failed")
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    @service.operation("foo", coalesce=True)
+    def foo(request, response, context):
+        calls.append(request)
+        started.set()
+        release.wait(1)
+        raise service.exceptions.Failed("shared")
+
+    results = []
+
+    def process():
+        results.append(ujson.loads(processors.service(service, "foo", "{}")))
+    threads = [threading.Thread(target=process) for _ in range(3)]
+    threads[0].start()
+    started.wait(1)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    expected = {"__exception__": {"cls": "Failed", "args": ["shared"]}}
+    assert results == [expected] * 3
+    assert len(calls) == 1
+
+    # The next request runs again
+    release.set()
+    processors.service(service, "foo", "{}")
+    assert len(calls) == 2
+
+
+def test_coalesced_operation_stuck_leader(service):
+    ''' Followers stop waiting on a stuck leader at their deadline '''
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    @service.operation("foo", coalesce=True)
+    def foo(request, response, context):
+        calls.append(request)
+        started.set()
+        release.wait(1)
+
+    leader = threading.Thread(
+        target=processors.service, args=(service, "foo", "{}"))
+    leader.start()
+    started.wait(1)
+    try:
+        with pytest.raises(wsgi.DeadlineExceeded):
+            processors.service(service, "foo", "{}",
+                               deadline=time.time() + 0.05)
+        assert len(calls) == 1
+
+        # Without a deadline, they process their own request after timeout
+        service.api["timeout"] = 0.01
+        release.set()
+        processors.service(service, "foo", "{}")
+    finally:
+        release.set()
+        leader.join()
+
+
+def test_asgi_coalesced_operation_stuck_leader(service):
+    ''' asgi followers stop waiting on a stuck leader at their deadline '''
+    release = asyncio.Event()
+
+    @service.operation("foo", coalesce=True)
+    async def foo(request, response, context):
+        await release.wait()
+
+    async def run():
+        leader = asyncio.ensure_future(
+            processors.async_service(service, "foo", "{}"))
+        await asyncio.sleep(0.01)
+        try:
+            with pytest.raises(wsgi.DeadlineExceeded):
+                await processors.async_service(
+                    service, "foo", "{}", deadline=time.time() + 0.05)
+        finally:
+            release.set()
+            await leader
+
+    asyncio.run(run())
+
+
+def test_asgi_coalesced_operation(service):
+    ''' Coroutine operations are coalesced on the event loop '''
+    calls = []
+
+    @service.operation("foo", coalesce=True)
+    async def foo(request, response, context):
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        response.value = request.value
+
+    async def run():
+        return await asyncio.gather(*(
+            processors.async_service(service, "foo", '{"value": 1}')
+            for _ in range(5)))
+
+    assert asyncio.run(run()) == ['{"value":1}'] * 5
+    assert len(calls) == 1
+
+
+def test_operation_added_after_init(service, start_response):
+    ''' Operations added to the api later are routed once bound '''
+    service.api["operations"].append("late")
+    service.operation("late", func=lambda request, response, context:
+                      response.update(late=True))
+    environ = {
+        "PATH_INFO": "/test/late",
+        "CONTENT_LENGTH": "2",
+        "wsgi.input": io.BytesIO(b"{}")
+    }
+    result = service.wsgi_application(environ, start_response)
+    assert ujson.loads(result[0]) == {"late": True}
+
+
+def test_body_options(service):
+    ''' Operation limits fall back to the api '''
+    assert service.body_options("foo") == (service.api["max_body_size"], False)
+    service.operation("foo", func=None, max_body_size=10, stream=True)
+    assert service.body_options("foo") == (
+        service.api["max_body_size"], False)
+
+    service.operation("foo", func=lambda *args: None, max_body_size=10,
+                      stream=True)
+    assert service.body_options("foo") == (10, True)
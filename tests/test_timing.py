@@ -0,0 +1,172 @@
+import asyncio
+import collections
+import io
+import time
+import ujson
+from pyservice import AsyncClient, Client, Service, timing
+
+
+def server_timing(headers):
+    return timing.parse(dict(headers).get("Server-Timing"))
+
+
+def test_phases():
+    ''' Plugins are named by scope, and numbered when names repeat '''
+    def auth(context):
+        pass
+
+    class Plugin:
+        def __call__(self, context):
+            pass
+
+    names = timing.phases("request", [auth, Plugin(), auth, lambda: None])
+    assert names == [
+        "request.auth", "request.Plugin", "request.auth.2", "request._lambda_"]
+
+
+def test_header_round_trip():
+    ''' Durations are sent in milliseconds and parsed back to seconds '''
+    value = timing.header({"read": 0.001, "function": 0.25})
+    assert value == "read;dur=1.000, function;dur=250.000"
+    assert timing.parse(value) == {"read": 0.001, "function": 0.25}
+
+
+def test_parse_malformed():
+    ''' Metrics without a valid duration are skipped '''
+    value = 'db;desc="Database";dur=2, cache, miss;dur=x, ;dur=1'
+    assert timing.parse(value) == {"db": 0.002}
+    assert timing.parse(None) == {}
+
+
+def test_service_timings(api, wsgi_call, start_response):
+    ''' Each phase is timed, plugins exclusive of the chain they wrap '''
+    api["server_timing"] = True
+    service = Service(**api)
+    seen = {}
+
+    @service.plugin(scope="request")
+    def slow_auth(context):
+        time.sleep(0.02)
+        context.process_request()
+        seen.update(context.timings)
+
+    @service.plugin(scope="operation")
+    def passthrough(request, response, context):
+        context.process_request()
+
+    @service.operation("foo")
+    def foo(request, response, context):
+        time.sleep(0.05)
+        response.value = request.value
+
+    wsgi_call(service, "foo", '{"value": 1}')
+
+    assert list(seen) == [
+        "read", "request.slow_auth", "deserialize", "operation.passthrough",
+        "function", "serialize"]
+    assert 0.02 <= seen["request.slow_auth"] < 0.05
+    assert seen["function"] >= 0.05
+
+    phases = server_timing(start_response.headers)
+    assert list(phases) == list(seen)
+
+
+def test_service_timings_disabled(service, wsgi_call, start_response):
+    ''' Nothing is timed unless the api enables it '''
+    seen = []
+
+    @service.operation("foo")
+    def foo(request, response, context):
+        seen.append(context.timings)
+
+    wsgi_call(service, "foo", "{}")
+    assert seen == [None]
+    assert "Server-Timing" not in dict(start_response.headers)
+
+
+def test_batch_timings(api, wsgi_call, start_response):
+    ''' Batches time the batch as a whole '''
+    api["server_timing"] = True
+    service = Service(**api)
+    service.operation("foo", func=lambda request, response, context: None)
+    body = ujson.dumps({"operations": [{"operation": "foo"}]})
+    wsgi_call(service, "__batch__", body)
+
+    phases = server_timing(start_response.headers)
+    assert list(phases) == ["read", "deserialize", "entries", "serialize"]
+
+
+def test_asgi_timings(api):
+    ''' asgi responses carry the same header '''
+    api["server_timing"] = True
+    service = Service(**api)
+
+    @service.operation("foo")
+    async def foo(request, response, context):
+        response.value = 1
+
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"{}"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/test/foo", "headers": []}
+    asyncio.run(service.asgi_application(scope, receive, send))
+    headers = dict(sent[0]["headers"])
+    phases = timing.parse(headers[b"server-timing"].decode())
+    assert list(phases) == ["read", "deserialize", "function", "serialize"]
+
+
+Response = collections.namedtuple(
+    "Response", ["status_code", "text", "reason", "headers"])
+
+
+class Transport:
+    def send(self, uri, data, headers=None, timeout=None):
+        time.sleep(0.01)
+        return Response(200, data, "OK", {
+            "server-timing": "function;dur=2, serialize;dur=1"})
+
+
+def test_client_merges_timings(api):
+    ''' Client phases are merged with the service's '''
+    api["server_timing"] = True
+    client = Client(**api)
+    client.transport = Transport()
+    seen = {}
+
+    @client.plugin(scope="request")
+    def record(context):
+        context.process_request()
+        seen.update(context.timings)
+
+    client.foo(key="value")
+    assert set(seen) == {
+        "serialize", "transport", "deserialize", "service.function",
+        "service.serialize", "network"}
+    assert seen["service.function"] == 0.002
+    assert seen["network"] == seen["transport"] - 0.003
+
+
+def test_async_client_merges_timings(api):
+    ''' AsyncClient phases are merged the same way '''
+    api["server_timing"] = True
+    client = AsyncClient(**api)
+
+    class AsyncTransport:
+        async def send(self, *args, **kwargs):
+            return Transport().send(*args, **kwargs)
+    client.transport = AsyncTransport()
+    seen = {}
+
+    @client.plugin(scope="request")
+    async def record(context):
+        await context.process_request()
+        seen.update(context.timings)
+
+    asyncio.run(client.foo(key="value"))
+    assert "service.function" in seen
+    assert "network" in seen
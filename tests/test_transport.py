@@ -0,0 +1,338 @@
+import asyncio
+import http.server
+import socket
+import threading
+import time
+import wsgiref.simple_server
+import pytest
+import pyservice
+from pyservice import transport
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        body = self.rfile.read(length)
+        self.server.connections.add(self.client_address)
+        self.send_response(200)
+        if self.path.endswith("/stream"):
+            # One line per word of the request body
+            body = b"".join(word + b"\n" for word in body.split())
+            self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Path", self.path)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    ''' Local keep-alive server that echoes the request body '''
+    httpd = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+    httpd.connections = set()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.uri = "http://localhost:{}/api/foo".format(httpd.server_port)
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def service_server():
+    ''' Local wsgiref server running a Service '''
+    service = pyservice.Service(operations=["big"])
+    httpd = wsgiref.simple_server.make_server(
+        "localhost", 0, service.wsgi_application,
+        handler_class=QuietHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.service = service
+    httpd.endpoint = {"scheme": "http", "host": "localhost",
+                      "port": httpd.server_port, "pattern": "/api/{operation}"}
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_send_returns_response(server):
+    ''' status, headers and body are returned '''
+    pooled = transport.PooledTransport()
+    response = pooled.send(server.uri, "Hello", timeout=1)
+
+    assert response.status_code == 200
+    assert response.reason == "OK"
+    assert response.headers["x-path"] == "/api/foo"
+    assert response.text == "Hello"
+
+
+def test_connections_are_reused(server):
+    ''' Sequential calls share a single keep-alive connection '''
+    pooled = transport.PooledTransport()
+    for _ in range(5):
+        pooled.send(server.uri, "Hello", timeout=1)
+
+    assert len(server.connections) == 1
+
+
+def test_send_streamed_response(server):
+    ''' ndjson responses are read lazily, then the connection is reused '''
+    pooled = transport.PooledTransport()
+    uri = server.uri.replace("/foo", "/stream")
+    response = pooled.send(uri, "a b c", timeout=1)
+
+    assert isinstance(response, transport.StreamedResponse)
+    assert list(response.iter_lines()) == [b"a\n", b"b\n", b"c\n"]
+
+    pooled.send(server.uri, "Hello", timeout=1)
+    assert len(server.connections) == 1
+
+
+def test_streamed_response_closed_early(server):
+    ''' Closing a partially read stream discards its connection '''
+    pooled = transport.PooledTransport()
+    uri = server.uri.replace("/foo", "/stream")
+    response = pooled.send(uri, "a b c", timeout=1)
+    next(response.iter_lines())
+    response.close()
+
+    pooled.send(server.uri, "Hello", timeout=1)
+    assert len(server.connections) == 2
+
+
+def test_pool_size_limits_idle_connections():
+    ''' Released connections beyond pool_size are closed '''
+    closed = []
+
+    class Connection:
+        def close(self):
+            closed.append(self)
+
+    pool = transport.ConnectionPool(Connection, 1, None, None)
+    first, _ = pool.acquire()
+    second, _ = pool.acquire()
+    pool.release(first)
+    pool.release(second)
+
+    assert closed == [second]
+    assert pool.acquire() == (first, True)
+
+
+def test_max_connections_blocks():
+    ''' acquire fails when every connection is in use '''
+    pool = transport.ConnectionPool(object, 1, 1, None)
+    pool.acquire()
+    with pytest.raises(transport.TransportError):
+        pool.acquire(timeout=0.01)
+
+
+def test_idle_connections_are_reaped():
+    ''' Connections idle longer than idle_timeout are closed '''
+    closed = []
+
+    class Connection:
+        def close(self):
+            closed.append(self)
+
+    pool = transport.ConnectionPool(Connection, 1, None, 0)
+    connection, _ = pool.acquire()
+    pool.release(connection)
+    pool.reap()
+
+    assert closed == [connection]
+    assert pool.acquire()[1] is False
+
+
+def test_pool_per_endpoint():
+    ''' Each (scheme, host, port) gets its own pool '''
+    pooled = transport.PooledTransport()
+    pool = pooled.pool("http", "localhost", 8080)
+
+    assert pooled.pool("http", "localhost", 8080) is pool
+    assert pooled.pool("http", "localhost", 8081) is not pool
+
+
+def test_unsupported_scheme():
+    ''' Only http and https are supported '''
+    pooled = transport.PooledTransport()
+    with pytest.raises(transport.TransportError):
+        pooled.send("ftp://localhost/api/foo", "")
+
+
+def test_connection_refused_wrapped(server):
+    ''' Connection failures are wrapped in TransportError '''
+    uri = server.uri
+    server.shutdown()
+    server.server_close()
+
+    pooled = transport.PooledTransport()
+    with pytest.raises(transport.TransportError):
+        pooled.send(uri, "Hello", timeout=1)
+
+
+def test_send_concurrent_threads(server):
+    ''' A single transport can be shared across threads '''
+    pooled = transport.PooledTransport(pool_size=4, max_connections=4)
+    results = []
+
+    def call(i):
+        results.append(pooled.send(server.uri, str(i), timeout=1).text)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results, key=int) == [str(i) for i in range(16)]
+    assert len(server.connections) <= 4
+
+
+def test_async_send_returns_response(server):
+    ''' status, headers and body are returned from the coroutine '''
+    pooled = transport.AsyncPooledTransport()
+    response = asyncio.run(pooled.send(server.uri, "Hello", timeout=1))
+
+    assert response.status_code == 200
+    assert response.headers["x-path"] == "/api/foo"
+    assert response.text == "Hello"
+
+
+def test_async_connections_are_reused(server):
+    ''' Concurrent coroutines share at most max_connections '''
+    pooled = transport.AsyncPooledTransport(max_connections=2)
+
+    async def run():
+        calls = [pooled.send(server.uri, str(i), timeout=1)
+                 for i in range(20)]
+        return await asyncio.gather(*calls)
+
+    responses = asyncio.run(run())
+    assert [r.text for r in responses] == [str(i) for i in range(20)]
+    assert len(server.connections) <= 2
+
+
+def test_async_connection_refused_wrapped(server):
+    ''' Connection failures are wrapped in TransportError '''
+    uri = server.uri
+    server.shutdown()
+    server.server_close()
+
+    pooled = transport.AsyncPooledTransport()
+    with pytest.raises(transport.TransportError):
+        asyncio.run(pooled.send(uri, "Hello", timeout=1))
+
+
+@pytest.fixture
+def stalled():
+    ''' Port of a listener whose accept queue is full, so connects hang '''
+    listener = socket.socket()
+    listener.bind(("localhost", 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    clients = []
+    try:
+        while True:
+            client = socket.socket()
+            clients.append(client)
+            client.settimeout(0.1)
+            client.connect(("localhost", port))
+    except OSError:
+        pass
+    yield port
+    for client in clients:
+        client.close()
+    listener.close()
+
+
+def test_async_connect_timeout(stalled):
+    ''' The timeout covers opening a connection, and frees its slot '''
+    pooled = transport.AsyncPooledTransport(max_connections=1)
+    uri = "http://localhost:{}/api/foo".format(stalled)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(transport.TransportError):
+                await pooled.send(uri, "Hello", timeout=0.1)
+
+    start = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - start < 1
+
+
+def test_async_streamed_response(server):
+    ''' ndjson responses are read line by line from the coroutine '''
+    pooled = transport.AsyncPooledTransport()
+    uri = server.uri.replace("/foo", "/stream")
+
+    async def run():
+        response = await pooled.send(uri, "a b c", timeout=1)
+        return [line async for line in response.iter_lines()]
+
+    assert asyncio.run(run()) == [b"a\n", b"b\n", b"c\n"]
+
+
+def test_async_chunked_response():
+    ''' Chunked response bodies are reassembled '''
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"5\r\nHello\r\n7\r\n, World\r\n0\r\n\r\n")
+
+        class Writer:
+            def write(self, data):
+                pass
+
+            async def drain(self):
+                pass
+        connection = transport.AsyncConnection(
+            "localhost", 80, reader, Writer())
+        return await connection.request("/", b"", {})
+
+    response, will_close = asyncio.run(run())
+    assert response.text == "Hello, World"
+    assert not will_close
+
+
+def test_abandoned_stream_releases_connection(server):
+    ''' Dropping an unstarted stream frees its slot for the next call '''
+    client = pyservice.Client(
+        endpoint={"scheme": "http", "host": "localhost",
+                  "port": server.server_port, "pattern": "/api/{operation}"},
+        operations=["stream", "foo"], timeout=1)
+    client.transport = transport.PooledTransport(max_connections=1)
+
+    client.stream(words="a b c")
+    assert client.foo(words="d").words == "d"
+
+    with client.stream(words="a b c"):
+        pass
+    assert client.foo(words="e").words == "e"
+
+
+def test_large_compressed_response(service_server):
+    ''' Compressed responses aren't limited by the service's max_body_size '''
+    items = [{"id": i, "name": "item {}".format(i)} for i in range(10000)]
+
+    @service_server.service.operation("big")
+    def big(request, response, context):
+        response.items = items
+
+    client = pyservice.Client(
+        endpoint=service_server.endpoint, operations=["big"], timeout=5)
+    assert client.big().items == items
+
+    async_client = pyservice.AsyncClient(
+        endpoint=service_server.endpoint, operations=["big"], timeout=5)
+    assert asyncio.run(async_client.big()).items == items
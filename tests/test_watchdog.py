@@ -0,0 +1,54 @@
+import logging
+import time
+import pytest
+from pyservice import watchdog
+
+
+@pytest.fixture
+def dog():
+    dog = watchdog.Watchdog(threshold=0.02, interval=0.005)
+    yield dog
+    dog.stop()
+
+
+def test_slow_request_logged(service, dog, wsgi_call, caplog):
+    ''' Slow requests are logged with their operation, size and stacks '''
+    @service.operation("foo")
+    def slow_operation(request, response, context):
+        time.sleep(request.delay)
+
+    service.watchdog = dog
+    with caplog.at_level(logging.WARNING, logger="pyservice.watchdog"):
+        wsgi_call(service, "foo", b'{"delay": 0}')
+        assert not caplog.records
+        wsgi_call(service, "foo", b'{"delay": 0.1}')
+
+    [record] = caplog.records
+    message = record.getMessage()
+    assert message.startswith("Slow request to 'foo' (14 bytes) took ")
+    assert "slow_operation (" in message
+    assert not dog.requests
+
+
+def test_still_running(dog, caplog):
+    ''' Requests that hit max_samples are logged without waiting '''
+    dog.max_samples = 2
+    with caplog.at_level(logging.WARNING, logger="pyservice.watchdog"):
+        watched = dog.watch("foo", 0)
+        time.sleep(0.1)
+        [record] = caplog.records
+        assert "still running after" in record.getMessage()
+        assert watched.samples == 2
+        # Not logged again once it's done
+        dog.release(watched)
+    assert len(caplog.records) == 1
+
+
+def test_fast_requests_not_sampled(dog):
+    ''' Requests under the threshold are never sampled '''
+    dog.threshold = 10
+    watched = dog.watch("foo", 0)
+    time.sleep(0.02)
+    dog.release(watched)
+    assert not watched.samples
+    assert not dog.requests
@@ -1,6 +1,6 @@
 import io
 import pytest
-from pyservice import wsgi
+from pyservice import codecs, compression, wsgi
 
 
 def test_request_known_operation(service):
@@ -178,9 +178,191 @@ def test_load_body_no_input():
     assert wsgi.load_body(environ) == ''
 
 
-def test_load_chunked_body_raises(environment):
-    ''' chunked encoding isn't supported '''
+def test_load_chunked_body_malformed(environment):
+    ''' malformed chunked encoding raises '''
     environ = environment("Hello", 100)
     environ["HTTP_TRANSFER_ENCODING"] = "chunked"
     with pytest.raises(wsgi.RequestException):
         wsgi.load_body(environ)
+
+
+def test_load_chunked_body():
+    ''' chunked bodies are decoded without a content length '''
+    environ = {
+        "HTTP_TRANSFER_ENCODING": "chunked",
+        "wsgi.input": io.BytesIO(
+            b"5\r\nHello\r\n7;ext=1\r\n, World\r\n0\r\n\r\n")
+    }
+    assert wsgi.load_body(environ) == "Hello, World"
+
+
+def test_load_chunked_body_terminated():
+    ''' input the server already decoded is read to the end '''
+    environ = {
+        "HTTP_TRANSFER_ENCODING": "chunked",
+        "wsgi.input_terminated": True,
+        "wsgi.input": io.BytesIO(b"Hello, World")
+    }
+    assert wsgi.load_body(environ) == "Hello, World"
+
+
+def test_load_chunked_body_max_size():
+    ''' chunked bodies can't exceed max_size '''
+    environ = {
+        "HTTP_TRANSFER_ENCODING": "chunked",
+        "wsgi.input": io.BytesIO(b"5\r\nHello\r\n0\r\n\r\n")
+    }
+    with pytest.raises(wsgi.RequestException) as excinfo:
+        wsgi.load_body(environ, max_size=4)
+    assert excinfo.value.status == 413
+
+
+def test_load_body_custom_max_size(environment):
+    ''' max_size can be larger than MEMFILE_MAX '''
+    body = "x" * (wsgi.MEMFILE_MAX + 1)
+    environ = environment(body, len(body))
+    assert wsgi.load_body(environ, max_size=len(body)) == body
+
+
+def test_spool_body_to_disk(environment):
+    ''' Bodies larger than MEMFILE_MAX are spooled to a file '''
+    body = "x" * (wsgi.MEMFILE_MAX + 1)
+    environ = environment(body, len(body))
+    spooled = wsgi.spool_body(environ, max_size=len(body))
+
+    assert spooled._rolled
+    assert spooled.read() == body.encode("UTF-8")
+    spooled.close()
+
+
+def test_request_stream_operation(service, environment):
+    ''' Streaming operations get a file with the raw body '''
+    service.operation("foo", func=lambda *args: None, stream=True)
+    environ = environment("Body", 4)
+    environ["PATH_INFO"] = "/test/foo"
+    request = wsgi.Request(service, environ)
+
+    request.operation
+    assert request.body.read() == b"Body"
+    request.close()
+    assert request.body.closed
+
+
+def test_request_operation_max_size(service, environment):
+    ''' Operations can lower the body limit '''
+    service.operation("foo", func=lambda *args: None, max_body_size=3)
+    environ = environment("Body", 4)
+    environ["PATH_INFO"] = "/test/foo"
+    request = wsgi.Request(service, environ)
+
+    request.operation
+    with pytest.raises(wsgi.RequestException):
+        request.body
+
+
+def test_request_batch_operation(service):
+    ''' The batch operation is reserved for every service '''
+    environ = {"PATH_INFO": "/test/__batch__"}
+    request = wsgi.Request(service, environ)
+    assert request.operation == "__batch__"
+
+
+def test_negotiate_defaults_to_json(service):
+    ''' Requests without headers are JSON both ways '''
+    assert wsgi.negotiate(service.codecs, None, None) == (
+        codecs.JSON, codecs.JSON)
+
+
+def test_negotiate_accept(service):
+    ''' Accept picks the response codec, wildcards keep the request's '''
+    msgpack = service.codecs["application/x-msgpack"]
+    assert wsgi.negotiate(
+        service.codecs, "application/json; charset=utf-8",
+        "application/x-msgpack") == (codecs.JSON, msgpack)
+    assert wsgi.negotiate(
+        service.codecs, "application/x-msgpack",
+        "text/html, */*;q=0.1") == (msgpack, msgpack)
+
+
+def test_negotiate_unsupported(service):
+    ''' Unknown content types are 415, unacceptable responses are 406 '''
+    with pytest.raises(wsgi.RequestException) as excinfo:
+        wsgi.negotiate(service.codecs, "text/xml", None)
+    assert excinfo.value.status == 415
+    with pytest.raises(wsgi.RequestException) as excinfo:
+        wsgi.negotiate(service.codecs, None, "text/xml")
+    assert excinfo.value.status == 406
+
+
+def test_request_binary_body(service, environment):
+    ''' Bodies of binary codecs aren't decoded '''
+    environ = environment("Body", 4)
+    environ["CONTENT_TYPE"] = "application/x-msgpack"
+    request = wsgi.Request(service, environ)
+    assert request.body == b"Body"
+
+
+def test_set_response_content_type(start_response):
+    ''' content_type is sent with non-empty bodies '''
+    response = wsgi.Response(start_response)
+    response.content_type = "application/x-msgpack"
+    response.body = b"\x80\x01"
+
+    assert response.send() == [b"\x80\x01"]
+    assert start_response.headers == [
+        ('Content-Length', '2'), ('Content-Type', 'application/x-msgpack')]
+
+
+def test_load_compressed_body(environment):
+    ''' Bodies with a Content-Encoding are decompressed '''
+    body = compression.compress(b"Hello, World" * 10, "gzip")
+    environ = {
+        "CONTENT_LENGTH": str(len(body)),
+        "HTTP_CONTENT_ENCODING": "gzip",
+        "wsgi.input": io.BytesIO(body)
+    }
+    assert wsgi.load_body(environ) == "Hello, World" * 10
+
+
+def test_load_compressed_body_limit():
+    ''' The limit applies to the decompressed size '''
+    body = compression.compress(b"x" * (wsgi.MEMFILE_MAX + 1), "deflate")
+    environ = {
+        "CONTENT_LENGTH": str(len(body)),
+        "HTTP_CONTENT_ENCODING": "deflate",
+        "wsgi.input": io.BytesIO(body)
+    }
+    with pytest.raises(wsgi.RequestException) as excinfo:
+        wsgi.load_body(environ)
+    assert excinfo.value.status == 413
+
+
+@pytest.mark.parametrize("encoding, status", [("gzip", 400), ("br", 415)])
+def test_load_compressed_body_invalid(encoding, status):
+    ''' Malformed bodies are 400, unknown encodings 415 '''
+    environ = {
+        "CONTENT_LENGTH": "4",
+        "HTTP_CONTENT_ENCODING": encoding,
+        "wsgi.input": io.BytesIO(b"Body")
+    }
+    with pytest.raises(wsgi.RequestException) as excinfo:
+        wsgi.load_body(environ)
+    assert excinfo.value.status == status
+
+
+def test_set_response_compressed(start_response):
+    ''' Bodies over the threshold are compressed '''
+    response = wsgi.Response(start_response)
+    response.compression = ("gzip", 6, 10)
+    response.body = "x" * 100
+
+    body = response.send()[0]
+    assert compression.decompress(body, "gzip") == b"x" * 100
+    assert start_response.headers == [
+        ('Content-Length', str(len(body))),
+        ('Content-Encoding', 'gzip'),
+        ('Vary', 'Accept-Encoding')]
+
+    response.body = "x" * 9
+    assert response.send() == [b"x" * 9]
+    assert ('Content-Encoding', 'gzip') not in start_response.headers